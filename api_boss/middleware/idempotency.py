@@ -0,0 +1,179 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from flask import Response, g, jsonify, request
+from pymongo.errors import DuplicateKeyError
+from logger.logger_base import Logger
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# Response headers stored with the body and sent again on a replay
+REPLAYED_HEADERS = ('Content-Type', 'Location', 'ETag')
+
+
+class LocalKeyStore:
+    # Keys in this process only, least recently used dropped first; for the single-node (memory engine) mode
+    def __init__(self, max_keys=10000):
+        self.records = OrderedDict()  # key -> record, as stored by CollectionKeyStore
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def reserve(self, key, fingerprint, ttl_seconds, lock_seconds):
+        # Claim the key for this request and return None, or return the record of the request that holds it
+        now = time.time()
+        with self.lock:
+            record = self.records.get(key)
+            if record and record['expires'] <= now:
+                record = None
+            abandoned = record and record['status'] == 'pending' and record['lockedUntil'] < now
+            if record and not (abandoned and record['fingerprint'] == fingerprint):
+                self.records.move_to_end(key)
+                return record
+            self.records[key] = {'fingerprint': fingerprint, 'status': 'pending', 'lockedUntil': now + lock_seconds,
+                                 'expires': now + ttl_seconds}
+            self.records.move_to_end(key)
+            while len(self.records) > self.max_keys:
+                self.records.popitem(last=False)
+            return None
+
+    def complete(self, key, response):
+        with self.lock:
+            if key in self.records:
+                self.records[key].update(status='done', response=response)
+
+    def release(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+
+
+class CollectionKeyStore:
+    # Keys in the shared idempotency_keys collection, so a retry landing on another worker or replica is caught too
+    # Old keys are removed by a TTL index on expiresAt
+    def __init__(self, repository):
+        self.repository = repository
+
+    def ensure_indexes(self):
+        self.repository.create_index('expiresAt', expire_after_seconds=0)
+
+    def reserve(self, key, fingerprint, ttl_seconds, lock_seconds):
+        now = time.time()
+        for _ in range(2):
+            try:
+                # The unique _id makes the claim atomic: of two concurrent retries only one inserts
+                self.repository.insert_one({
+                    '_id': key, 'fingerprint': fingerprint, 'status': 'pending', 'lockedUntil': now + lock_seconds,
+                    'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds),
+                })
+                return None
+            except DuplicateKeyError:
+                record = self.repository.find_one({'_id': key})
+            if record is None:
+                continue  # Expired between the insert and the read
+            if record['status'] == 'pending' and record['lockedUntil'] < now and record['fingerprint'] == fingerprint:
+                # The worker that claimed it died mid-request: take the key over
+                if self.repository.update_one({'_id': key, 'status': 'pending', 'lockedUntil': record['lockedUntil']},
+                                              {'$set': {'lockedUntil': now + lock_seconds}}):
+                    return None
+            return record
+        return None
+
+    def complete(self, key, response):
+        self.repository.update_one({'_id': key}, {'$set': {'status': 'done', 'response': response}})
+
+    def release(self, key):
+        self.repository.delete_one({'_id': key, 'status': 'pending'})
+
+
+class IdempotencyKeys:
+    # Makes POST retries safe: the first request with an Idempotency-Key header runs and its response is stored,
+    # a retry with the same key gets the stored response back without running validation or the insert again
+    # Keys are scoped by service, tenant and X-API-Key; reusing a key for a different request body is refused with 422
+    # Only JSON requests take part, streamed uploads such as archive imports can't be fingerprinted up front
+    def __init__(self, app, store, scope, ttl_seconds=86400, lock_seconds=60):
+        self.logger = Logger()  # Logger for logging messages
+        self.store = store  # Where the keys and stored responses live
+        self.scope = scope  # Collection name of the service, e.g. 'characters'
+        self.ttl_seconds = ttl_seconds  # How long a key is remembered
+        self.lock_seconds = lock_seconds  # After this long a request still in progress is presumed dead
+        app.before_request(self.replay)
+        app.after_request(self.remember)
+        app.teardown_request(self.release)
+
+    @classmethod
+    def from_environment(cls, app, db_conn, scope):
+        # On unless IDEMPOTENCY=0; IDEMPOTENCY_STORE=collection (default with MongoDB) or local (default with the memory engine)
+        if os.environ.get('IDEMPOTENCY', '1').lower() in ('0', 'false', 'no'):
+            return None
+        kind = os.environ.get('IDEMPOTENCY_STORE', 'local' if db_conn.backend == 'memory' else 'collection').lower()
+        if kind == 'local':
+            store = LocalKeyStore(int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000)))
+        else:
+            store = CollectionKeyStore(db_conn.repository('idempotency_keys'))
+            try:
+                store.ensure_indexes()
+            except Exception as e:
+                # Without the TTL index old keys pile up, but retries are still caught
+                Logger().error(f'Error creating the idempotency key index: {e}')
+        return cls(app, store, scope, ttl_seconds=float(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400)))
+
+    def replay(self):
+        key = request.headers.get(HEADER)
+        if request.method != 'POST' or not key or not request.is_json:
+            return None
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'Invalid data: {HEADER} is limited to {MAX_KEY_LENGTH} characters'}), 400
+
+        client = hashlib.sha256(f'{g.get("tenant", "")}\0{request.headers.get("X-API-Key", "")}\0{key}'.encode()).hexdigest()
+        stored_key = f'{self.scope}:{client}'
+        fingerprint = hashlib.sha256(request.full_path.encode() + b'\0' + request.get_data()).hexdigest()
+        try:
+            record = self.store.reserve(stored_key, fingerprint, self.ttl_seconds, self.lock_seconds)
+        except Exception as e:
+            # The store is down: run the request as if no key was sent rather than fail it
+            self.logger.error(f'Error reserving an idempotency key: {e}')
+            return None
+
+        if record is None:
+            g.idempotency_key = stored_key  # First request with this key, let it run
+            return None
+        if record['fingerprint'] != fingerprint:
+            return jsonify({'error': f'{HEADER} was already used for a different request'}), 422
+        if record['status'] == 'pending':
+            response = jsonify({'error': f'A request with this {HEADER} is still in progress'})
+            response.headers['Retry-After'] = '1'
+            return response, 409
+        stored = record['response']
+        response = Response(stored['body'], status=stored['status'], headers=stored['headers'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def remember(self, response):
+        stored_key = g.pop('idempotency_key', None)
+        if stored_key is None:
+            return response
+        try:
+            if response.status_code >= 500 or response.is_streamed:
+                self.store.release(stored_key)  # Server errors are worth retrying for real
+            else:
+                self.store.complete(stored_key, {
+                    'status': response.status_code,
+                    'body': response.get_data(),
+                    'headers': {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers},
+                })
+        except Exception as e:
+            self.logger.error(f'Error storing the response of an idempotency key: {e}')
+        return response
+
+    def release(self, exception=None):
+        # An unhandled exception skips after_request: free the key so a retry runs again
+        stored_key = g.pop('idempotency_key', None)
+        if stored_key is not None:
+            try:
+                self.store.release(stored_key)
+            except Exception as e:
+                self.logger.error(f'Error releasing an idempotency key: {e}')
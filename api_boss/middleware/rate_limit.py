@@ -0,0 +1,183 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import g, jsonify, request
+from logger.logger_base import Logger
+from middleware.tenant import parse_api_keys
+
+# Default budgets per route class: tokens added per second, bucket size (the largest burst)
+DEFAULT_BUDGETS = {
+    'list': (5, 20),
+    'write': (2, 10),
+    'healthcheck': (1, 5),
+}
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def parse_budget(value, default):
+    # "5,20" -> (5.0, 20.0)
+    if not value:
+        return default
+    rate, _, burst = value.partition(',')
+    return float(rate), float(burst or rate)
+
+
+class LocalBucketStore:
+    # Token buckets in this process only; a stand-in when the app runs with a single worker
+    def __init__(self, max_buckets=10000):
+        self.buckets = {}  # key -> (tokens, updated)
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        # Spend one token; returns (allowed, seconds until a token is available, tokens left)
+        now = time.time() if now is None else now
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            allowed, tokens, retry_after = refill_and_take(tokens, updated, rate, burst, now)
+            if key not in self.buckets and len(self.buckets) >= self.max_buckets:
+                # Drop the longest idle bucket; an idle client's bucket is full again anyway
+                del self.buckets[min(self.buckets, key=lambda name: self.buckets[name][1])]
+            self.buckets[key] = (tokens, now)
+            return allowed, retry_after, tokens
+
+
+class SharedBucketStore:
+    # Token buckets in a memory-mapped file (e.g. under /dev/shm) shared by every worker process
+    # Fixed-size open-addressing table: slot = (key hash, tokens, last update)
+    SLOT = struct.Struct('<Qdd')
+    PROBES = 8
+
+    def __init__(self, path, slots=4096):
+        self.slots = slots
+        size = self.SLOT.size * slots
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.lock = threading.Lock()  # flock is per process, the threads of a worker need their own lock
+
+    def take(self, key, rate, burst, now=None):
+        now = time.time() if now is None else now
+        key_hash = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                offset = self.find_slot(key_hash)
+                stored_hash, tokens, updated = self.SLOT.unpack_from(self.map, offset)
+                if stored_hash != key_hash:
+                    tokens, updated = burst, now  # New client, or its slot was reused by another one
+                allowed, tokens, retry_after = refill_and_take(tokens, updated, rate, burst, now)
+                self.SLOT.pack_into(self.map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return allowed, retry_after, tokens
+
+    def find_slot(self, key_hash):
+        # The key's own slot, else an empty one, else the longest idle one among the probed slots
+        oldest_offset, oldest_time = None, None
+        for probe in range(self.PROBES):
+            offset = ((key_hash + probe) % self.slots) * self.SLOT.size
+            stored_hash, _, updated = self.SLOT.unpack_from(self.map, offset)
+            if stored_hash == key_hash or stored_hash == 0:
+                return offset
+            if oldest_time is None or updated < oldest_time:
+                oldest_offset, oldest_time = offset, updated
+        return oldest_offset
+
+
+def refill_and_take(tokens, updated, rate, burst, now):
+    # Token bucket: refill for the time elapsed, then spend one token if there is one
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return True, tokens - 1, 0
+    return False, tokens, (1 - tokens) / rate if rate else 60
+
+
+class RateLimiter:
+    # Admission control for a Flask app: per-client token buckets plus a cap on requests in progress
+    def __init__(self, app, store, budgets=None, max_concurrent=12, queue_timeout=0.05, trust_proxy=False, api_keys=()):
+        self.logger = Logger()  # Logger for logging messages
+        self.store = store  # Where the token buckets live
+        self.budgets = budgets or DEFAULT_BUDGETS
+        self.queue_timeout = queue_timeout  # Seconds a request may wait for a free slot before it is shed
+        self.trust_proxy = trust_proxy  # Take the client IP from X-Forwarded-For (only behind a trusted proxy)
+        self.api_keys = frozenset(api_keys)  # Issued API keys, which get a bucket of their own
+        # Fewer slots than gunicorn threads, so a flood is turned away while threads remain for everyone else
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    @classmethod
+    def from_environment(cls, app):
+        # Rate limiting is opt-in: RATE_LIMIT=1, with the budgets sized for the deployment (RATE_LIMIT_LIST, _WRITE...)
+        # RATE_LIMIT_STORE is a shared-memory file path, without it buckets are per worker
+        # The keys of TENANT_API_KEYS and RATE_LIMIT_API_KEYS (comma separated) are limited per key, not per IP
+        if os.environ.get('RATE_LIMIT', '0').lower() not in ('1', 'true', 'yes'):
+            return None
+        path = os.environ.get('RATE_LIMIT_STORE')
+        store = SharedBucketStore(path) if path else LocalBucketStore()
+        budgets = {
+            route_class: parse_budget(os.environ.get(f'RATE_LIMIT_{route_class.upper()}'), default)
+            for route_class, default in DEFAULT_BUDGETS.items()
+        }
+        return cls(
+            app, store, budgets,
+            max_concurrent=int(os.environ.get('RATE_LIMIT_MAX_CONCURRENT', 12)),
+            queue_timeout=float(os.environ.get('RATE_LIMIT_QUEUE_TIMEOUT', 0.05)),
+            trust_proxy=os.environ.get('RATE_LIMIT_TRUST_PROXY', '0').lower() in ('1', 'true', 'yes'),
+            api_keys=set(parse_api_keys(os.environ.get('TENANT_API_KEYS')))
+            | {key.strip() for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key.strip()},
+        )
+
+    def client_key(self):
+        # Clients that send an issued API key are limited per key, everyone else per IP; an unknown key would
+        # otherwise let a client pick a fresh bucket for every request
+        api_key = request.headers.get('X-API-Key')
+        if api_key and api_key in self.api_keys:
+            return f'key:{api_key}'
+        if self.trust_proxy and request.headers.get('X-Forwarded-For'):
+            return f'ip:{request.headers["X-Forwarded-For"].split(",")[0].strip()}'
+        return f'ip:{request.remote_addr}'
+
+    def route_class(self):
+        if request.path == '/healthcheck':
+            return 'healthcheck'
+        if request.method in WRITE_METHODS:
+            return 'write'
+        return 'list'
+
+    def admit(self):
+        if request.method == 'OPTIONS':
+            return None  # CORS preflight
+        route_class = self.route_class()
+        rate, burst = self.budgets[route_class]
+        allowed, retry_after, _ = self.store.take(f'{route_class}:{self.client_key()}', rate, burst)
+        if not allowed:
+            response = jsonify({'error': 'Too many requests, slow down'})
+            response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+            return response, 429
+
+        # Event streams stay open for minutes, so they don't take a slot (the change feed caps them per process with
+        # CHANGE_FEED_MAX_STREAMS); neither do health checks
+        if self.slots is None or route_class == 'healthcheck' or request.path.endswith('/events'):
+            return None
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            # Shed the request now instead of letting it queue behind the busy threads
+            self.logger.warning(f'Shedding {request.method} {request.path}: too many requests in progress')
+            response = jsonify({'error': 'Server busy, try again shortly'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        g.rate_limit_slot = True
+        return None
+
+    def release(self, exception=None):
+        if g.pop('rate_limit_slot', False):
+            self.slots.release()
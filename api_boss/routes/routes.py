@@ -1,14 +1,22 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from marshmallow import ValidationError
 from logger.logger_base import Logger
-from flasgger import swag_from
+from routes.docs import swag_from  # flasgger's swag_from, or a no-op when the docs are prebuilt
+from services.delta_sync import parse_cursor
+from schemas.schemas import EncounterSchema
+from services.encounter import parse_cr
+from schemas.tags import parse_tags
 
 # Define routes for managing bosses (add, update, delete, etc.)
 class BossRoutes(Blueprint):
+    # Fields a PATCH request may change, each checked with the matching validate_* method
+    PATCH_FIELDS = ('named', 'typed', 'picture', 'cr', 'hp', 'ac', 'resistances', 'immunities', 'abilities')
+
     def __init__(self, boss_service, boss_schema):
         super().__init__('boss', __name__)  # Initialize the Blueprint
         self.boss_service = boss_service  # Service to handle database operations
         self.boss_schema = boss_schema  # Schema to validate the boss data
+        self.encounter_schema = EncounterSchema()  # Schema to validate encounter requests
         self.register_routes()  # Register the routes (endpoints)
         self.logger = Logger()  # Logger for logging messages
         
@@ -17,12 +25,37 @@ class BossRoutes(Blueprint):
         self.route('/api/v1/bosses', methods=['GET'])(self.get_bosses)
         self.route('/api/v1/bosses', methods=['POST'])(self.add_bosses)
         self.route('/api/v1/bosses/<int:boss_id>', methods=['PUT'])(self.update_boss)
+        self.route('/api/v1/bosses/<int:boss_id>', methods=['PATCH'])(self.patch_boss)
         self.route('/api/v1/bosses/<int:boss_id>', methods=['DELETE'])(self.delete_boss)
+        self.route('/api/v1/bosses/events', methods=['GET'])(self.stream_events)
+        self.route('/api/v1/bosses/changes', methods=['GET'])(self.get_changes)
+        self.route('/api/v1/bosses/stats', methods=['GET'])(self.get_stats)
+        self.route('/api/v1/bosses/jobs', methods=['POST'])(self.submit_job)
+        self.route('/api/v1/bosses/jobs/<job_id>', methods=['GET'])(self.get_job)
+        self.route('/api/v1/bosses/export', methods=['GET'])(self.export_bosses)
+        self.route('/api/v1/bosses/import', methods=['POST'])(self.import_bosses)
+        self.route('/api/v1/bosses/encounter', methods=['POST'])(self.evaluate_encounter)
+        self.route('/api/v1/bosses/encounter/suggest', methods=['POST'])(self.suggest_bosses)
         self.route('/healthcheck', methods=['GET'])(self.healthcheck)
 
     @swag_from({
         'tags': ['Bosses'],
-        'parameters': [],  # No necesitas un cuerpo en la solicitud GET
+        'parameters': [
+            {
+                'name': 'immune',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Only bosses immune to all of these, comma-separated (e.g. fire,poison)'
+            },
+            {
+                'name': 'resist',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Only bosses resistant to all of these, comma-separated (e.g. cold)'
+            }
+        ],
         'responses': {
             200: {'description': 'List of bosses'},
             400: {'description': 'Invalid data'},
@@ -30,8 +63,12 @@ class BossRoutes(Blueprint):
         }
     })
     def get_bosses(self):
-        # Get all bosses from the database
-        bosses = self.boss_service.get_all_bosses()
+        # Get all bosses from the database, optionally only those with the given immunities and resistances
+        required_tags = {
+            'immunityTags': parse_tags(request.args.get('immune')),
+            'resistanceTags': parse_tags(request.args.get('resist')),
+        }
+        bosses = self.boss_service.get_all_bosses(required_tags)
         return jsonify(bosses), 200  # Return the list of bosses as JSON
     
     
@@ -59,6 +96,13 @@ class BossRoutes(Blueprint):
                     },
                     'required': ['named', 'typed', 'picture', 'cr', 'hp', 'ac', 'resistances', 'immunities', 'abilities']
                 }
+            },
+            {
+                'name': 'Idempotency-Key',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Unique key per logical request; a retry with the same key gets the first response back instead of a duplicate'
             }
         ],
         'responses': {
@@ -82,6 +126,12 @@ class BossRoutes(Blueprint):
             400: {
                 'description': 'Invalid or missing data in the request body'
             },
+            409: {
+                'description': 'A request with the same Idempotency-Key is still in progress'
+            },
+            422: {
+                'description': 'The Idempotency-Key was already used for a different request'
+            },
             500: {
                 'description': 'Internal server error'
             }
@@ -129,7 +179,10 @@ class BossRoutes(Blueprint):
                 'ac': ac,
                 'resistances': resistances,
                 'immunities': immunities,
-                'abilities': abilities
+                'abilities': abilities,
+                'crValue': parse_cr(cr),  # Numeric challenge rating for encounter math
+                'resistanceTags': parse_tags(resistances),  # Canonical lowercase tags for the ?resist= filter
+                'immunityTags': parse_tags(immunities),  # Canonical lowercase tags for the ?immune= filter
             }
             created_boss = self.boss_service.add_boss(new_boss)  # Add the boss to the database
             self.logger.info(f'New boss: {created_boss}')  # Log the new boss creation
@@ -184,6 +237,9 @@ class BossRoutes(Blueprint):
                 'resistances': resistances,
                 'immunities': immunities,
                 'abilities': abilities,
+                'crValue': parse_cr(cr),  # Numeric challenge rating for encounter math
+                'resistanceTags': parse_tags(resistances),  # Canonical lowercase tags for the ?resist= filter
+                'immunityTags': parse_tags(immunities),  # Canonical lowercase tags for the ?immune= filter
             }
             updated_boss = self.boss_service.update_boss(boss_id, update_boss)  # Update the boss in the database
             if updated_boss:
@@ -195,6 +251,103 @@ class BossRoutes(Blueprint):
             self.logger.error(f'Error updating the boss in the database: {e}')
             return jsonify({'error': f'Error updating the boss in the database: {e}'}), 500  # Handle any errors
 
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Update only some fields of a boss',
+        'parameters': [
+            {
+                'name': 'boss_id',
+                'in': 'path',
+                'required': True,
+                'type': 'integer',
+                'description': 'ID of the boss to update'
+            },
+            {
+                'name': 'If-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; the update is rejected if the boss changed since'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'named': {'type': 'string'},
+                        'typed': {'type': 'string'},
+                        'picture': {'type': 'string'},
+                        'cr': {'type': 'string'},
+                        'hp': {'type': 'string'},
+                        'ac': {'type': 'string'},
+                        'resistances': {'type': 'string'},
+                        'immunities': {'type': 'string'},
+                        'abilities': {'type': 'string'},
+                    }
+                }
+            }
+        ],
+        'responses': {
+            200: {'description': 'The changed fields, with the new version in the ETag header'},
+            400: {'description': 'Invalid data'},
+            404: {'description': 'Boss not found'},
+            412: {'description': 'The boss was changed by someone else'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def patch_boss(self, boss_id):
+        # Update only the fields sent by the client
+        try:
+            request_data = request.json  # Get the changed fields
+
+            if not request_data:
+                return jsonify({'error': 'Invalid data, empty'}), 400  # Check if data is empty
+
+            unknown_fields = sorted(set(request_data) - set(self.PATCH_FIELDS))
+            if unknown_fields:
+                return jsonify({'error': f'Invalid data: unknown fields {unknown_fields}'}), 400
+
+            # Optional optimistic concurrency check against the version the client last saw
+            expected_version = None
+            if_match = request.headers.get('If-Match')
+            if if_match:
+                expected_version = if_match.removeprefix('W/').strip('"')
+                if not expected_version.isdigit():
+                    return jsonify({'error': 'Invalid If-Match header'}), 400
+                expected_version = int(expected_version)
+
+            # Validate only the supplied fields using the schema
+            try:
+                for field, value in request_data.items():
+                    if value is None:
+                        raise ValidationError(f'{field} must not be null')
+                    getattr(self.boss_schema, f'validate_{field}')(value)
+            except ValidationError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400  # Return error if validation fails
+
+            changes = dict(request_data)
+            if 'cr' in changes:
+                changes['crValue'] = parse_cr(changes['cr'])  # Keep the numeric challenge rating in sync
+            if 'resistances' in changes:
+                changes['resistanceTags'] = parse_tags(changes['resistances'])  # Keep the tags in sync
+            if 'immunities' in changes:
+                changes['immunityTags'] = parse_tags(changes['immunities'])
+            patched_boss = self.boss_service.patch_boss(boss_id, changes, expected_version)  # Update the boss in the database
+            if patched_boss is None:
+                return jsonify({'error': 'Boss not found'}), 404  # If boss not found, return an error
+            if patched_boss is False:
+                return jsonify({'error': 'Boss was modified by another request'}), 412  # Version mismatch
+
+            response = jsonify(patched_boss)
+            response.headers['ETag'] = f'"{patched_boss["updatedAt"]}"'  # New version for the next If-Match
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error patching the boss in the database: {e}')
+            return jsonify({'error': f'Error patching the boss in the database: {e}'}), 500  # Handle any errors
+
     def delete_boss(self, boss_id):
         # Delete a boss by its ID
         try:
@@ -209,6 +362,397 @@ class BossRoutes(Blueprint):
             self.logger.error(f'Error deleting the boss from the database: {e}')
             return jsonify({'error': f'Error deleting the boss from the database: {e}'}), 500  # Handle any errors
         
+    def get_party_levels(self, request_data):
+        # Use the explicit party levels, or look them up from the given character ids
+        character_ids = request_data.get('characterIds')
+        if character_ids is not None:
+            self.encounter_schema.validate_characterIds(character_ids)
+            party_levels = list(request_data.get('partyLevels') or []) + self.boss_service.get_party_levels(character_ids)
+        else:
+            party_levels = request_data.get('partyLevels')
+        self.encounter_schema.validate_partyLevels(party_levels)
+        return party_levels
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Rate the difficulty of an encounter',
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'partyLevels': {'type': 'array', 'items': {'type': 'integer'}, 'description': 'Levels of the party members'},
+                        'characterIds': {'type': 'array', 'items': {'type': 'integer'}, 'description': 'Characters whose levels are added to the party'},
+                        'bossIds': {'type': 'array', 'items': {'type': 'integer'}, 'description': 'Bosses in the encounter'},
+                    },
+                    'required': ['bossIds']
+                }
+            }
+        ],
+        'responses': {
+            200: {'description': 'XP thresholds, adjusted XP and difficulty of the encounter'},
+            400: {'description': 'Invalid data'},
+            404: {'description': 'Boss not found'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def evaluate_encounter(self):
+        # Compute the difficulty of fighting the given bosses
+        try:
+            request_data = request.json  # Get the data from the request
+
+            if not request_data:
+                return jsonify({'error': 'Invalid data, empty'}), 400  # Check if data is empty
+
+            boss_ids = request_data.get('bossIds')
+
+            # Validate the data using the schema
+            try:
+                party_levels = self.get_party_levels(request_data)
+                self.encounter_schema.validate_bossIds(boss_ids)
+            except ValidationError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400  # Return error if validation fails
+
+            encounter = self.boss_service.evaluate_encounter(party_levels, boss_ids)
+            if 'error' in encounter:
+                return jsonify(encounter), 404  # A boss is missing or has an unusable challenge rating
+            return jsonify(encounter), 200
+
+        except Exception as e:
+            self.logger.error(f'Error evaluating the encounter: {e}')
+            return jsonify({'error': f'Error evaluating the encounter: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Suggest bosses for a target difficulty',
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'partyLevels': {'type': 'array', 'items': {'type': 'integer'}, 'description': 'Levels of the party members'},
+                        'characterIds': {'type': 'array', 'items': {'type': 'integer'}, 'description': 'Characters whose levels are added to the party'},
+                        'difficulty': {'type': 'string', 'description': 'easy, medium, hard or deadly (default medium)'},
+                        'maxBosses': {'type': 'integer', 'description': 'Most bosses per suggestion, 1 to 6 (default 3)'},
+                        'limit': {'type': 'integer', 'description': 'Number of suggestions, 1 to 20 (default 5)'},
+                    }
+                }
+            }
+        ],
+        'responses': {
+            200: {'description': 'Boss combinations whose adjusted XP matches the difficulty'},
+            400: {'description': 'Invalid data'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def suggest_bosses(self):
+        # Suggest boss combinations within the party's XP budget
+        try:
+            request_data = request.json  # Get the data from the request
+
+            if not request_data:
+                return jsonify({'error': 'Invalid data, empty'}), 400  # Check if data is empty
+
+            difficulty = request_data.get('difficulty', 'medium')
+            max_bosses = request_data.get('maxBosses', 3)
+            limit = request_data.get('limit', 5)
+
+            # Validate the data using the schema
+            try:
+                party_levels = self.get_party_levels(request_data)
+                self.encounter_schema.validate_difficulty(difficulty)
+                if not isinstance(max_bosses, int) or not 1 <= max_bosses <= 6:
+                    raise ValidationError('maxBosses must be between 1 and 6.')
+                if not isinstance(limit, int) or not 1 <= limit <= 20:
+                    raise ValidationError('limit must be between 1 and 20.')
+            except ValidationError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400  # Return error if validation fails
+
+            suggestions = self.boss_service.suggest_bosses(party_levels, difficulty, max_bosses, limit)
+            return jsonify(suggestions), 200
+
+        except Exception as e:
+            self.logger.error(f'Error suggesting bosses: {e}')
+            return jsonify({'error': f'Error suggesting bosses: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Stream bosses changes as Server-Sent Events',
+        'parameters': [
+            {
+                'name': 'Last-Event-ID',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Id of the last event received, to replay what was missed while disconnected'
+            }
+        ],
+        'produces': ['text/event-stream'],
+        'responses': {
+            200: {'description': 'Stream of insert, update, replace and delete events'},
+            503: {'description': 'Too many open event streams in this process'}
+        }
+    })
+    def stream_events(self):
+        # Push changes to the client instead of having it poll the list endpoint
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+        change_feed = self.boss_service.change_feed
+        if not change_feed.open_stream():
+            # Each open stream holds a server thread, so past the cap the client should come back later
+            response = jsonify({'error': 'Too many open event streams, try again shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        response = Response(change_feed.stream(last_event_id), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Don't let a reverse proxy hold events back
+        })
+        response.call_on_close(change_feed.close_stream)
+        return response
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Boss changes since the last sync',
+        'parameters': [
+            {
+                'name': 'since',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Epoch milliseconds, or the next value of the previous response (0 or omitted for everything)'
+            },
+            {
+                'name': 'limit',
+                'in': 'query',
+                'required': False,
+                'type': 'integer',
+                'description': 'Maximum changes per response, 1 to 5000 (default 1000)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Deleted ids and changed bosses; apply deleted first, then changed'},
+            400: {'description': 'Invalid since or limit'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_changes(self):
+        # Get only the bosses changed or deleted since the given time
+        try:
+            limit = request.args.get('limit', '1000')
+            if not limit.isdigit() or not 1 <= int(limit) <= 5000:
+                return jsonify({'error': 'Invalid data: limit must be between 1 and 5000'}), 400
+            try:
+                since = parse_cursor(request.args.get('since', '0'))  # Epoch milliseconds or the cursor of the last page
+            except ValueError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400
+
+            changes = self.boss_service.get_changes(since, int(limit))
+            return jsonify(changes), 200  # Return the changes as JSON
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the boss changes: {e}')
+            return jsonify({'error': f'Error fetching the boss changes: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Counts of the bosses per challenge rating (with tiers) and type',
+        'parameters': [
+            {
+                'name': 'If-None-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; answered with 304 while the bosses are unchanged'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Total and counts per value, most common first, with the version in the ETag header'},
+            304: {'description': 'The bosses did not change since the given ETag'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_stats(self):
+        # Get the dashboard counts, aggregated in the database and cached until the bosses change
+        try:
+            stats = self.boss_service.get_stats()
+            if isinstance(stats, tuple):
+                return stats  # Error response from the service
+
+            etag = f'"{stats["version"]}"'
+            if etag in request.headers.get('If-None-Match', ''):
+                return '', 304, {'ETag': etag}  # The client's copy is still current
+            response = jsonify(stats)
+            response.headers['ETag'] = etag
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error computing the boss stats: {e}')
+            return jsonify({'error': f'Error computing the boss stats: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Run a long operation in the background',
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'type': {'type': 'string', 'description': 'Job type: reindex, export or import'},
+                        'params': {'type': 'object', 'description': 'Parameters of the job; export and import take path (a file name in ARCHIVE_DIR), format and, for import, mode'}
+                    },
+                    'required': ['type']
+                }
+            }
+        ],
+        'responses': {
+            202: {'description': 'Job queued; poll the URL in the Location header for its status'},
+            400: {'description': 'Unknown job type or invalid params'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def submit_job(self):
+        # Queue a job for the workers instead of running it inside the request
+        try:
+            request_data = request.json or {}
+            params = request_data.get('params', {})
+            if not isinstance(request_data.get('type'), str) or not isinstance(params, dict):
+                return jsonify({'error': 'Invalid data: type must be a string and params an object'}), 400
+
+            job = self.boss_service.submit_job(request_data['type'], params)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            response = jsonify({'_id': job['_id'], 'type': job['type'], 'status': job['status']})
+            response.headers['Location'] = f'/api/v1/bosses/jobs/{job["_id"]}'
+            return response, 202
+
+        except Exception as e:
+            self.logger.error(f'Error submitting the boss job: {e}')
+            return jsonify({'error': f'Error submitting the boss job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Status of a background job',
+        'parameters': [
+            {
+                'name': 'job_id',
+                'in': 'path',
+                'required': True,
+                'type': 'string',
+                'description': 'ID returned when the job was submitted'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Status (queued, running, succeeded or failed), attempts, progress, result and last error'},
+            404: {'description': 'Job not found'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_job(self, job_id):
+        # Get the status and progress of a job
+        try:
+            job = self.boss_service.get_job(job_id)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            if not job:
+                return jsonify({'error': 'Job not found'}), 404
+            return jsonify(job), 200
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the boss job: {e}')
+            return jsonify({'error': f'Error fetching the boss job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Download every boss as a compressed archive',
+        'produces': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Gzip stream of a header record followed by the bosses, sent as it is read'},
+            400: {'description': 'Unknown format'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def export_bosses(self):
+        # Stream the archive so neither side holds the whole collection in memory
+        try:
+            archive_format = request.args.get('format', 'bson')
+            chunks = self.boss_service.export_archive(archive_format)
+            if isinstance(chunks, tuple):
+                return chunks  # Error response from the service
+            return Response(chunks, mimetype='application/gzip', headers={
+                'Content-Disposition': f'attachment; filename="bosses.{archive_format}.gz"',
+            })
+
+        except Exception as e:
+            self.logger.error(f'Error exporting the bosses: {e}')
+            return jsonify({'error': f'Error exporting the bosses: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Bosses'],
+        'summary': 'Load bosses from a compressed archive',
+        'consumes': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            },
+            {
+                'name': 'mode',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['upsert', 'insert'],
+                'description': 'upsert replaces bosses with the same ID (default); insert is faster but fails on existing IDs'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {'type': 'string', 'format': 'binary'},
+                'description': 'Archive as written by the export endpoint'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Number of bosses imported'},
+            400: {'description': 'Unknown format or mode, or not a bosses archive'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def import_bosses(self):
+        # Import the archive in batches while the body is still arriving; larger files go through an import job
+        try:
+            result = self.boss_service.import_archive(
+                request.stream, request.args.get('format', 'bson'), request.args.get('mode', 'upsert'),
+            )
+            if isinstance(result, tuple):
+                return result  # Error response from the service
+            return jsonify(result), 200
+
+        except Exception as e:
+            self.logger.error(f'Error importing the bosses: {e}')
+            return jsonify({'error': f'Error importing the bosses: {e}'}), 500  # Handle any errors
+
     def healthcheck(self):
         # Health check to verify the server is up
         return jsonify({'status': 'up'}), 200
@@ -1,4 +1,8 @@
 from marshmallow import fields, validates, ValidationError
+import re
+
+# Largest party an encounter is priced for; bigger parties only widen the XP budget the suggestion search walks
+MAX_PARTY_SIZE = 10
 
 # This boss defines the fields we need to validate
 class BossSchema:
@@ -74,6 +78,46 @@ class BossSchema:
     #     if len(value) > 256:
     #         raise ValidationError('Extra must be at max 256 characters long')
 
+# This schema validates the requests sent to the encounter calculator
+class EncounterSchema:
+    partyLevels = fields.List(fields.Integer(), required=False)  # Levels of the party members
+    characterIds = fields.List(fields.Integer(), required=False)  # Characters whose levels make up the party
+    bossIds = fields.List(fields.Integer(), required=True)  # Bosses the party will face
+    difficulty = fields.String(required=False)  # Target difficulty when suggesting bosses
+
+    @validates('partyLevels')
+    def validate_partyLevels(self, value):
+        # Check that there is at least one party member
+        if not value or not isinstance(value, list):
+            raise ValidationError('At least one party level is required.')
+        # Check that every level is a whole number between 1 and 20
+        if any(not isinstance(level, int) or isinstance(level, bool) or not 1 <= level <= 20 for level in value):
+            raise ValidationError('Party levels must be whole numbers between 1 and 20.')
+        if len(value) > MAX_PARTY_SIZE:
+            raise ValidationError(f'A party has at most {MAX_PARTY_SIZE} members.')
+
+    @validates('characterIds')
+    def validate_characterIds(self, value):
+        # Check that the character ids are a list of integers
+        if not isinstance(value, list) or any(not isinstance(item, int) or isinstance(item, bool) for item in value):
+            raise ValidationError('Character ids must be a list of integers.')
+        if len(value) > MAX_PARTY_SIZE:
+            raise ValidationError(f'A party has at most {MAX_PARTY_SIZE} members.')
+
+    @validates('bossIds')
+    def validate_bossIds(self, value):
+        # Check that at least one boss is part of the encounter
+        if not value or not isinstance(value, list):
+            raise ValidationError('At least one boss id is required.')
+        if any(not isinstance(item, int) or isinstance(item, bool) for item in value):
+            raise ValidationError('Boss ids must be a list of integers.')
+
+    @validates('difficulty')
+    def validate_difficulty(self, value):
+        # Check that the difficulty is one of the encounter thresholds
+        if value not in ['easy', 'medium', 'hard', 'deadly']:
+            raise ValidationError('Difficulty must be one of the following: easy, medium, hard, deadly.')
+
 # Main part of the code that runs when the script is executed
 if __name__ == '__main__':
     from logger.logger_base import Logger  # Import the custom logger to handle errors
@@ -0,0 +1,151 @@
+from fractions import Fraction
+
+# Experience points by challenge rating (Dungeon Master's Guide, "Creating Combat Encounters")
+CR_XP = {
+    0: 10, 0.125: 25, 0.25: 50, 0.5: 100,
+    1: 200, 2: 450, 3: 700, 4: 1100, 5: 1800, 6: 2300, 7: 2900, 8: 3900, 9: 5000, 10: 5900,
+    11: 7200, 12: 8400, 13: 10000, 14: 11500, 15: 13000, 16: 15000, 17: 18000, 18: 20000, 19: 22000, 20: 25000,
+    21: 33000, 22: 41000, 23: 50000, 24: 62000, 25: 75000, 26: 90000, 27: 105000, 28: 120000, 29: 135000, 30: 155000,
+}
+
+DIFFICULTIES = ('easy', 'medium', 'hard', 'deadly')
+
+# XP thresholds per character level, in the same order as DIFFICULTIES
+LEVEL_THRESHOLDS = {
+    1: (25, 50, 75, 100), 2: (50, 100, 150, 200), 3: (75, 150, 225, 400), 4: (125, 250, 375, 500),
+    5: (250, 500, 750, 1100), 6: (300, 600, 900, 1400), 7: (350, 750, 1100, 1700), 8: (450, 900, 1400, 2100),
+    9: (550, 1100, 1600, 2400), 10: (600, 1200, 1900, 2800), 11: (800, 1600, 2400, 3600), 12: (1000, 2000, 3000, 4500),
+    13: (1100, 2200, 3400, 5100), 14: (1250, 2500, 3800, 5700), 15: (1400, 2800, 4300, 6400), 16: (1600, 3200, 4800, 7200),
+    17: (2000, 3900, 5900, 8800), 18: (2100, 4200, 6300, 9500), 19: (2400, 4900, 7300, 10900), 20: (2800, 5700, 8500, 12700),
+}
+
+# Encounter multipliers, indexed by monster-count bracket (shifted for very small or very large parties)
+MULTIPLIERS = (0.5, 1, 1.5, 2, 2.5, 3, 4, 5)
+
+# Challenge ratings sorted from highest to lowest, used by the suggestion search
+CR_VALUES_DESC = tuple(sorted(CR_XP, reverse=True))
+
+# Challenge rating tiers the stats endpoint groups bosses in: (label, lowest CR, highest CR)
+CR_TIERS = (('0-4', 0, 4), ('5-10', 5, 10), ('11-16', 11, 16), ('17+', 17, 30))
+
+# Upper bound for "deadly" suggestions, which have no next threshold
+DEADLY_CEILING = 1.5
+
+
+def parse_cr(value):
+    # Convert a challenge rating string such as "5", "1/2" or "0.25" into a number, or None if invalid
+    try:
+        cr = float(Fraction(str(value).strip()))
+    except (ValueError, ZeroDivisionError):
+        return None
+    cr = int(cr) if cr.is_integer() else cr
+    return cr if cr in CR_XP else None
+
+
+def party_thresholds(levels):
+    # Sum the per-level thresholds for the whole party
+    totals = [0, 0, 0, 0]
+    for level in levels:
+        for index, threshold in enumerate(LEVEL_THRESHOLDS[min(max(level, 1), 20)]):
+            totals[index] += threshold
+    return dict(zip(DIFFICULTIES, totals))
+
+
+def encounter_multiplier(monster_count, party_size):
+    # Pick the multiplier bracket for the number of monsters, then adjust it for the party size
+    if monster_count <= 0:
+        return 0
+    if monster_count == 1:
+        bracket = 1
+    elif monster_count == 2:
+        bracket = 2
+    elif monster_count <= 6:
+        bracket = 3
+    elif monster_count <= 10:
+        bracket = 4
+    elif monster_count <= 14:
+        bracket = 5
+    else:
+        bracket = 6
+
+    if party_size < 3:
+        bracket += 1
+    elif party_size >= 6:
+        bracket -= 1
+    return MULTIPLIERS[bracket]
+
+
+def rate_encounter(adjusted_xp, thresholds):
+    # Return the hardest difficulty whose threshold the adjusted XP reaches
+    difficulty = 'trivial'
+    for name in DIFFICULTIES:
+        if adjusted_xp >= thresholds[name]:
+            difficulty = name
+    return difficulty
+
+
+def evaluate_encounter(levels, crs):
+    # Compute the XP budget and difficulty for a party facing monsters with the given challenge ratings
+    thresholds = party_thresholds(levels)
+    base_xp = sum(CR_XP[cr] for cr in crs)
+    multiplier = encounter_multiplier(len(crs), len(levels))
+    adjusted_xp = base_xp * multiplier
+    return {
+        'thresholds': thresholds,
+        'baseXp': base_xp,
+        'multiplier': multiplier,
+        'adjustedXp': adjusted_xp,
+        'difficulty': rate_encounter(adjusted_xp, thresholds),
+    }
+
+
+def difficulty_window(thresholds, difficulty):
+    # Adjusted XP range [low, high) that rates as the requested difficulty
+    index = DIFFICULTIES.index(difficulty)
+    low = thresholds[difficulty]
+    if index + 1 < len(DIFFICULTIES):
+        high = thresholds[DIFFICULTIES[index + 1]]
+    else:
+        high = thresholds['deadly'] * DEADLY_CEILING
+    return low, high
+
+
+def search_cr_combinations(available, party_size, low, high, max_monsters, limit):
+    # Find challenge rating multisets whose adjusted XP falls in [low, high), stopping at the first limit found
+    # available maps each CR present in the collection to how many bosses have it
+    crs = [cr for cr in CR_VALUES_DESC if available.get(cr)]
+    target = (low + high) / 2
+    found = []
+
+    def search(start, chosen, base_xp):
+        # Returns True once enough combinations were found, which ends the whole search
+        count = len(chosen)
+        if count:
+            adjusted = base_xp * encounter_multiplier(count, party_size)
+            if adjusted >= high:
+                return False  # Adding monsters never lowers the adjusted XP
+            if adjusted >= low:
+                found.append((abs(adjusted - target), tuple(chosen), adjusted))
+                if len(found) >= limit:
+                    return True
+        if count == max_monsters:
+            return False
+        for index in range(start, len(crs)):
+            cr = crs[index]
+            if chosen.count(cr) >= available[cr]:
+                continue  # Not enough distinct bosses with this rating
+            # Stop early when even filling every slot with this CR can't reach the budget
+            remaining = max_monsters - count
+            best = (base_xp + CR_XP[cr] * remaining) * encounter_multiplier(max_monsters, party_size)
+            if best < low:
+                break  # CRs are sorted high to low, so later ones can't reach it either
+            chosen.append(cr)
+            done = search(index, chosen, base_xp + CR_XP[cr])
+            chosen.pop()
+            if done:
+                return True
+        return False
+
+    search(0, [], 0)
+    found.sort(key=lambda item: (item[0], len(item[1])))  # Closest to the middle of the window first
+    return [(combination, adjusted) for _, combination, adjusted in found]
@@ -1,17 +1,64 @@
 # Import necessary modules
 from flask import jsonify
 from logger.logger_base import Logger
+from services.change_feed import ChangeFeed
+from services.archive import export_archive, import_archive, archive_path
+from services.delta_sync import now_ms, ensure_sync_indexes, record_tombstone, get_changes
+from services.jobs import JobQueue
+from services.stats import StatsCache, count_by, facet_counts
+from services.write_behind import WriteBehindQueue
+from schemas.tags import parse_tags, tags_query
+from services.encounter import (
+    CR_XP, CR_TIERS, evaluate_encounter, difficulty_window, search_cr_combinations, party_thresholds, encounter_multiplier, parse_cr,
+)
 
 class BossService:
     def __init__(self, db_conn):
         # Set up logging and database connection
         self.logger = Logger()  # Logger for logging messages
         self.db_conn = db_conn  # Database connection
+        self.repository = db_conn.repository('bosses')  # Storage of the bosses
+        self.tombstones = db_conn.repository('tombstones')  # Deletion records used by delta sync
+        self.characters = db_conn.foreign('characters', 'Encounters with characterIds')  # Party members, read for their levels
+        self.change_feed = ChangeFeed(self.repository, self.tombstones, 'bosses')  # Pushes collection changes to event stream clients
+        self.stats = StatsCache(self.repository, self.compute_stats)  # Dashboard stats, recomputed after writes
+        self.counters = db_conn.repository('counters')  # Id counters for the write-behind queue
+        # Batches inserts in a background thread when WRITE_BEHIND is set, otherwise None
+        self.write_behind = WriteBehindQueue.from_environment(self.repository, self.counters, 'bosses')
+        # Long operations run off the request path; JOB_WORKERS threads or `python -m services.jobs` run them
+        self.jobs = JobQueue.from_environment(db_conn, 'bosses', {
+            'reindex': self.reindex_job,
+            'export': self.export_job,
+            'import': self.import_job,
+        })
 
-    def get_all_bosses(self):
+    def ensure_indexes(self):
         try:
-            # Fetch all bosses from the database and return them as a list
-            bosses = list(self.db_conn.db.bosses.find())
+            # Numeric challenge rating used for range queries by the encounter suggestions
+            self.repository.create_index('crValue')
+            # Multikey indexes for the ?immune= and ?resist= filters
+            self.repository.create_index('immunityTags')
+            self.repository.create_index('resistanceTags')
+            # updatedAt and tombstone indexes used by delta sync
+            ensure_sync_indexes(self.repository, self.tombstones)
+            self.jobs.ensure_indexes()  # Job claims and the cleanup of finished jobs
+            # Backfill bosses stored before crValue was set on write
+            for boss in self.repository.find({'crValue': {'$exists': False}}, {'cr': 1}):
+                self.repository.update_one({'_id': boss['_id']}, {'$set': {'crValue': parse_cr(boss.get('cr'))}})
+            # Backfill bosses stored before the resistance and immunity tags were set on write
+            for boss in self.repository.find({'immunityTags': {'$exists': False}}, {'resistances': 1, 'immunities': 1}):
+                self.repository.update_one({'_id': boss['_id']}, {'$set': {
+                    'resistanceTags': parse_tags(boss.get('resistances')),
+                    'immunityTags': parse_tags(boss.get('immunities')),
+                }})
+        except Exception as e:
+            # Indexes only speed things up, so log and keep serving
+            self.logger.error(f'Error creating the boss indexes: {e}')
+
+    def get_all_bosses(self, required_tags=None):
+        try:
+            # Fetch all bosses from the database, or only those with every required tag, and return them as a list
+            bosses = list(self.repository.find(tags_query(required_tags or {})))
             return bosses
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -20,11 +67,20 @@ class BossService:
 
     def add_boss(self, new_boss):
         try:
-            # Find the boss with the highest ID and set the new boss ID to be the next one
-            max_boss = self.db_conn.db.bosses.find_one(sort=[('_id', -1)])
-            next_id = max_boss['_id'] + 1 if max_boss else 1
+            if self.write_behind:
+                # Reserve the ID and queue the insert; the background thread writes it with others in one batch
+                new_boss['_id'] = self.write_behind.allocate_id()
+                new_boss['updatedAt'] = now_ms()  # Change time used by delta sync
+                self.write_behind.enqueue(new_boss)
+                self.stats.invalidate()  # The cached stats are out of date
+                return new_boss
+
+            # The new boss ID is the highest ID in the collection plus one
+            next_id = self.repository.next_id()
             new_boss['_id'] = next_id  # Assign new ID to the boss
-            self.db_conn.db.bosses.insert_one(new_boss)  # Add the new boss to the database
+            new_boss['updatedAt'] = now_ms()  # Change time used by delta sync
+            self.repository.insert_one(new_boss)  # Add the new boss to the database
+            self.stats.invalidate()  # The cached stats are out of date
             return new_boss  # Return the newly added boss
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -33,8 +89,10 @@ class BossService:
 
     def get_boss_by_id(self, boss_id):
         try:
+            if self.write_behind:
+                self.write_behind.wait_for(boss_id)  # Write it first if it is still queued
             # Fetch a specific boss by its ID from the database
-            boss_data = self.db_conn.db.bosses.find_one({'_id': boss_id})
+            boss_data = self.repository.find_one({'_id': boss_id})
             return boss_data  # Return the boss data
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -48,8 +106,10 @@ class BossService:
 
             if update_boss:
                 # If the boss exists, update it with the new data
-                updated_boss = self.db_conn.db.bosses.update_one({'_id': boss_id}, {'$set': boss_data})
-                if updated_boss.modified_count > 0:
+                boss_data['updatedAt'] = now_ms()  # Change time used by delta sync
+                updated_boss = self.repository.update_one({'_id': boss_id}, {'$set': boss_data})
+                self.stats.invalidate()  # The cached stats are out of date
+                if updated_boss > 0:
                     return updated_boss  # Return the updated boss
                 else:
                     return 'The boss is already up-to-date'  # No changes made
@@ -61,6 +121,30 @@ class BossService:
             self.logger.error(f'Error updating the boss: {e}')
             return jsonify({'error': f'Error updating the boss: {e}'}), 500
         
+    def patch_boss(self, boss_id, changes, expected_version=None):
+        try:
+            if self.write_behind:
+                self.write_behind.wait_for(boss_id)  # Write it first if it is still queued
+            # Only match the version the client saw, when it sent one
+            query = {'_id': boss_id}
+            if expected_version is not None:
+                query['updatedAt'] = expected_version
+
+            changes['updatedAt'] = now_ms()  # Change time used by delta sync, also the new version
+            # Set only the changed fields and read back just those, in a single round-trip
+            patched_boss = self.repository.find_one_and_update(query, {'$set': changes}, projection=list(changes))
+            self.stats.invalidate()  # The cached stats are out of date
+            if patched_boss:
+                return patched_boss  # Return the changed fields
+            if expected_version is not None and self.repository.count({'_id': boss_id}, limit=1):
+                return False  # The boss exists but has a newer version
+            return None  # Boss not found
+
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error patching the boss: {e}')
+            return jsonify({'error': f'Error patching the boss: {e}'}), 500
+
     def delete_boss(self, boss_id):
         try:
             # Check if the boss exists before deleting
@@ -68,7 +152,9 @@ class BossService:
             
             if deleted_boss:
                 # If the boss exists, delete it from the database
-                self.db_conn.db.bosses.delete_one({'_id': boss_id})
+                self.repository.delete_one({'_id': boss_id})
+                self.stats.invalidate()  # The cached stats are out of date
+                record_tombstone(self.tombstones, 'bosses', boss_id)  # Let offline clients sync the deletion
                 return deleted_boss  # Return the deleted boss data
             else:
                 return None  # boss not found
@@ -78,6 +164,187 @@ class BossService:
             self.logger.error(f'Error deleting the boss data: {e}')
             return jsonify({'error': f'Error deleting the boss data: {e}'}), 500
 
+    def get_party_levels(self, character_ids):
+        # Read the levels of the given characters from the shared database
+        characters = self.characters.find({'_id': {'$in': character_ids}}, {'level': 1})
+        return [int(character['level']) for character in characters if str(character.get('level', '')).isdigit()]
+
+    def evaluate_encounter(self, party_levels, boss_ids):
+        try:
+            # Only the challenge rating is needed to price the encounter
+            found = {boss['_id']: boss for boss in self.repository.find({'_id': {'$in': boss_ids}}, {'named': 1, 'cr': 1, 'crValue': 1})}
+            missing = set(boss_ids) - set(found)
+            if missing:
+                return {'error': f'Bosses not found: {sorted(missing)}'}
+
+            # $in reads each boss once, but a boss listed twice (e.g. two of the same monster) counts twice
+            bosses = [found[boss_id] for boss_id in boss_ids]
+            crs = []
+            for boss in bosses:
+                cr = boss.get('crValue', parse_cr(boss.get('cr')))
+                if cr is None:
+                    return {'error': f'Boss {boss["_id"]} has an invalid challenge rating: {boss.get("cr")}'}
+                crs.append(cr)
+
+            result = evaluate_encounter(party_levels, crs)
+            result['partyLevels'] = party_levels
+            result['bosses'] = bosses
+            return result
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error evaluating the encounter: {e}')
+            return jsonify({'error': f'Error evaluating the encounter: {e}'}), 500
+
+    def suggest_bosses(self, party_levels, difficulty, max_bosses, limit):
+        try:
+            thresholds = party_thresholds(party_levels)
+            low, high = difficulty_window(thresholds, difficulty)
+
+            # A single boss has the lowest multiplier, so no boss worth more than this can fit the budget
+            max_single_xp = high / encounter_multiplier(1, len(party_levels))
+            max_cr = max((cr for cr, xp in CR_XP.items() if xp < max_single_xp), default=None)
+            if max_cr is None:
+                available = {}
+            else:
+                # Count bosses per challenge rating with a range scan on the crValue index
+                available = {
+                    group['_id']: group['count']
+                    for group in self.repository.aggregate([
+                        {'$match': {'crValue': {'$gte': 0, '$lte': max_cr}}},
+                        {'$group': {'_id': '$crValue', 'count': {'$sum': 1}}},
+                    ])
+                }
+            combinations = search_cr_combinations(available, len(party_levels), low, high, max_bosses, limit)
+
+            suggestions = []
+            for combination, adjusted_xp in combinations:
+                bosses = []
+                for cr in sorted(set(combination), reverse=True):
+                    # Fetch just as many bosses as the combination needs at this rating
+                    bosses.extend(self.repository.find(
+                        {'crValue': cr}, {'named': 1, 'typed': 1, 'cr': 1}, limit=combination.count(cr)
+                    ))
+                suggestions.append({'bosses': bosses, 'adjustedXp': adjusted_xp})
+
+            return {
+                'partyLevels': party_levels,
+                'difficulty': difficulty,
+                'thresholds': thresholds,
+                'budget': {'min': low, 'max': high},
+                'suggestions': suggestions,
+            }
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error suggesting bosses: {e}')
+            return jsonify({'error': f'Error suggesting bosses: {e}'}), 500
+
+    def compute_stats(self):
+        # Bosses per challenge rating and per type, plus the tier buckets the dashboard groups the ratings in
+        stats = facet_counts(self.repository, {'byCr': count_by('$crValue'), 'byType': count_by('$typed')})
+        stats['byCr'].sort(key=lambda row: (row['value'] is None, row['value'] or 0))
+        tiers = {label: 0 for label, _, _ in CR_TIERS}
+        for row in stats['byCr']:
+            for label, low, high in CR_TIERS:
+                if row['value'] is not None and low <= row['value'] <= high:
+                    tiers[label] += row['count']
+        stats['byCrTier'] = [{'value': label, 'count': count} for label, count in tiers.items()]
+        return stats
+
+    def get_stats(self):
+        try:
+            # Cached aggregated stats with their version, recomputed only when the bosses changed
+            return self.stats.get()
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing the boss stats: {e}')
+            return jsonify({'error': f'Error computing the boss stats: {e}'}), 500
+
+    def submit_job(self, job_type, params):
+        try:
+            # Queue a background job; the response only carries its id and status
+            return self.jobs.submit(job_type, params)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown job type
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error submitting the boss job: {e}')
+            return jsonify({'error': f'Error submitting the boss job: {e}'}), 500
+
+    def get_job(self, job_id):
+        try:
+            # Fetch a job of this service with its status, progress and result
+            return self.jobs.get(job_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the boss job: {e}')
+            return jsonify({'error': f'Error fetching the boss job: {e}'}), 500
+
+    def reindex_job(self, context, params):
+        # Job handler: create the indexes and run the backfills again, e.g. after restoring a dump
+        self.ensure_indexes()
+        return {'indexes': sorted(self.repository.index_names())}
+
+    def export_archive(self, archive_format):
+        try:
+            if self.write_behind:
+                self.write_behind.flush()  # Queued inserts belong in the archive
+            # Compressed archive of every boss, produced chunk by chunk while the response is sent
+            return export_archive(self.repository, 'bosses', archive_format)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error exporting the bosses: {e}')
+            return jsonify({'error': f'Error exporting the bosses: {e}'}), 500
+
+    def import_archive(self, stream, archive_format, mode):
+        try:
+            # Import an archive read from the request body as it arrives
+            return self.load_archive(stream, archive_format, mode)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format or mode, or not a bosses archive
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error importing the bosses: {e}')
+            return jsonify({'error': f'Error importing the bosses: {e}'}), 500
+
+    def load_archive(self, stream, archive_format, mode, progress=None):
+        # Import an archive, then bring what is derived from the bosses up to date
+        counts = import_archive(stream, self.repository, 'bosses', archive_format, mode, progress=progress)
+        self.ensure_indexes()  # Backfills the derived fields of bosses from older archives
+        if self.write_behind:
+            self.write_behind.reseed()  # Ids handed out next must come after the imported ones
+        self.stats.invalidate()
+        return counts
+
+    def export_job(self, context, params):
+        # Job handler: write an archive into ARCHIVE_DIR
+        archive_format = params.get('format', 'bson')
+        with open(archive_path(params.get('path')), 'wb') as archive:
+            for chunk in export_archive(self.repository, 'bosses', archive_format):
+                archive.write(chunk)
+            return {'path': archive.name, 'format': archive_format, 'bytes': archive.tell()}
+
+    def import_job(self, context, params):
+        # Job handler: import an archive from ARCHIVE_DIR, for archives too large to send in one request
+        with open(archive_path(params.get('path')), 'rb') as archive:
+            return self.load_archive(archive, params.get('format', 'bson'), params.get('mode', 'upsert'), progress=context.progress)
+
+    def get_changes(self, since, limit):
+        try:
+            # Fetch only the bosses changed or deleted since the client's last sync
+            return get_changes(self.repository, self.tombstones, 'bosses', since, limit)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the boss changes: {e}')
+            return jsonify({'error': f'Error fetching the boss changes: {e}'}), 500
+
+    def close(self):
+        # Flush queued inserts; called on shutdown before the database connection is closed
+        if self.write_behind:
+            self.write_behind.close()
+
+
 # Main block of code for testing the BossService
 if __name__ == '__main__':
     from models.models import BossModel
@@ -0,0 +1,278 @@
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+
+from flask import g, request
+from flask.json.provider import DefaultJSONProvider
+from pymongo import monitoring
+from logger.logger_base import Logger
+
+# W3C trace context header: version-traceid-parentid-flags
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+current_span = contextvars.ContextVar('current_span', default=None)  # Innermost open span of this request
+tracer = None  # Set by init_tracing when TRACING is on
+
+
+class Span:
+    # One timed operation; serialized in the OTLP JSON span format
+    def __init__(self, name, trace_id, parent_id=None, kind=1, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind  # OTLP SpanKind: 1 internal, 2 server, 3 client
+        self.attributes = attributes or {}
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def finish(self, error=None):
+        self.end = time.time_ns()
+        self.error = error
+        tracer.exporter.export(self)
+
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [{'key': key, 'value': otlp_value(value)} for key, value in self.attributes.items()],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class SpanExporter:
+    # Collects finished spans and writes them in batches from a background thread
+    def __init__(self, service_name, batch_size=256, interval=1.0):
+        self.logger = Logger()  # Logger for logging messages
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.interval = interval  # Seconds between flushes
+        self.queue = queue.Queue(maxsize=10000)  # Spans are dropped, never blocking requests, when it is full
+        self.thread = threading.Thread(target=self.run, name='span-exporter', daemon=True)
+        self.thread.start()
+
+    def export(self, span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.logger.warning(f'Dropped {len(batch)} spans: {e}')
+
+    def payload(self, spans):
+        # OTLP/HTTP JSON request body
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{'scope': {'name': 'dnd-tracing'}, 'spans': [span.to_otlp() for span in spans]}],
+        }]}
+
+    def write(self, spans):
+        raise NotImplementedError
+
+
+class FileSpanExporter(SpanExporter):
+    # One OTLP JSON request body per line, readable by the stand-in collector and most OTLP tools
+    def __init__(self, service_name, path):
+        self.path = path
+        super().__init__(service_name)
+
+    def write(self, spans):
+        with open(self.path, 'a') as trace_file:
+            trace_file.write(json.dumps(self.payload(spans)) + '\n')
+
+
+class OtlpSpanExporter(SpanExporter):
+    # POSTs OTLP/HTTP JSON to a collector, e.g. http://localhost:4318/v1/traces
+    def __init__(self, service_name, endpoint):
+        self.endpoint = endpoint
+        super().__init__(service_name)
+
+    def write(self, spans):
+        body = json.dumps(self.payload(spans)).encode()
+        post = urllib.request.Request(self.endpoint, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(post, timeout=5):
+            pass
+
+
+class Tracer:
+    def __init__(self, exporter, sample_rate=1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate  # Fraction of new traces recorded; incoming sampled traces are always kept
+
+    def start_span(self, name, kind=1, attributes=None):
+        # Child of the current span; None outside a traced request
+        parent = current_span.get()
+        if parent is None:
+            return None
+        return Span(name, parent.trace_id, parent.span_id, kind, attributes)
+
+
+class MongoCommandTracer(monitoring.CommandListener):
+    # One client span per command the driver sends, including getMore for long cursors
+    def __init__(self):
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        command = event.command
+        attributes = {'db.system': 'mongodb', 'db.name': event.database_name, 'db.operation': event.command_name}
+        collection = command.get(event.command_name)
+        if isinstance(collection, str):
+            attributes['db.mongodb.collection'] = collection
+        if isinstance(command.get('filter'), dict):
+            attributes['db.mongodb.filter_keys'] = ','.join(sorted(command['filter']))  # Shape only, never values
+        span = tracer.start_span(f'mongodb.{event.command_name}', kind=3, attributes=attributes)
+        if span:
+            with self.lock:
+                self.spans[(event.connection_id, event.request_id)] = span
+
+    def succeeded(self, event):
+        with self.lock:
+            span = self.spans.pop((event.connection_id, event.request_id), None)
+        if span:
+            span.finish()
+
+    def failed(self, event):
+        with self.lock:
+            span = self.spans.pop((event.connection_id, event.request_id), None)
+        if span:
+            span.finish(error=str(event.failure))
+
+
+class TracedJSONProvider(DefaultJSONProvider):
+    # jsonify with a serialization span
+    def dumps(self, obj, **kwargs):
+        span = tracer.start_span('serialize')
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            if span:
+                span.finish()
+
+
+def init_tracing(app, service_name):
+    # Opt-in: TRACING=1, exporting to TRACE_EXPORT (file:<path> or otlp:<url>), sampling TRACING_SAMPLE of new traces
+    # Call before connecting to the database so the Mongo command listener is registered first
+    global tracer
+    if os.environ.get('TRACING', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    target = os.environ.get('TRACE_EXPORT', f'file:{service_name}_traces.jsonl')
+    kind, _, location = target.partition(':')
+    exporter = OtlpSpanExporter(service_name, location) if kind == 'otlp' else FileSpanExporter(service_name, location)
+    tracer = Tracer(exporter, float(os.environ.get('TRACING_SAMPLE', 1.0)))
+
+    monitoring.register(MongoCommandTracer())
+    app.json = TracedJSONProvider(app)
+    app.before_request(start_request_span)
+    app.after_request(add_trace_header)
+    app.teardown_request(finish_request_span)
+    return tracer
+
+
+def start_request_span():
+    # Continue the caller's trace from its traceparent header, or start a new one
+    match = TRACEPARENT.match(request.headers.get('traceparent', ''))
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        if not int(flags, 16) & 1:
+            return  # The caller decided not to sample this trace
+    else:
+        if random.random() >= tracer.sample_rate:
+            return
+        trace_id, parent_id = os.urandom(16).hex(), None
+    span = Span(f'{request.method} {request.url_rule.rule if request.url_rule else request.path}', trace_id, parent_id, kind=2,
+                attributes={'http.method': request.method, 'http.target': request.path})
+    g.trace_span = span
+    g.trace_token = current_span.set(span)
+
+
+def add_trace_header(response):
+    # Tell the caller which trace and span this request belongs to; the services share the database instead of
+    # calling each other, so the trace is carried on only by a caller that forwards this header
+    span = g.get('trace_span')
+    if span:
+        span.attributes['http.status_code'] = response.status_code
+        response.headers['traceparent'] = span.traceparent()
+    return response
+
+
+def finish_request_span(exception=None):
+    span = g.pop('trace_span', None)
+    if span:
+        current_span.reset(g.pop('trace_token'))
+        span.finish(error=str(exception) if exception else None)
+
+
+def traced(target, prefix=None):
+    # Wrap an object so every public method call becomes a span (services, schemas); a no-op when tracing is off
+    if tracer is None:
+        return target
+    return TracedProxy(target, prefix or type(target).__name__)
+
+
+class TracedProxy:
+    def __init__(self, target, prefix):
+        self._target = target
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name.startswith('_') or not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def call(*args, **kwargs):
+            span = tracer.start_span(f'{self._prefix}.{name}')
+            if span is None:
+                return value(*args, **kwargs)
+            token = current_span.set(span)
+            try:
+                result = value(*args, **kwargs)
+            except Exception as e:
+                current_span.reset(token)
+                span.finish(error=str(e))
+                raise
+            current_span.reset(token)
+            span.finish()
+            return result
+        return call
@@ -1,6 +1,10 @@
 import os  # Import the os module to access environment variables
 from logger.logger_base import Logger  # Import the custom Logger class
 from pymongo import MongoClient  # Import MongoClient to interact with MongoDB
+from models.repository import MongoRepository  # Repository over a MongoDB collection
+from models.memory_engine import MemoryDatabase, MemoryRepository  # In-process storage engine
+from models.query_profiler import QueryProfiler  # Slow-query log for every storage operation
+from models.tenancy import SHARED_COLLECTIONS, TenantDatabases, TenantRepository  # Tenant isolation
 
 class CampaignModel:  # Class CampaignModel
     def __init__(self):
@@ -8,8 +12,39 @@ class CampaignModel:  # Class CampaignModel
         self.client = None
         self.db = None
         self.logger = Logger()  # Initialize the Logger instance
+        # Storage engine: 'mongo' (default) or 'memory' for single-node deployments without a MongoDB server
+        # The memory engine lives inside the process, so it runs with a single gunicorn worker (WEB_CONCURRENCY=1)
+        # and can't share collections with the other services: see foreign()
+        self.backend = os.environ.get('STORAGE_BACKEND', 'mongo').lower()
+        self.collection_name = 'campaigns'  # Collection this service owns
+        self.isolated = set()  # Features already reported as reading another service's collection on the memory engine
+        self.profiler = QueryProfiler.from_environment()  # Times the operations of every repository (SLOW_QUERY_*)
+        # Tenant isolation: 'off' (default), 'field' (tenants share collections, told apart by a field) or
+        # 'database' (one database per tenant, MongoDB only)
+        self.tenancy = os.environ.get('TENANCY', 'off').lower()
+        self.default_tenant = os.environ.get('TENANT_DEFAULT', 'default')  # Owner of the data from before tenancy
+        self.tenant_field = os.environ.get('TENANT_FIELD', 'tenant')  # Field holding the tenant in field mode
+        self.tenant_databases = None  # Handles of the tenant databases in database mode
+        if self.tenancy == 'database' and self.backend == 'memory':
+            self.logger.warning('TENANCY=database needs MongoDB, the memory engine uses TENANCY=field')
+            self.tenancy = 'field'
     
     def connect_to_database(self):
+        if self.backend == 'memory':
+            # Every worker would hold its own copy of the data, so refuse to start with more than one
+            if int(os.environ.get('WEB_CONCURRENCY', 1)) > 1:
+                self.logger.critical('The in-memory storage engine needs a single worker')
+                raise ValueError('Set environment WEB_CONCURRENCY=1 with STORAGE_BACKEND=memory')
+            # Keep the data in this process, restored from and saved to a BSON snapshot file when one is set
+            self.db = MemoryDatabase(
+                snapshot_path=os.environ.get('STORAGE_SNAPSHOT'),  # e.g. /data/campaigns.bson
+                snapshot_interval=float(os.environ.get('STORAGE_SNAPSHOT_INTERVAL', 30)),  # Seconds between snapshots
+            )
+            self.db.load()
+            self.db.start()
+            self.logger.info('Using the in-memory storage engine')
+            return
+
         # Retrieve MongoDB credentials from environment variables
         mongodb_user = os.environ.get('MONGODB_USER')  # MongoDB username
         mongodb_pass = os.environ.get('MONGODB_PASS')  # MongoDB password
@@ -32,6 +67,9 @@ class CampaignModel:  # Class CampaignModel
                 serverSelectionTimeoutMS=5000  # Timeout for server selection
             )
             self.db = self.client['microservices']  # Connect to the 'microservices' database
+            if self.tenancy == 'database':
+                # Tenant 'guild' lives in microservices_guild; the default tenant keeps the main database
+                self.tenant_databases = TenantDatabases(self.client, 'microservices_', int(os.environ.get('TENANT_DB_CACHE', 100)))
             # Check if the database has collections to confirm connection
             if self.db.list_collection_names():
                 self.logger.info('Connected to MongoDB database successfully')  # Log successful connection
@@ -44,6 +82,48 @@ class CampaignModel:  # Class CampaignModel
         # Close the MongoDB connection if it exists
         if self.client:
             self.client.close()  # Close the client connection
+        elif isinstance(self.db, MemoryDatabase):
+            self.db.close()  # Write the final snapshot
+
+    def repository(self, collection_name):
+        # Storage for one collection, scoped to the current tenant when tenancy is on
+        if self.tenancy in ('field', 'database') and collection_name not in SHARED_COLLECTIONS:
+            return TenantRepository(self, collection_name)
+        return self.storage(collection_name)
+
+    def foreign(self, collection_name, feature):
+        # Storage for a collection another service owns (e.g. the characters a boss encounter reads)
+        # The memory engine can't reach the other service's process, so there the feature only sees the documents
+        # written through this service; that is logged once per feature at startup
+        if self.backend == 'memory' and collection_name != self.collection_name and feature not in self.isolated:
+            self.isolated.add(feature)
+            self.logger.warning(f'{feature} reads {collection_name}, which the in-memory storage engine does not share '
+                                f'with the service that owns it; use MongoDB for it to see that service\'s data')
+        return self.repository(collection_name)
+
+    def storage(self, collection_name, database=None):
+        # Unscoped storage for one collection, on whichever engine is configured (database: a tenant database)
+        if self.backend == 'memory':
+            repository = MemoryRepository(self, collection_name)
+        else:
+            repository = MongoRepository(self, collection_name, database)
+        return self.profiler.wrap(repository) if self.profiler else repository
+
+    def tenants(self, *collection_names):
+        # Tenants holding data in the collections, for maintenance that runs once per tenant ([None] without tenancy)
+        if self.tenancy == 'database':
+            return [self.default_tenant] + [name for name in self.tenant_databases.names() if name != self.default_tenant]
+        if self.tenancy == 'field':
+            found = {self.default_tenant}
+            for collection_name in collection_names:
+                found.update(tenant or self.default_tenant for tenant in self.storage(collection_name).distinct(self.tenant_field))
+            return sorted(found)
+        return [None]
+
+    def on_new_tenant(self, function):
+        # Run function as each tenant on the first use of its database in this process (e.g. to create its indexes)
+        if self.tenant_databases is not None:
+            self.tenant_databases.setup.append(function)
 
 
 if __name__ == '__main__':
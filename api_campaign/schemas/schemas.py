@@ -1,5 +1,6 @@
 from marshmallow import fields, validates, ValidationError
 import re
+from services.summaries import pc_names  # The one parser of the pc field
 
 
 # This campaign defines the fields we need to validate
@@ -13,6 +14,9 @@ class CampaignSchema:
     endDate = fields.String(required=True)
     ql = fields.String(required=True)  
 
+    def __init__(self, character_names=None):
+        # Optional existence check of the pc names (services.integrity.CharacterNames), None to skip it
+        self.character_names = character_names
 
     @validates('title')
     def validate_title(self, value):
@@ -63,9 +67,14 @@ class CampaignSchema:
         
     @validates('pc')
     def validate_pc(self, value):
-        # Check if the field is empty
-        if not value:
+        # Check that the field names at least one character, parsed as the routes will store it
+        if not pc_names(value):
             raise ValidationError('At least one Player Character is required.')
+        # Check that every Player Character exists, when the check is enabled
+        if self.character_names:
+            missing = self.character_names.missing(value)
+            if missing:
+                raise ValidationError(f'Unknown Player Characters: {", ".join(missing)}.')
 
     @validates('startDate')
     def validate_startDate(self, value):
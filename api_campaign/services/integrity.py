@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+
+from logger.logger_base import Logger
+from models.tenancy import current_tenant, for_each_tenant
+from services.delta_sync import now_ms
+from services.stats import collection_version
+from services.summaries import pc_names
+
+
+class CharacterNames:
+    # Tells which of a campaign's pc names have no character, for the optional check on campaign writes (PC_CHECK)
+    # 'query': one batched $in lookup per write
+    # 'cache': names seen in the characters collection are kept in memory and only unknown names are looked up,
+    #          so a character created a moment ago is never rejected; a deleted one is accepted for up to cache_seconds
+    #          (one name set per tenant)
+    def __init__(self, characters, mode='query', cache_seconds=10):
+        self.characters = characters  # Characters collection, written by the character service
+        self.mode = mode
+        self.cache_seconds = cache_seconds  # How often the cache checks whether the characters changed
+        self.cache = {}  # Tenant -> (character names, collection version they were read at, monotonic time of the check)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, db_conn):
+        # The check is opt-in: PC_CHECK=query or PC_CHECK=cache, with PC_CHECK_CACHE_SECONDS for the cache
+        mode = os.environ.get('PC_CHECK', 'off').lower()
+        if mode not in ('query', 'cache'):
+            return None
+        return cls(db_conn.foreign('characters', 'PC_CHECK'), mode, float(os.environ.get('PC_CHECK_CACHE_SECONDS', 10)))
+
+    def cached_names(self):
+        # Reload the name set only when the characters collection changed since the last load
+        tenant = current_tenant.get()
+        with self.lock:
+            names, version, checked_at = self.cache.get(tenant, (set(), None, 0.0))
+            if time.monotonic() - checked_at >= self.cache_seconds:
+                current = collection_version(self.characters)
+                if current != version:
+                    names = set(self.characters.distinct('characterName'))
+                self.cache[tenant] = (names, current, time.monotonic())
+            return names
+
+    def missing(self, pc):
+        # Names of the pc value ('Aria, Brom' or [{'characterName': 'Aria'}, ...]) that no character has
+        names = list(dict.fromkeys(pc_names(pc)))
+        if self.mode == 'cache':
+            known = self.cached_names()
+            names = [name for name in names if name not in known]
+        if not names:
+            return []
+        found = set(self.characters.distinct('characterName', {'characterName': {'$in': names}}))
+        return [name for name in names if name not in found]
+
+
+class OrphanScan:
+    # Finds the campaigns whose pc names have no character, walking the campaigns in _id order one batch at a time
+    # Only a batch and its names are held in memory; the findings go to campaign_orphans as the scan goes
+    # A scan covers the current tenant; run_all() scans every tenant in turn
+    def __init__(self, db_conn, batch_size=500):
+        self.logger = Logger()  # Logger for logging messages
+        self.db_conn = db_conn  # Database connection, to list the tenants
+        self.campaigns = db_conn.repository('campaigns')
+        self.characters = db_conn.foreign('characters', 'The orphan scan')
+        self.orphans = db_conn.repository('campaign_orphans')  # {_id: campaign id, title, missing, checkedAt}
+        self.batch_size = batch_size
+        self.thread = None
+
+    def run(self, progress=None):
+        # progress(done, total, message) is called after each batch, when given
+        started = now_ms()
+        checked = orphaned = 0
+        last_id = None
+        while True:
+            query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+            batch = list(self.campaigns.find(query, {'title': 1, 'pc': 1}, sort=[('_id', 1)], limit=self.batch_size))
+            if not batch:
+                break
+            # One $in lookup for every name in the batch
+            names = list({name for campaign in batch for name in pc_names(campaign.get('pc'))})
+            found = set(self.characters.distinct('characterName', {'characterName': {'$in': names}})) if names else set()
+            for campaign in batch:
+                missing = [name for name in dict.fromkeys(pc_names(campaign.get('pc'))) if name not in found]
+                if missing:
+                    self.orphans.replace_one({'_id': campaign['_id']}, {
+                        '_id': campaign['_id'], 'title': campaign.get('title'), 'missing': missing, 'checkedAt': started,
+                    }, upsert=True)
+                    orphaned += 1
+            checked += len(batch)
+            last_id = batch[-1]['_id']
+            if progress:
+                progress(checked, None, f'{orphaned} orphaned so far')
+        # Findings this scan did not confirm belong to campaigns since fixed or deleted
+        self.orphans.delete_many({'checkedAt': {'$lt': started}})
+        self.logger.info(f'Orphan scan: {orphaned} of {checked} campaigns reference missing characters')
+        return {'campaigns': checked, 'orphaned': orphaned}
+
+    def run_all(self):
+        # One scan per tenant with campaigns (a single scan without tenancy)
+        return for_each_tenant(self.db_conn, self.run, 'campaigns')
+
+    def start(self, interval):
+        # Run the scan every interval seconds in a daemon thread
+        def loop():
+            while True:
+                try:
+                    self.run_all()
+                except Exception as e:
+                    self.logger.error(f'Error scanning the campaigns for missing characters: {e}')
+                time.sleep(interval)
+
+        self.thread = threading.Thread(target=loop, name='orphan-scan', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_environment(cls, db_conn):
+        # Periodic scan is opt-in: ORPHAN_SCAN_INTERVAL seconds, ORPHAN_SCAN_BATCH campaigns per batch
+        scan = cls(db_conn, batch_size=int(os.environ.get('ORPHAN_SCAN_BATCH', 500)))
+        interval = float(os.environ.get('ORPHAN_SCAN_INTERVAL', 0))
+        if interval > 0:
+            scan.start(interval)
+        return scan
+
+
+if __name__ == '__main__':
+    # One-off scan, e.g. from cron: python -m services.integrity
+    from models.models import CampaignModel
+
+    logger = Logger()  # Logger for logging messages
+    db_conn = CampaignModel()  # Database connection
+
+    try:
+        db_conn.connect_to_database()  # Connect to the database
+        counts = OrphanScan(db_conn, batch_size=int(os.environ.get('ORPHAN_SCAN_BATCH', 500))).run_all()
+        logger.info(f'Orphan scan finished: {counts}')
+    except Exception as e:
+        # If something goes wrong, log the error
+        logger.error(f'An error has occurred: {e}')
+    finally:
+        db_conn.close_connection()  # Close the database connection (the memory engine writes its snapshot)
@@ -0,0 +1,210 @@
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from logger.logger_base import Logger
+from models.tenancy import current_tenant, tenant_scope
+from services.delta_sync import now_ms
+
+# Finished jobs are kept this long for status polling, then removed by a TTL index
+JOB_RETENTION = timedelta(days=7)
+
+
+class LeaseLost(Exception):
+    # The job's lease expired and another worker took it over; the handler must stop
+    pass
+
+
+class JobContext:
+    # Handed to a job handler to report progress, which also renews the lease
+    def __init__(self, queue, job):
+        self.queue = queue
+        self.job = job
+
+    def progress(self, done, total=None, message=None):
+        self.queue.heartbeat(self.job, {'done': done, 'total': total, 'message': message})
+
+
+class JobQueue:
+    # Background jobs stored in the shared 'jobs' collection, run by worker threads or a worker process
+    # A worker claims a job with an atomic find_one_and_update and holds it for lease_seconds, renewed on progress
+    # A job whose worker died is claimed again once its lease expires; failures are retried with backoff
+    # Handlers run more than once when that happens, so they must be safe to repeat
+    def __init__(self, db_conn, service, handlers, lease_seconds=60, max_attempts=3, poll_interval=1.0):
+        self.logger = Logger()  # Logger for logging messages
+        self.repository = db_conn.repository('jobs')  # Jobs of every service, told apart by 'service'
+        self.service = service  # Collection name of the service, e.g. 'bosses'
+        self.handlers = handlers  # {type: function(context, params) -> result}
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts  # Tries before a job is marked failed
+        self.attempt_limit = {'$ifNull': ['$maxAttempts', max_attempts]}  # Each job's own limit, in query expressions
+        self.poll_interval = poll_interval  # Seconds between claims while the queue is empty
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.threads = []
+        self.stopping = threading.Event()
+
+    @classmethod
+    def from_environment(cls, db_conn, service, handlers):
+        # JOB_WORKERS threads run jobs inside each app process (needed with the memory engine);
+        # with MongoDB, `python -m services.jobs` runs them in a separate worker process instead
+        queue = cls(
+            db_conn, service, handlers,
+            lease_seconds=float(os.environ.get('JOB_LEASE_SECONDS', 60)),
+            max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', 3)),
+        )
+        queue.start(int(os.environ.get('JOB_WORKERS', 0)))
+        return queue
+
+    def ensure_indexes(self):
+        # The claim query, and removal of finished jobs after JOB_RETENTION
+        self.repository.create_index([('service', 1), ('status', 1), ('runAt', 1)])
+        self.repository.create_index('expiresAt', expire_after_seconds=0)
+
+    def submit(self, job_type, params=None):
+        # Queue a job and return it; raises ValueError for a type this service doesn't run
+        if job_type not in self.handlers:
+            raise ValueError(f'Unknown job type {job_type!r}, expected one of: {", ".join(sorted(self.handlers))}')
+        now = now_ms()
+        job = {
+            '_id': uuid.uuid4().hex,
+            'service': self.service,
+            'tenant': current_tenant.get(),  # The handler runs as the tenant that queued the job
+            'type': job_type,
+            'params': params or {},
+            'status': 'queued',
+            'attempts': 0,
+            'maxAttempts': self.max_attempts,
+            'progress': None,
+            'result': None,
+            'error': None,
+            'createdAt': now,
+            'updatedAt': now,
+            'runAt': now,
+        }
+        self.repository.insert_one(job)
+        return job
+
+    def get(self, job_id):
+        # A tenant only sees its own jobs
+        query = {'_id': job_id, 'service': self.service}
+        if current_tenant.get() is not None:
+            query['tenant'] = current_tenant.get()
+        return self.repository.find_one(query, {'expiresAt': 0, 'worker': 0})
+
+    def claim(self):
+        # Take the oldest job that is due, or one whose worker stopped renewing its lease
+        # Only types this worker has a handler for, so an older deployment leaves newer job types alone
+        # A lapsed lease is only taken over while the job has attempts left, or a job that kills its worker would run forever
+        now = now_ms()
+        return self.repository.find_one_and_update(
+            {'service': self.service, 'type': {'$in': list(self.handlers)}, '$or': [
+                {'status': 'queued', 'runAt': {'$lte': now}},
+                {'status': 'running', 'leaseUntil': {'$lt': now}, '$expr': {'$lt': ['$attempts', self.attempt_limit]}},
+            ]},
+            {'$set': {'status': 'running', 'worker': self.worker_id, 'leaseUntil': now + int(self.lease_seconds * 1000),
+                      'updatedAt': now},
+             '$inc': {'attempts': 1}},
+            sort=[('runAt', 1)],
+        )
+
+    def fail_abandoned(self):
+        # Mark failed the jobs whose lease lapsed on their last attempt, which claim() no longer takes
+        now = now_ms()
+        return self.repository.update_many(
+            {'service': self.service, 'status': 'running', 'leaseUntil': {'$lt': now},
+             '$expr': {'$gte': ['$attempts', self.attempt_limit]}},
+            {'$set': {'status': 'failed', 'error': 'The worker stopped during the last attempt', 'updatedAt': now,
+                      'expiresAt': datetime.now(timezone.utc) + JOB_RETENTION},
+             '$unset': {'leaseUntil': ''}},
+        )
+
+    def heartbeat(self, job, progress):
+        # Record progress and extend the lease, as long as this worker still holds the job
+        # update_one counts modified documents, and a repeated progress in the same millisecond modifies nothing, so
+        # whether the job still matches comes from find_one_and_update instead
+        now = now_ms()
+        held = self.repository.find_one_and_update(
+            {'_id': job['_id'], 'worker': self.worker_id, 'status': 'running'},
+            {'$set': {'progress': progress, 'leaseUntil': now + int(self.lease_seconds * 1000), 'updatedAt': now}},
+            projection={'_id': 1},
+        )
+        if held is None:
+            raise LeaseLost(f'Job {job["_id"]} was taken over by another worker')
+
+    def finish(self, job, changes):
+        # Store the outcome, unless the lease was lost and another worker owns the job now
+        changes['updatedAt'] = now_ms()
+        if changes['status'] in ('succeeded', 'failed'):
+            changes['expiresAt'] = datetime.now(timezone.utc) + JOB_RETENTION
+        self.repository.update_one({'_id': job['_id'], 'worker': self.worker_id}, {'$set': changes, '$unset': {'leaseUntil': ''}})
+
+    def run_one(self):
+        # Claim and run a single job; returns whether there was one
+        job = self.claim()
+        if not job:
+            self.fail_abandoned()  # While idle, so a busy queue doesn't pay for it
+            return False
+        try:
+            with tenant_scope(job.get('tenant')):
+                result = self.handlers[job['type']](JobContext(self, job), job.get('params') or {})
+            self.finish(job, {'status': 'succeeded', 'result': result, 'error': None})
+        except LeaseLost as e:
+            self.logger.warning(str(e))
+        except Exception as e:
+            if job['attempts'] < job.get('maxAttempts', self.max_attempts):
+                # Back off 2, 4, 8... seconds before the next attempt
+                self.logger.warning(f'Job {job["_id"]} ({job["type"]}) failed on attempt {job["attempts"]}, retrying: {e}')
+                self.finish(job, {'status': 'queued', 'error': str(e), 'runAt': now_ms() + 1000 * 2 ** job['attempts']})
+            else:
+                self.logger.error(f'Job {job["_id"]} ({job["type"]}) failed after {job["attempts"]} attempts: {e}')
+                self.finish(job, {'status': 'failed', 'error': str(e)})
+        return True
+
+    def work(self):
+        # Worker loop: run jobs back to back, poll while there are none
+        while not self.stopping.is_set():
+            try:
+                if self.run_one():
+                    continue
+            except Exception as e:
+                self.logger.error(f'Error claiming a {self.service} job: {e}')
+            self.stopping.wait(self.poll_interval)
+
+    def start(self, workers):
+        for number in range(workers):
+            thread = threading.Thread(target=self.work, name=f'{self.service}-job-worker-{number}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        # Let the workers finish their current job and exit
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+
+if __name__ == '__main__':
+    # Worker process: python -m services.jobs (stops after the current job on SIGTERM or Ctrl+C)
+    from models.models import CampaignModel
+    from services.services import CampaignService
+
+    logger = Logger()  # Logger for logging messages
+    db_conn = CampaignModel()  # Database connection
+
+    try:
+        db_conn.connect_to_database()  # Connect to the database
+        jobs = CampaignService(db_conn).jobs
+        signal.signal(signal.SIGTERM, lambda signum, frame: jobs.stopping.set())
+        logger.info(f'Job worker {jobs.worker_id} started')
+        jobs.work()
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        # If something goes wrong, log the error
+        logger.error(f'An error has occurred: {e}')
+    finally:
+        db_conn.close_connection()  # Close the database connection
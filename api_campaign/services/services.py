@@ -1,17 +1,60 @@
 # Import necessary modules
 from flask import jsonify
 from logger.logger_base import Logger
+from services.change_feed import ChangeFeed
+from services.archive import export_archive, import_archive, archive_path
+from services.delta_sync import now_ms, ensure_sync_indexes, record_tombstone, get_changes
+from services.jobs import JobQueue
+from services.stats import StatsCache, count_by, facet_counts
+from services.summaries import SummaryStore, CAMPAIGN_FIELDS, pc_roster
+from services.integrity import CharacterNames, OrphanScan
 
 class CampaignService:
     def __init__(self, db_conn):
         # Set up logging and database connection
         self.logger = Logger()  # Logger for logging messages
         self.db_conn = db_conn  # Database connection
+        self.repository = db_conn.repository('campaigns')  # Storage of the campaigns
+        self.tombstones = db_conn.repository('tombstones')  # Deletion records used by delta sync
+        self.change_feed = ChangeFeed(self.repository, self.tombstones, 'campaigns')  # Pushes collection changes to event stream clients
+        self.stats = StatsCache(self.repository, self.compute_stats)  # Dashboard stats, recomputed after writes
+        self.summaries = SummaryStore(db_conn)  # Per-player and per-campaign summaries for the landing page
+        self.character_names = CharacterNames.from_environment(db_conn)  # Existence check of the pc names, None unless PC_CHECK is set
+        self.orphan_scan = OrphanScan.from_environment(db_conn)  # Campaigns naming missing characters, rescanned every ORPHAN_SCAN_INTERVAL
+        # Long operations run off the request path; JOB_WORKERS threads or `python -m services.jobs` run them
+        self.jobs = JobQueue.from_environment(db_conn, 'campaigns', {
+            'reindex': self.reindex_job,
+            'rebuild-summaries': self.rebuild_summaries_job,
+            'orphan-scan': self.orphan_scan_job,
+            'export': self.export_job,
+            'import': self.import_job,
+        })
+
+    def ensure_indexes(self):
+        try:
+            # updatedAt and tombstone indexes used by delta sync
+            ensure_sync_indexes(self.repository, self.tombstones)
+            self.jobs.ensure_indexes()  # Job claims and the cleanup of finished jobs
+            # Indexes of the summaries, built from the stored data on their first start
+            self.summaries.ensure_indexes()
+            self.orphan_scan.orphans.create_index('checkedAt')  # Stale findings are dropped by checkedAt
+            # Campaigns by character name, for the renames and deletions cascaded by the character service
+            self.repository.create_index('pc.characterName')
+            # Backfill campaigns whose pc was stored as the raw 'Aria, Brom' string by older updates
+            for campaign in self.repository.find({'pc.characterName': {'$exists': False}}, {'pc': 1}):
+                if isinstance(campaign.get('pc'), str):
+                    self.repository.update_one({'_id': campaign['_id']}, {'$set': {
+                        'pc': pc_roster(campaign['pc']),
+                        'updatedAt': now_ms(),
+                    }})
+        except Exception as e:
+            # Indexes only speed things up, so log and keep serving
+            self.logger.error(f'Error creating the campaign indexes: {e}')
 
     def get_all_campaigns(self):
         try:
             # Fetch all campaigns from the database and return them as a list
-            campaigns = list(self.db_conn.db.campaigns.find())
+            campaigns = list(self.repository.find())
             return campaigns
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -20,14 +63,15 @@ class CampaignService:
 
     def add_campaign(self, new_campaign):
         try:
-            # Try to get the highest ID in the collection
-            max_campaign = self.db_conn.db.campaigns.find_one(sort=[('_id', -1)])
-            # If a campaign exists, increment its ID by 1; otherwise, start from 1
-            next_id = max_campaign['_id'] + 1 if max_campaign else 1
+            # Highest ID in the collection plus one, or 1 for the first campaign
+            next_id = self.repository.next_id()
             # Assign the new ID to the campaign
             new_campaign['_id'] = next_id  
+            new_campaign['updatedAt'] = now_ms()  # Change time used by delta sync
             # Insert the new campaign into the database
-            self.db_conn.db.campaigns.insert_one(new_campaign)
+            self.repository.insert_one(new_campaign)
+            self.stats.invalidate()  # The cached stats are out of date
+            self.summaries.sync_campaign(next_id)  # List the campaign in the summaries
             
             # Return the newly added campaign
             return new_campaign
@@ -42,7 +86,7 @@ class CampaignService:
     def get_campaign_by_id(self, campaign_id):
         try:
             # Fetch a specific campaign by its ID from the database
-            campaign_data = self.db_conn.db.campaigns.find_one({'_id': campaign_id})
+            campaign_data = self.repository.find_one({'_id': campaign_id})
             return campaign_data  # Return the campaign data
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -56,8 +100,11 @@ class CampaignService:
 
             if update_campaign:
                 # If the campaign exists, update it with the new data
-                updated_campaign = self.db_conn.db.campaigns.update_one({'_id': campaign_id}, {'$set': campaign_data})
-                if updated_campaign.modified_count > 0:
+                campaign_data['updatedAt'] = now_ms()  # Change time used by delta sync
+                updated_campaign = self.repository.update_one({'_id': campaign_id}, {'$set': campaign_data})
+                self.stats.invalidate()  # The cached stats are out of date
+                self.summaries.sync_campaign(campaign_id)  # Refresh the campaign in the summaries
+                if updated_campaign > 0:
                     return updated_campaign  # Return the updated campaign
                 else:
                     return 'The campaign is already up-to-date'  # No changes made
@@ -69,6 +116,30 @@ class CampaignService:
             self.logger.error(f'Error updating the campaign: {e}')
             return jsonify({'error': f'Error updating the campaign: {e}'}), 500
         
+    def patch_campaign(self, campaign_id, changes, expected_version=None):
+        try:
+            # Only match the version the client saw, when it sent one
+            query = {'_id': campaign_id}
+            if expected_version is not None:
+                query['updatedAt'] = expected_version
+
+            changes['updatedAt'] = now_ms()  # Change time used by delta sync, also the new version
+            # Set only the changed fields and read back just those, in a single round-trip
+            patched_campaign = self.repository.find_one_and_update(query, {'$set': changes}, projection=list(changes))
+            self.stats.invalidate()  # The cached stats are out of date
+            if patched_campaign and set(CAMPAIGN_FIELDS) & set(changes):
+                self.summaries.sync_campaign(campaign_id)  # Only when a summarized field changed
+            if patched_campaign:
+                return patched_campaign  # Return the changed fields
+            if expected_version is not None and self.repository.count({'_id': campaign_id}, limit=1):
+                return False  # The campaign exists but has a newer version
+            return None  # Campaign not found
+
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error patching the campaign: {e}')
+            return jsonify({'error': f'Error patching the campaign: {e}'}), 500
+
     def delete_campaign(self, campaign_id):
         try:
             # Check if the campaign exists before deleting
@@ -76,7 +147,10 @@ class CampaignService:
             
             if deleted_campaign:
                 # If the campaign exists, delete it from the database
-                self.db_conn.db.campaigns.delete_one({'_id': campaign_id})
+                self.repository.delete_one({'_id': campaign_id})
+                self.stats.invalidate()  # The cached stats are out of date
+                self.summaries.sync_campaign(campaign_id)  # Drop the campaign from the summaries
+                record_tombstone(self.tombstones, 'campaigns', campaign_id)  # Let offline clients sync the deletion
                 return deleted_campaign  # Return the deleted campaign data
             else:
                 return None  # Campaign not found
@@ -86,6 +160,122 @@ class CampaignService:
             self.logger.error(f'Error deleting the campaign data: {e}')
             return jsonify({'error': f'Error deleting the campaign data: {e}'}), 500
 
+    def compute_stats(self):
+        # Campaigns per status
+        return facet_counts(self.repository, {'byStatus': count_by('$status')})
+
+    def get_stats(self):
+        try:
+            # Cached aggregated stats with their version, recomputed only when the campaigns changed
+            return self.stats.get()
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing the campaign stats: {e}')
+            return jsonify({'error': f'Error computing the campaign stats: {e}'}), 500
+
+    def get_campaign_summary(self, campaign_id):
+        try:
+            # Fetch the materialized campaign summary, a single read by _id
+            return self.summaries.get_campaign(campaign_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the campaign summary: {e}')
+            return jsonify({'error': f'Error fetching the campaign summary: {e}'}), 500
+
+    def get_orphans(self):
+        try:
+            # Campaigns the last orphan scan found naming characters that don't exist
+            return list(self.orphan_scan.orphans.find(sort=[('_id', 1)]))
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the campaign orphans: {e}')
+            return jsonify({'error': f'Error fetching the campaign orphans: {e}'}), 500
+
+    def submit_job(self, job_type, params):
+        try:
+            # Queue a background job; the response only carries its id and status
+            return self.jobs.submit(job_type, params)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown job type
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error submitting the campaign job: {e}')
+            return jsonify({'error': f'Error submitting the campaign job: {e}'}), 500
+
+    def get_job(self, job_id):
+        try:
+            # Fetch a job of this service with its status, progress and result
+            return self.jobs.get(job_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the campaign job: {e}')
+            return jsonify({'error': f'Error fetching the campaign job: {e}'}), 500
+
+    def reindex_job(self, context, params):
+        # Job handler: create the indexes and run the backfills again, e.g. after restoring a dump
+        self.ensure_indexes()
+        return {'indexes': sorted(self.repository.index_names())}
+
+    def rebuild_summaries_job(self, context, params):
+        # Job handler: recompute the player and campaign summaries from scratch
+        return self.summaries.rebuild(progress=context.progress)
+
+    def orphan_scan_job(self, context, params):
+        # Job handler: look for campaigns naming missing characters
+        return self.orphan_scan.run(progress=context.progress)
+
+    def export_archive(self, archive_format):
+        try:
+            # Compressed archive of every campaign, produced chunk by chunk while the response is sent
+            return export_archive(self.repository, 'campaigns', archive_format)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error exporting the campaigns: {e}')
+            return jsonify({'error': f'Error exporting the campaigns: {e}'}), 500
+
+    def import_archive(self, stream, archive_format, mode):
+        try:
+            # Import an archive read from the request body as it arrives
+            return self.load_archive(stream, archive_format, mode)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format or mode, or not a campaigns archive
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error importing the campaigns: {e}')
+            return jsonify({'error': f'Error importing the campaigns: {e}'}), 500
+
+    def load_archive(self, stream, archive_format, mode, progress=None):
+        # Import an archive, then bring what is derived from the campaigns up to date
+        counts = import_archive(stream, self.repository, 'campaigns', archive_format, mode, progress=progress)
+        self.ensure_indexes()  # Backfills the derived fields of campaigns from older archives
+        self.summaries.rebuild()  # The imported campaigns replace what the summaries were built from
+        self.stats.invalidate()
+        return counts
+
+    def export_job(self, context, params):
+        # Job handler: write an archive into ARCHIVE_DIR
+        archive_format = params.get('format', 'bson')
+        with open(archive_path(params.get('path')), 'wb') as archive:
+            for chunk in export_archive(self.repository, 'campaigns', archive_format):
+                archive.write(chunk)
+            return {'path': archive.name, 'format': archive_format, 'bytes': archive.tell()}
+
+    def import_job(self, context, params):
+        # Job handler: import an archive from ARCHIVE_DIR, for archives too large to send in one request
+        with open(archive_path(params.get('path')), 'rb') as archive:
+            return self.load_archive(archive, params.get('format', 'bson'), params.get('mode', 'upsert'), progress=context.progress)
+
+    def get_changes(self, since, limit):
+        try:
+            # Fetch only the campaigns changed or deleted since the client's last sync
+            return get_changes(self.repository, self.tombstones, 'campaigns', since, limit)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the campaign changes: {e}')
+            return jsonify({'error': f'Error fetching the campaign changes: {e}'}), 500
+
 # Main block of code for testing the CampaignService
 if __name__ == '__main__':
     from models.models import CampaignModel
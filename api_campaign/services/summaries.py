@@ -0,0 +1,237 @@
+from logger.logger_base import Logger
+from models.tenancy import current_tenant, for_each_tenant
+from services.delta_sync import now_ms
+
+# Character fields copied into the player summaries; a write touching none of them leaves the summaries as they are
+CHARACTER_FIELDS = ('characterName', 'playerName', 'race', 'className', 'level')
+# Campaign fields copied into the campaign summaries and into the campaigns listed per player
+CAMPAIGN_FIELDS = ('title', 'status', 'dm', 'pc')
+
+
+def pc_names(pc):
+    # Character names of a campaign: [{'characterName': 'Aria'}, ...] as stored, a list of names, or the 'Aria, Brom'
+    # string clients send (and older updates stored); every reader and writer of pc parses it here
+    if isinstance(pc, str):
+        return [name.strip() for name in pc.split(',') if name.strip()]
+    names = []
+    for member in pc if isinstance(pc, list) else []:
+        name = member.get('characterName') if isinstance(member, dict) else member
+        if isinstance(name, str) and name.strip():
+            names.append(name.strip())
+    return names
+
+
+def pc_roster(pc):
+    # The pc value as campaigns store it: [{'characterName': 'Aria'}, ...]
+    return [{'characterName': name} for name in pc_names(pc)]
+
+
+def character_entry(character):
+    # A character as listed in its player's summary
+    return {'_id': character['_id'], **{field: character.get(field) for field in CHARACTER_FIELDS if field != 'playerName'}}
+
+
+def campaign_entry(campaign, character):
+    # A campaign as listed in the summary of the player whose character plays in it
+    return {
+        '_id': campaign['_id'],
+        'title': campaign.get('title'),
+        'status': campaign.get('status'),
+        'characterId': character['_id'],
+        'characterName': character.get('characterName'),
+    }
+
+
+def campaign_summary(campaign, characters_by_name, updated_at):
+    # A campaign with each of its characters resolved to their id and player, None when no such character exists
+    members = []
+    for name in pc_names(campaign.get('pc')):
+        character = characters_by_name.get(name)
+        members.append({
+            'characterName': name,
+            'characterId': character['_id'] if character else None,
+            'playerName': character.get('playerName') if character else None,
+        })
+    return {
+        '_id': campaign['_id'],
+        'title': campaign.get('title'),
+        'status': campaign.get('status'),
+        'dm': campaign.get('dm'),
+        'characters': members,
+        'updatedAt': updated_at,
+    }
+
+
+class SummaryStore:
+    # Materialized summaries read by the landing page in a single indexed lookup:
+    # player_summaries: {_id: playerName, characters: [...], campaigns: [...]} keyed by player
+    # campaign_summaries: {_id: campaign id, title, status, dm, characters: [{characterName, characterId, playerName}]}
+    # Kept current by the character and campaign services after each write; rebuild() repairs any drift
+    # With TENANCY=field the players of tenants other than the default one are keyed 'tenant:playerName'
+    def __init__(self, db_conn):
+        self.logger = Logger()  # Logger for logging messages
+        self.db_conn = db_conn  # Database connection, holding the tenancy settings
+        self.characters = db_conn.foreign('characters', 'Player summaries')  # Source of the player summaries
+        self.campaigns = db_conn.foreign('campaigns', 'Campaign summaries')  # Source of the campaign summaries
+        self.players = db_conn.repository('player_summaries')  # One document per playerName
+        self.campaign_summaries = db_conn.repository('campaign_summaries')  # One document per campaign
+
+    def ensure_indexes(self):
+        # Lookups made by the incremental updates, so none of them scans a collection
+        self.characters.create_index('characterName')
+        self.players.create_index('characters._id')
+        self.players.create_index('campaigns._id')
+        self.campaign_summaries.create_index('characters.characterName')
+        self.campaign_summaries.create_index('characters.characterId')
+        # First start with summaries: build them from what is already stored
+        if not self.players.count(limit=1) and not self.campaign_summaries.count(limit=1):
+            if self.characters.count(limit=1) or self.campaigns.count(limit=1):
+                if current_tenant.get() is None:
+                    for_each_tenant(self.db_conn, self.rebuild, 'characters', 'campaigns')
+                else:
+                    self.rebuild()  # A new tenant database
+
+    def player_key(self, player_name):
+        # Two tenants sharing the collection may both have a player of that name
+        tenant = current_tenant.get()
+        if self.db_conn.tenancy == 'field' and tenant not in (None, self.db_conn.default_tenant):
+            return f'{tenant}:{player_name}'
+        return player_name
+
+    def get_player(self, player_name):
+        player = self.players.find_one({'_id': self.player_key(player_name)})
+        if player:
+            player['_id'] = player_name
+        return player
+
+    def get_campaign(self, campaign_id):
+        return self.campaign_summaries.find_one({'_id': campaign_id})
+
+    def sync_character(self, character_id):
+        # Bring the summaries in line with the stored character after an add, update, patch or delete
+        # The write itself already succeeded, so a failure here is logged and left to the rebuild command
+        try:
+            self.remove_character(character_id)
+            character = self.characters.find_one({'_id': character_id}, list(CHARACTER_FIELDS))
+            if character:
+                self.add_character(character)
+        except Exception as e:
+            self.logger.error(f'Error updating the summaries of character {character_id}, rebuild them to repair: {e}')
+
+    def sync_campaign(self, campaign_id):
+        # Same for a campaign
+        try:
+            self.remove_campaign(campaign_id)
+            campaign = self.campaigns.find_one({'_id': campaign_id}, list(CAMPAIGN_FIELDS))
+            if campaign:
+                self.add_campaign(campaign)
+        except Exception as e:
+            self.logger.error(f'Error updating the summaries of campaign {campaign_id}, rebuild them to repair: {e}')
+
+    def remove_character(self, character_id):
+        updated_at = now_ms()
+        player = self.players.find_one({'characters._id': character_id}, {'_id': 1})
+        if player:
+            self.players.update_one({'_id': player['_id']}, {
+                '$pull': {'characters': {'_id': character_id}, 'campaigns': {'characterId': character_id}},
+                '$set': {'updatedAt': updated_at},
+            })
+            self.players.delete_one({'_id': player['_id'], 'characters': {'$size': 0}})  # The player's last character
+        # The campaigns still list the name, now without a character behind it
+        self.campaign_summaries.update_many(
+            {'characters.characterId': character_id},
+            {'$set': {'characters.$[member].characterId': None, 'characters.$[member].playerName': None, 'updatedAt': updated_at}},
+            array_filters=[{'member.characterId': character_id}],
+        )
+
+    def add_character(self, character):
+        updated_at = now_ms()
+        name, player_name = character.get('characterName'), character.get('playerName')
+        appearances = list(self.campaign_summaries.find({'characters.characterName': name}, {'title': 1, 'status': 1}))
+        if player_name:
+            self.players.update_one({'_id': self.player_key(player_name)}, {
+                '$push': {
+                    'characters': character_entry(character),
+                    'campaigns': {'$each': [campaign_entry(campaign, character) for campaign in appearances]},
+                },
+                '$set': {'updatedAt': updated_at},
+            }, upsert=True)
+        if appearances:
+            self.campaign_summaries.update_many(
+                {'characters.characterName': name},
+                {'$set': {'characters.$[member].characterId': character['_id'], 'characters.$[member].playerName': player_name,
+                          'updatedAt': updated_at}},
+                array_filters=[{'member.characterName': name}],
+            )
+
+    def remove_campaign(self, campaign_id):
+        self.campaign_summaries.delete_one({'_id': campaign_id})
+        self.players.update_many({'campaigns._id': campaign_id}, {
+            '$pull': {'campaigns': {'_id': campaign_id}},
+            '$set': {'updatedAt': now_ms()},
+        })
+
+    def add_campaign(self, campaign):
+        updated_at = now_ms()
+        names = pc_names(campaign.get('pc'))
+        characters = {character['characterName']: character for character in
+                      self.characters.find({'characterName': {'$in': names}}, ['characterName', 'playerName'])}
+        self.campaign_summaries.replace_one({'_id': campaign['_id']}, campaign_summary(campaign, characters, updated_at), upsert=True)
+        for character in characters.values():
+            if character.get('playerName'):
+                self.players.update_one({'_id': self.player_key(character['playerName'])}, {
+                    '$push': {'campaigns': campaign_entry(campaign, character)},
+                    '$set': {'updatedAt': updated_at},
+                })
+
+    def rebuild(self, progress=None):
+        # Recompute every summary from the characters and campaigns, then drop the summaries nothing backs any more
+        # progress(done, total, message) is called as the campaigns are processed, when given
+        updated_at = now_ms()
+        characters = list(self.characters.find({}, list(CHARACTER_FIELDS), sort=[('_id', 1)]))
+        characters_by_name = {character.get('characterName'): character for character in characters}
+        players = {}
+        for character in characters:
+            if character.get('playerName'):
+                player = players.setdefault(character['playerName'], {
+                    '_id': self.player_key(character['playerName']), 'characters': [], 'campaigns': [], 'updatedAt': updated_at,
+                })
+                player['characters'].append(character_entry(character))
+
+        campaign_ids = []
+        for campaign in self.campaigns.find({}, list(CAMPAIGN_FIELDS)):
+            summary = campaign_summary(campaign, characters_by_name, updated_at)
+            self.campaign_summaries.replace_one({'_id': campaign['_id']}, summary, upsert=True)
+            campaign_ids.append(campaign['_id'])
+            if progress and len(campaign_ids) % 100 == 0:
+                progress(len(campaign_ids), None, 'campaign summaries')
+            for member in summary['characters']:
+                if member['playerName'] in players:
+                    players[member['playerName']]['campaigns'].append(
+                        campaign_entry(campaign, characters_by_name[member['characterName']])
+                    )
+        for player in players.values():
+            self.players.replace_one({'_id': player['_id']}, player, upsert=True)
+
+        self.campaign_summaries.delete_many({'_id': {'$nin': campaign_ids}})
+        self.players.delete_many({'_id': {'$nin': [player['_id'] for player in players.values()]}})
+        return {'players': len(players), 'campaigns': len(campaign_ids)}
+
+
+if __name__ == '__main__':
+    # Rebuild command, for drift repair: python -m services.summaries
+    from models.models import CampaignModel
+
+    logger = Logger()  # Logger for logging messages
+    db_conn = CampaignModel()  # Database connection
+
+    try:
+        db_conn.connect_to_database()  # Connect to the database
+        store = SummaryStore(db_conn)
+        counts = for_each_tenant(db_conn, store.rebuild, 'characters', 'campaigns')  # Each tenant's own summaries
+        logger.info(f'Summaries rebuilt: {counts}')
+    except Exception as e:
+        # If something goes wrong, log the error
+        logger.error(f'An error has occurred: {e}')
+    finally:
+        db_conn.close_connection()  # Close the database connection (the memory engine writes its snapshot)
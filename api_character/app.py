@@ -1,34 +1,58 @@
 # Import necessary modules
+import atexit
+
 from flask import Flask
 
 from models.models import CharacterModel  # Import the model to interact with the database
 from services.services import CharacterService  # Import the service to handle business logic
 from schemas.schemas import CharacterSchema  # Import the schema for data validation
 from routes.routes import CharacterRoutes  # Import the routes to manage the API endpoints
-from flasgger import Swagger  # Import Swagger for API documentation
+from middleware.rate_limit import RateLimiter  # Import the per-client rate limiter
+from middleware.tenant import TenantResolver  # Import the tenant selection for TENANCY
+from middleware.idempotency import IdempotencyKeys  # Import the Idempotency-Key replay for POST retries
+from middleware.tracing import init_tracing, traced  # Import the opt-in request tracing
+from routes.docs import init_docs  # Import the API documentation setup
+from routes.debug import init_debug  # Import the config-protected diagnostics routes
 
 from flask_cors import CORS  # Import CORS to handle cross-origin requests
 
 # Initialize the Flask application
 app = Flask(__name__)
 CORS(app)  # Enable Cross-Origin Resource Sharing for the app
+RateLimiter.from_environment(app)  # Throttle each client and shed load before the routes run
+init_tracing(app, 'character-api')  # Record spans for each request when TRACING is set (before the database connects)
 
-# Set up Swagger for automatic API documentation
-swagger = Swagger(app)
+# Set up the API documentation: live Swagger, a prebuilt static spec or none (API_DOCS)
+swagger = init_docs(app)
 
 # Initialize the database connection
 db_conn = CharacterModel()
 db_conn.connect_to_database()  # Connect to the database
+TenantResolver.from_environment(app, db_conn)  # Scope each API request to its tenant (when TENANCY is set)
+IdempotencyKeys.from_environment(app, db_conn, 'characters')  # Answer retried POSTs with the stored response
 
 # Initialize the service with the database connection
 character_service = CharacterService(db_conn)
+character_service.ensure_indexes()  # Create the indexes used by the service
+db_conn.on_new_tenant(character_service.ensure_indexes)  # Same indexes in each tenant database
 
 # Initialize the schema for data validation
 character_schema = CharacterSchema()
 
 # Initialize the routes for the API and register them
-character_routes = CharacterRoutes(character_service, character_schema)
+character_routes = CharacterRoutes(traced(character_service), traced(character_schema))
 app.register_blueprint(character_routes)  # Register the routes with the Flask app
+init_debug(app, db_conn.profiler)  # Slow-query report at /debug/slow-queries when DEBUG_ENDPOINTS is set
+
+
+def close_connection():
+    # Apply the queued campaign cascades before the connection goes away
+    character_service.close()
+    db_conn.close_connection()
+
+
+# Gunicorn workers exit through sys.exit on a graceful shutdown, which runs atexit handlers
+atexit.register(close_connection)
 
 # Start the Flask app
 if __name__ == '__main__':
@@ -36,5 +60,5 @@ if __name__ == '__main__':
         # Run the app in debug mode for development
         app.run(debug=True, host='0.0.0.0', port=8002)
     finally:
-        # Close the database connection when the app stops
-        db_conn.close_connection()
\ No newline at end of file
+        # Apply queued cascades and close the database connection when the app stops
+        close_connection()
\ No newline at end of file
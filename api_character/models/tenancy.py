@@ -0,0 +1,234 @@
+import contextvars
+import re
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from models.repository import Repository
+
+# Tenant of the current request or background task; None outside any (startup, maintenance commands)
+current_tenant = contextvars.ContextVar('current_tenant', default=None)
+
+# Tenant names end up in database names, so they are kept to what MongoDB allows everywhere
+TENANT_NAME = re.compile(r'^[A-Za-z0-9_-]{1,48}$')
+
+# Collections shared by every tenant in the main database: the job queue and idempotency keys carry the tenant
+# themselves, and the id counters keep ids unique across tenants
+SHARED_COLLECTIONS = ('jobs', 'idempotency_keys', 'counters')
+
+
+@contextmanager
+def tenant_scope(tenant):
+    # Run a block as the given tenant, e.g. a queued job or a background write
+    token = current_tenant.set(tenant)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+
+def for_each_tenant(db_conn, function, *collection_names):
+    # Run function once per tenant that has data in the collections (once, unscoped, without tenancy)
+    return {tenant: run_as(tenant, function) for tenant in db_conn.tenants(*collection_names)}
+
+
+def run_as(tenant, function):
+    with tenant_scope(tenant):
+        return function()
+
+
+class TenantDatabases:
+    # Database handles per tenant for TENANCY=database, least recently used dropped beyond max_handles
+    # Handles are cheap views on the one MongoClient; the first use of a tenant in this process runs the setup
+    # functions (the services' ensure_indexes) so a new tenant database gets its indexes before its first query
+    def __init__(self, client, prefix, max_handles=100):
+        self.client = client
+        self.prefix = prefix  # e.g. 'microservices_' -> tenant 'guild' lives in microservices_guild
+        self.max_handles = max_handles
+        self.handles = OrderedDict()
+        self.prepared = set()  # Tenants whose setup already ran in this process
+        self.setup = []  # Functions run as each tenant on its first use
+        self.lock = threading.Lock()
+
+    def get(self, tenant):
+        with self.lock:
+            database = self.handles.get(tenant)
+            if database is None:
+                database = self.handles[tenant] = self.client[f'{self.prefix}{tenant}']
+                while len(self.handles) > self.max_handles:
+                    self.handles.popitem(last=False)
+            else:
+                self.handles.move_to_end(tenant)
+            # Marked before the setup runs, as the setup itself reads this tenant's collections
+            first_use = tenant not in self.prepared
+            self.prepared.add(tenant)
+        if first_use:
+            for function in self.setup:
+                run_as(tenant, function)
+        return database
+
+    def names(self):
+        # Tenants that have a database
+        return sorted(name[len(self.prefix):] for name in self.client.list_database_names() if name.startswith(self.prefix))
+
+
+class TenantRepository(Repository):
+    # Scopes a collection to the current tenant
+    # TENANCY=field: one shared collection where every query is filtered on, and every new document stamped with,
+    #                the tenant field; documents without one belong to the default tenant, so existing data needs no migration
+    # TENANCY=database: each tenant's collection lives in its own database, picked per call
+    # The tenant is read when an operation is called, not while its cursor is read, so streamed responses that
+    # outlive the request stay in their tenant
+    # Outside a tenant scope nothing is filtered, which is what index creation, backfills and restores need
+    def __init__(self, db_conn, collection_name):
+        self.db_conn = db_conn  # Database connection, holding the tenancy settings
+        self.collection_name = collection_name
+        self.field = db_conn.tenant_field  # Name of the tenant field in field mode
+        self.filtered = db_conn.tenancy == 'field'
+        self.shared = db_conn.storage(collection_name) if db_conn.tenancy == 'field' else None
+
+    @property
+    def repository(self):
+        # Storage for the current tenant
+        if self.shared is not None:
+            return self.shared
+        tenant = current_tenant.get()
+        database = self.db_conn.tenant_databases.get(tenant) if tenant not in (None, self.db_conn.default_tenant) else None
+        return self.db_conn.storage(self.collection_name, database)
+
+    def condition(self):
+        # Filter on the tenant field, None when nothing is filtered
+        tenant = current_tenant.get()
+        if not self.filtered or tenant is None:
+            return None
+        if tenant == self.db_conn.default_tenant:
+            return {'$in': [tenant, None]}  # Documents from before tenancy was turned on
+        return tenant
+
+    def scope(self, filter):
+        condition = self.condition()
+        if condition is None:
+            return filter
+        return {**(filter or {}), self.field: condition}
+
+    def stamp(self, document):
+        # New documents belong to the current tenant, whatever tenant a client or an archive put in them
+        # Stamped on a copy: the caller's document is often the API response, which must not carry the tenant
+        tenant = current_tenant.get()
+        if self.filtered and tenant is not None:
+            return {**document, self.field: tenant}
+        return document
+
+    def hide(self, projection):
+        # Reads leave out the tenant field, which is internal; a projection listing the fields to return
+        # leaves it out already (unless it asks for it)
+        if not self.filtered:
+            return projection
+        if isinstance(projection, (list, tuple)):
+            return projection
+        fields = {name: value for name, value in (projection or {}).items() if name != '_id'}
+        if any(fields.values()) or (not fields and projection and projection.get('_id')):
+            return projection
+        return {**(projection or {}), self.field: 0}
+
+    def guard(self, update, upsert=False):
+        # Updates can't move a document to another tenant; an upsert copies equality conditions into the new
+        # document, but not the default tenant's $in, so that one gets the tenant through $setOnInsert
+        condition = self.condition()
+        if condition is None:
+            return update
+        update = {operator: {name: value for name, value in fields.items() if name != self.field} if isinstance(fields, dict) else fields
+                  for operator, fields in update.items()}
+        if upsert and isinstance(condition, dict):
+            update['$setOnInsert'] = {**update.get('$setOnInsert', {}), self.field: current_tenant.get()}
+        return update
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        return self.repository.find(self.scope(filter), self.hide(projection), sort, limit, skip)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        return self.repository.find_one(self.scope(filter), self.hide(projection), sort)
+
+    def insert_one(self, document):
+        stamped = self.stamp(document)
+        self.repository.insert_one(stamped)
+        document.setdefault('_id', stamped['_id'])  # Like the engines, give the caller's document its new _id
+
+    def insert_many(self, documents):
+        stamped = [self.stamp(document) for document in documents]
+        self.repository.insert_many(stamped)
+        for document, copy in zip(documents, stamped):
+            document.setdefault('_id', copy['_id'])
+
+    def upsert_many(self, documents):
+        # Replacing by _id alone could overwrite another tenant's document, so those ids are refused first
+        documents = [self.stamp(document) for document in documents]
+        condition = self.condition()
+        if condition is not None and documents:
+            ids = [document['_id'] for document in documents]
+            owned = {self.field: {'$nin': condition['$in']} if isinstance(condition, dict) else {'$ne': condition}}
+            taken = self.repository.distinct('_id', {'_id': {'$in': ids}, **owned})
+            if taken:
+                raise ValueError(f'IDs already used by another tenant: {", ".join(str(value) for value in taken[:10])}')
+        return self.repository.upsert_many(documents)
+
+    def update_one(self, filter, update, upsert=False, array_filters=None):
+        return self.repository.update_one(self.scope(filter), self.guard(update, upsert), upsert=upsert, array_filters=array_filters)
+
+    def update_many(self, filter, update, array_filters=None):
+        return self.repository.update_many(self.scope(filter), self.guard(update), array_filters=array_filters)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, before=False):
+        return self.repository.find_one_and_update(self.scope(filter), self.guard(update, upsert),
+                                                   projection=self.hide(projection), sort=sort, upsert=upsert, before=before)
+
+    def replace_one(self, filter, document, upsert=False):
+        return self.repository.replace_one(self.scope(filter), self.stamp(document), upsert=upsert)
+
+    def delete_one(self, filter):
+        return self.repository.delete_one(self.scope(filter))
+
+    def delete_many(self, filter):
+        return self.repository.delete_many(self.scope(filter))
+
+    def count(self, filter=None, limit=0):
+        return self.repository.count(self.scope(filter), limit)
+
+    def estimated_count(self):
+        # Over every tenant of a shared collection: the metadata count can't be filtered
+        return self.repository.estimated_count()
+
+    def distinct(self, field, filter=None):
+        return self.repository.distinct(field, self.scope(filter))
+
+    def aggregate(self, pipeline):
+        condition = self.condition()
+        if condition is not None:
+            pipeline = [{'$match': {self.field: condition}}] + list(pipeline)
+        return self.repository.aggregate(pipeline)
+
+    def create_index(self, keys, unique=False, expire_after_seconds=None):
+        # Tenant first in every index of a shared collection: each tenant's queries read only its own index range,
+        # and unique indexes become unique per tenant. TTL indexes must stay single-field
+        if self.filtered and expire_after_seconds is None and keys != '_id':
+            keys = [(keys, 1)] if isinstance(keys, str) else list(keys)
+            if keys[0][0] != self.field:
+                keys = [(self.field, 1)] + keys
+        return self.repository.create_index(keys, unique=unique, expire_after_seconds=expire_after_seconds)
+
+    def index_names(self):
+        return self.repository.index_names()
+
+    def watch(self, resume_after=None, max_await_time_ms=None):
+        if self.filtered:
+            # Delete events only carry the _id, so a shared change stream can't be split by tenant; the change
+            # feed falls back to polling, whose reads are filtered
+            raise NotImplementedError('Change streams are not split by tenant in a shared collection')
+        return self.repository.watch(resume_after=resume_after, max_await_time_ms=max_await_time_ms)
+
+    def explain(self, filter=None, sort=None):
+        return self.repository.explain(self.scope(filter), sort)
+
+    def next_id(self):
+        # Highest _id over every tenant of a shared collection, so ids never collide between them
+        return self.repository.next_id()
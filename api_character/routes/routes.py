@@ -1,10 +1,14 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from marshmallow import ValidationError
 from logger.logger_base import Logger
-from flasgger import swag_from
+from routes.docs import swag_from  # flasgger's swag_from, or a no-op when the docs are prebuilt
+from services.delta_sync import parse_cursor
 
 # Define routes for managing characters (add, update, delete, etc.)
 class CharacterRoutes(Blueprint):
+    # Fields a PATCH request may change, each checked with the matching validate_* method
+    PATCH_FIELDS = ('characterName', 'race', 'className', 'alignment', 'level', 'background', 'playerName', 'picture')
+
     def __init__(self, character_service, character_schema):
         super().__init__('character', __name__)  # Initialize the Blueprint
         self.character_service = character_service  # Service to handle database operations
@@ -17,7 +21,16 @@ class CharacterRoutes(Blueprint):
         self.route('/api/v1/characters', methods=['GET'])(self.get_characters)
         self.route('/api/v1/characters', methods=['POST'])(self.add_characters)
         self.route('/api/v1/characters/<int:character_id>', methods=['PUT'])(self.update_character)
+        self.route('/api/v1/characters/<int:character_id>', methods=['PATCH'])(self.patch_character)
         self.route('/api/v1/characters/<int:character_id>', methods=['DELETE'])(self.delete_character)
+        self.route('/api/v1/characters/events', methods=['GET'])(self.stream_events)
+        self.route('/api/v1/characters/changes', methods=['GET'])(self.get_changes)
+        self.route('/api/v1/characters/stats', methods=['GET'])(self.get_stats)
+        self.route('/api/v1/characters/jobs', methods=['POST'])(self.submit_job)
+        self.route('/api/v1/characters/jobs/<job_id>', methods=['GET'])(self.get_job)
+        self.route('/api/v1/characters/export', methods=['GET'])(self.export_characters)
+        self.route('/api/v1/characters/import', methods=['POST'])(self.import_characters)
+        self.route('/api/v1/players/<player_name>', methods=['GET'])(self.get_player_summary)
         self.route('/healthcheck', methods=['GET'])(self.healthcheck)
 
     @swag_from({
@@ -53,11 +66,20 @@ class CharacterRoutes(Blueprint):
                     },
                     'required': ['characterName', 'race', 'className', 'alignment', 'level', 'background', 'playerName', 'picture']  # These fields are required
                 }
+            },
+            {
+                'name': 'Idempotency-Key',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Unique key per logical request; a retry with the same key gets the first response back instead of a duplicate'
             }
         ],
         'responses': {
             201: {'description': 'Character successfully created'},
             400: {'description': 'Invalid data'},
+            409: {'description': 'A request with the same Idempotency-Key is still in progress'},
+            422: {'description': 'The Idempotency-Key was already used for a different request'},
             500: {'description': 'Internal server error'}
         }
     })
@@ -199,6 +221,96 @@ class CharacterRoutes(Blueprint):
             self.logger.error(f'Error updating the character in the database: {e}')
             return jsonify({'error': f'Error updating the character in the database: {e}'}), 500  # Handle any errors
 
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Update only some fields of a character',
+        'parameters': [
+            {
+                'name': 'character_id',
+                'in': 'path',
+                'required': True,
+                'type': 'integer',
+                'description': 'ID of the character to update'
+            },
+            {
+                'name': 'If-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; the update is rejected if the character changed since'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'characterName': {'type': 'string'},
+                        'race': {'type': 'string'},
+                        'className': {'type': 'string'},
+                        'alignment': {'type': 'string'},
+                        'level': {'type': 'string'},
+                        'background': {'type': 'string'},
+                        'playerName': {'type': 'string'},
+                        'picture': {'type': 'string'},
+                    }
+                }
+            }
+        ],
+        'responses': {
+            200: {'description': 'The changed fields, with the new version in the ETag header'},
+            400: {'description': 'Invalid data'},
+            404: {'description': 'Character not found'},
+            412: {'description': 'The character was changed by someone else'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def patch_character(self, character_id):
+        # Update only the fields sent by the client
+        try:
+            request_data = request.json  # Get the changed fields
+
+            if not request_data:
+                return jsonify({'error': 'Invalid data, empty'}), 400  # Check if data is empty
+
+            unknown_fields = sorted(set(request_data) - set(self.PATCH_FIELDS))
+            if unknown_fields:
+                return jsonify({'error': f'Invalid data: unknown fields {unknown_fields}'}), 400
+
+            # Optional optimistic concurrency check against the version the client last saw
+            expected_version = None
+            if_match = request.headers.get('If-Match')
+            if if_match:
+                expected_version = if_match.removeprefix('W/').strip('"')
+                if not expected_version.isdigit():
+                    return jsonify({'error': 'Invalid If-Match header'}), 400
+                expected_version = int(expected_version)
+
+            # Validate only the supplied fields using the schema
+            try:
+                for field, value in request_data.items():
+                    if value is None:
+                        raise ValidationError(f'{field} must not be null')
+                    getattr(self.character_schema, f'validate_{field}')(value)
+            except ValidationError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400  # Return error if validation fails
+
+            changes = dict(request_data)
+            patched_character = self.character_service.patch_character(character_id, changes, expected_version)  # Update the character in the database
+            if patched_character is None:
+                return jsonify({'error': 'Character not found'}), 404  # If character not found, return an error
+            if patched_character is False:
+                return jsonify({'error': 'Character was modified by another request'}), 412  # Version mismatch
+
+            response = jsonify(patched_character)
+            response.headers['ETag'] = f'"{patched_character["updatedAt"]}"'  # New version for the next If-Match
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error patching the character in the database: {e}')
+            return jsonify({'error': f'Error patching the character in the database: {e}'}), 500  # Handle any errors
+
     @swag_from({
         'tags': ['Characters'],
         'parameters': [
@@ -230,6 +342,310 @@ class CharacterRoutes(Blueprint):
             self.logger.error(f'Error deleting the character from the database: {e}')
             return jsonify({'error': f'Error deleting the character from the database: {e}'}), 500  # Handle any errors
         
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Stream characters changes as Server-Sent Events',
+        'parameters': [
+            {
+                'name': 'Last-Event-ID',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Id of the last event received, to replay what was missed while disconnected'
+            }
+        ],
+        'produces': ['text/event-stream'],
+        'responses': {
+            200: {'description': 'Stream of insert, update, replace and delete events'},
+            503: {'description': 'Too many open event streams in this process'}
+        }
+    })
+    def stream_events(self):
+        # Push changes to the client instead of having it poll the list endpoint
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+        change_feed = self.character_service.change_feed
+        if not change_feed.open_stream():
+            # Each open stream holds a server thread, so past the cap the client should come back later
+            response = jsonify({'error': 'Too many open event streams, try again shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        response = Response(change_feed.stream(last_event_id), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Don't let a reverse proxy hold events back
+        })
+        response.call_on_close(change_feed.close_stream)
+        return response
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Character changes since the last sync',
+        'parameters': [
+            {
+                'name': 'since',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Epoch milliseconds, or the next value of the previous response (0 or omitted for everything)'
+            },
+            {
+                'name': 'limit',
+                'in': 'query',
+                'required': False,
+                'type': 'integer',
+                'description': 'Maximum changes per response, 1 to 5000 (default 1000)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Deleted ids and changed characters; apply deleted first, then changed'},
+            400: {'description': 'Invalid since or limit'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_changes(self):
+        # Get only the characters changed or deleted since the given time
+        try:
+            limit = request.args.get('limit', '1000')
+            if not limit.isdigit() or not 1 <= int(limit) <= 5000:
+                return jsonify({'error': 'Invalid data: limit must be between 1 and 5000'}), 400
+            try:
+                since = parse_cursor(request.args.get('since', '0'))  # Epoch milliseconds or the cursor of the last page
+            except ValueError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400
+
+            changes = self.character_service.get_changes(since, int(limit))
+            return jsonify(changes), 200  # Return the changes as JSON
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the character changes: {e}')
+            return jsonify({'error': f'Error fetching the character changes: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Counts of the characters per class and race',
+        'parameters': [
+            {
+                'name': 'If-None-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; answered with 304 while the characters are unchanged'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Total and counts per value, most common first, with the version in the ETag header'},
+            304: {'description': 'The characters did not change since the given ETag'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_stats(self):
+        # Get the dashboard counts, aggregated in the database and cached until the characters change
+        try:
+            stats = self.character_service.get_stats()
+            if isinstance(stats, tuple):
+                return stats  # Error response from the service
+
+            etag = f'"{stats["version"]}"'
+            if etag in request.headers.get('If-None-Match', ''):
+                return '', 304, {'ETag': etag}  # The client's copy is still current
+            response = jsonify(stats)
+            response.headers['ETag'] = etag
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error computing the character stats: {e}')
+            return jsonify({'error': f'Error computing the character stats: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Run a long operation in the background',
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'type': {'type': 'string', 'description': 'Job type: reindex, rebuild-summaries, export or import'},
+                        'params': {'type': 'object', 'description': 'Parameters of the job; export and import take path (a file name in ARCHIVE_DIR), format and, for import, mode'}
+                    },
+                    'required': ['type']
+                }
+            }
+        ],
+        'responses': {
+            202: {'description': 'Job queued; poll the URL in the Location header for its status'},
+            400: {'description': 'Unknown job type or invalid params'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def submit_job(self):
+        # Queue a job for the workers instead of running it inside the request
+        try:
+            request_data = request.json or {}
+            params = request_data.get('params', {})
+            if not isinstance(request_data.get('type'), str) or not isinstance(params, dict):
+                return jsonify({'error': 'Invalid data: type must be a string and params an object'}), 400
+
+            job = self.character_service.submit_job(request_data['type'], params)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            response = jsonify({'_id': job['_id'], 'type': job['type'], 'status': job['status']})
+            response.headers['Location'] = f'/api/v1/characters/jobs/{job["_id"]}'
+            return response, 202
+
+        except Exception as e:
+            self.logger.error(f'Error submitting the character job: {e}')
+            return jsonify({'error': f'Error submitting the character job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Status of a background job',
+        'parameters': [
+            {
+                'name': 'job_id',
+                'in': 'path',
+                'required': True,
+                'type': 'string',
+                'description': 'ID returned when the job was submitted'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Status (queued, running, succeeded or failed), attempts, progress, result and last error'},
+            404: {'description': 'Job not found'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_job(self, job_id):
+        # Get the status and progress of a job
+        try:
+            job = self.character_service.get_job(job_id)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            if not job:
+                return jsonify({'error': 'Job not found'}), 404
+            return jsonify(job), 200
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the character job: {e}')
+            return jsonify({'error': f'Error fetching the character job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Download every character as a compressed archive',
+        'produces': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Gzip stream of a header record followed by the characters, sent as it is read'},
+            400: {'description': 'Unknown format'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def export_characters(self):
+        # Stream the archive so neither side holds the whole collection in memory
+        try:
+            archive_format = request.args.get('format', 'bson')
+            chunks = self.character_service.export_archive(archive_format)
+            if isinstance(chunks, tuple):
+                return chunks  # Error response from the service
+            return Response(chunks, mimetype='application/gzip', headers={
+                'Content-Disposition': f'attachment; filename="characters.{archive_format}.gz"',
+            })
+
+        except Exception as e:
+            self.logger.error(f'Error exporting the characters: {e}')
+            return jsonify({'error': f'Error exporting the characters: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Load characters from a compressed archive',
+        'consumes': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            },
+            {
+                'name': 'mode',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['upsert', 'insert'],
+                'description': 'upsert replaces characters with the same ID (default); insert is faster but fails on existing IDs'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {'type': 'string', 'format': 'binary'},
+                'description': 'Archive as written by the export endpoint'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Number of characters imported'},
+            400: {'description': 'Unknown format or mode, or not a characters archive'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def import_characters(self):
+        # Import the archive in batches while the body is still arriving; larger files go through an import job
+        try:
+            result = self.character_service.import_archive(
+                request.stream, request.args.get('format', 'bson'), request.args.get('mode', 'upsert'),
+            )
+            if isinstance(result, tuple):
+                return result  # Error response from the service
+            return jsonify(result), 200
+
+        except Exception as e:
+            self.logger.error(f'Error importing the characters: {e}')
+            return jsonify({'error': f'Error importing the characters: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Characters'],
+        'summary': 'Characters of a player and the campaigns they appear in',
+        'parameters': [
+            {
+                'name': 'player_name',
+                'in': 'path',
+                'required': True,
+                'type': 'string',
+                'description': 'playerName of the characters'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Materialized summary: the characters and, per campaign, the character playing it'},
+            404: {'description': 'Player not found'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_player_summary(self, player_name):
+        # Get the landing page data of a player, kept up to date on every character and campaign write
+        try:
+            summary = self.character_service.get_player_summary(player_name)
+            if isinstance(summary, tuple):
+                return summary  # Error response from the service
+            if not summary:
+                return jsonify({'error': 'Player not found'}), 404
+            return jsonify(summary), 200
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the player summary: {e}')
+            return jsonify({'error': f'Error fetching the player summary: {e}'}), 500  # Handle any errors
+
     @swag_from({
         'tags': ['Health'],
         'responses': {
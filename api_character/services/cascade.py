@@ -0,0 +1,136 @@
+import os
+import queue
+import threading
+import time
+
+from logger.logger_base import Logger
+from models.tenancy import current_tenant, tenant_scope
+from services.delta_sync import now_ms
+
+STOP = object()  # Tells the worker thread to apply what is left and exit
+
+
+class Flush:
+    # Marker queued behind the jobs that must be applied before the caller continues
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class CascadeQueue:
+    # Applies character renames and deletions to the campaign rosters (campaigns.pc) from a background thread,
+    # so the character write doesn't wait on however many campaigns name the character
+    # Jobs stay in memory until applied: a crash loses what is still queued, which the orphan scan then reports
+    def __init__(self, db_conn, summaries=None, max_pending=10000, attempts=3):
+        self.logger = Logger()  # Logger for logging messages
+        self.characters = db_conn.repository('characters')
+        self.campaigns = db_conn.foreign('campaigns', 'The cascade of character renames and deletions')
+        self.summaries = summaries  # Campaign summaries to refresh after their roster changed
+        self.attempts = attempts  # Tries per job before it is logged and dropped
+        self.queue = queue.Queue(maxsize=max_pending)  # Full queue blocks the writer instead of growing without limit
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)  # Signalled when no enqueue is between its closed check and its put
+        self.putting = 0  # Enqueues past the closed check whose put hasn't returned yet
+        self.thread = None
+        self.closed = False
+
+    @classmethod
+    def from_environment(cls, db_conn, summaries=None):
+        # Cascading is on by default; CASCADE=0 leaves the campaigns as they are
+        if os.environ.get('CASCADE', '1').lower() in ('0', 'false', 'no'):
+            return None
+        return cls(db_conn, summaries, max_pending=int(os.environ.get('CASCADE_MAX_PENDING', 10000)))
+
+    def rename(self, old_name, new_name):
+        # Queue the rename of a character in every campaign that lists it
+        if old_name and new_name and old_name != new_name:
+            self.enqueue(('rename', old_name, new_name, current_tenant.get()))
+
+    def delete(self, name):
+        # Queue the removal of a character from every campaign that lists it
+        if name:
+            self.enqueue(('delete', name, None, current_tenant.get()))
+
+    def enqueue(self, job):
+        with self.lock:
+            # Checked under the lock so close() can't queue STOP between the check and the put
+            closed = self.closed
+            if not closed:
+                self.putting += 1
+        if closed:
+            self.apply(job)  # Shutting down, apply it directly
+            return
+        try:
+            self.start()
+            self.queue.put(job)
+        finally:
+            with self.lock:
+                self.putting -= 1
+                self.idle.notify_all()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='campaign-cascade', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is STOP:
+                return
+            if isinstance(job, Flush):
+                job.done.set()
+                continue
+            for attempt in range(self.attempts):
+                try:
+                    self.apply(job)
+                    break
+                except Exception as e:
+                    if attempt == self.attempts - 1:
+                        self.logger.error(f'Campaign cascade {job} was not applied: {e}')
+                    else:
+                        time.sleep(0.1 * 2 ** attempt)  # Back off on transient errors
+
+    def apply(self, job):
+        # Applied as the tenant of the character write that queued it
+        action, name, new_name, tenant = job
+        with tenant_scope(tenant):
+            self.apply_to_campaigns(action, name, new_name)
+
+    def apply_to_campaigns(self, action, name, new_name):
+        # Another character may still carry the name, and then the campaigns keep it
+        if self.characters.count({'characterName': name}, limit=1):
+            return
+        campaign_ids = self.campaigns.distinct('_id', {'pc.characterName': name})
+        if not campaign_ids:
+            return
+        # One update_many for every campaign; updatedAt lets delta sync and the other caches see the change
+        query = {'_id': {'$in': campaign_ids}, 'pc.characterName': name}
+        if action == 'rename':
+            self.campaigns.update_many(query, {'$set': {'pc.$[member].characterName': new_name, 'updatedAt': now_ms()}},
+                                       array_filters=[{'member.characterName': name}])
+        else:
+            self.campaigns.update_many(query, {'$pull': {'pc': {'characterName': name}}, '$set': {'updatedAt': now_ms()}})
+        if self.summaries:
+            for campaign_id in campaign_ids:
+                self.summaries.sync_campaign(campaign_id)
+
+    def flush(self):
+        # Block until everything queued so far is applied
+        if self.thread is None or self.closed:
+            return
+        marker = Flush()
+        self.queue.put(marker)
+        marker.done.wait()
+
+    def close(self):
+        # Apply everything still queued; called on shutdown before the connection is closed
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.idle.wait_for(lambda: not self.putting)  # Jobs already past the closed check go in ahead of STOP
+            thread = self.thread
+        if thread:
+            self.queue.put(STOP)
+            thread.join()
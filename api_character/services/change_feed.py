@@ -0,0 +1,307 @@
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+from pymongo.errors import OperationFailure, PyMongoError
+from logger.logger_base import Logger
+from models.tenancy import current_tenant, tenant_scope
+from services.delta_sync import SAFETY_WINDOW_MS, now_ms
+
+# Changed documents read in full per query while polling
+POLL_BATCH = 500
+# Ids of recently published documents kept in polling mode to tell replaces from inserts
+RECENT_IDS = 10000
+
+
+class ChangeFeed:
+    # One background watcher per worker that fans collection changes out to Server-Sent Events subscribers
+    # With tenancy on, each tenant gets its own feed (and watcher) reading only that tenant's documents
+    def __init__(self, repository, tombstones, collection_name, poll_interval=None, history_size=500, heartbeat=15, tenant=None,
+                 max_streams=None, streams=None):
+        self.logger = Logger()  # Logger for logging messages
+        self.repository = repository  # Storage of the watched collection
+        self.tombstones = tombstones  # Deletion records of delta sync, read while polling
+        self.collection_name = collection_name  # Collection to watch
+        self.poll_interval = poll_interval or float(os.environ.get('CHANGE_FEED_POLL_INTERVAL', 2))
+        self.heartbeat = heartbeat  # Seconds between keep-alive comments
+        self.history = deque(maxlen=history_size)  # Recent events, replayed to clients that reconnect
+        self.subscribers = set()  # One queue per connected client
+        self.lock = threading.Lock()
+        self.thread = None
+        self.mode = None  # 'change_stream' or 'polling', decided when the watcher starts
+        self.resume_token = None  # Last change stream position, so a restarted watcher doesn't miss events
+        self.sequence = itertools.count(1)  # Event ids in polling mode
+        self.tenant = tenant  # Tenant whose documents this feed watches, None for the whole collection
+        self.tenant_feeds = OrderedDict()  # Tenant -> its feed, created on its first subscriber, least recently used first
+        self.max_tenant_feeds = int(os.environ.get('CHANGE_FEED_MAX_TENANTS', 100))  # Idle feeds beyond this are dropped
+        # Every open stream holds a server thread until the client leaves, so a process serves only so many
+        # (CHANGE_FEED_MAX_STREAMS, well under gunicorn's --threads); tenant feeds share the limit of their parent
+        self.streams = streams or threading.BoundedSemaphore(max_streams or int(os.environ.get('CHANGE_FEED_MAX_STREAMS', 8)))
+        self.first_new_id = None  # Polling mode: lowest id a document inserted after the watcher started can have
+        self.recent_ids = OrderedDict()  # Polling mode: ids published lately, at most RECENT_IDS
+
+    def subscribe(self):
+        # Register a new client queue and make sure the watcher is running
+        subscriber = queue.Queue(maxsize=1000)
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f'{self.collection_name}-change-feed', daemon=True)
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def open_stream(self):
+        # Take one of the process's stream slots for a new client; False when they are all in use
+        return self.streams.acquire(blocking=False)
+
+    def close_stream(self):
+        # Give the slot back once the response is closed, which also happens when the client disconnects
+        self.streams.release()
+
+    def idle(self):
+        with self.lock:
+            return not self.subscribers and self.thread is None
+
+    def publish(self, event):
+        # Keep the event for reconnecting clients and hand it to every subscriber
+        with self.lock:
+            self.history.append(event)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                self.drop(subscriber)
+
+    def drop(self, subscriber):
+        # A client that stopped reading is cut off; it reconnects with Last-Event-ID and catches up
+        self.unsubscribe(subscriber)
+        with subscriber.mutex:
+            subscriber.queue.clear()
+        subscriber.put_nowait(None)
+
+    def keep_running(self):
+        # Called by the watcher between events; it stops once the last client has left
+        with self.lock:
+            if self.subscribers:
+                return True
+            self.thread = None  # The next subscriber starts a fresh watcher
+            return False
+
+    def tenant_feed(self, tenant):
+        # The feed of a tenant; this feed itself without tenancy
+        if tenant is None or tenant == self.tenant:
+            return self
+        with self.lock:
+            feed = self.tenant_feeds.get(tenant)
+            if feed is not None:
+                self.tenant_feeds.move_to_end(tenant)
+                return feed
+            feed = self.tenant_feeds[tenant] = ChangeFeed(self.repository, self.tombstones, self.collection_name, self.poll_interval,
+                                                          self.history.maxlen, self.heartbeat, tenant=tenant, streams=self.streams)
+            # Forget the least recently used feeds without clients; a tenant coming back gets a fresh one
+            for name in [name for name, other in self.tenant_feeds.items() if other.idle()]:
+                if len(self.tenant_feeds) <= self.max_tenant_feeds:
+                    break
+                del self.tenant_feeds[name]
+            return feed
+
+    def run(self):
+        # The watcher thread reads as the feed's tenant
+        with tenant_scope(self.tenant):
+            self.watch()
+
+    def watch(self):
+        # Prefer a change stream, fall back to polling on servers without one (a standalone mongod, the memory engine,
+        # a collection shared by tenants)
+        try:
+            if self.mode != 'polling':
+                self.watch_change_stream()
+                return
+        except Exception as e:
+            if self.mode == 'change_stream':
+                self.logger.error(f'Change feed for {self.collection_name} stopped: {e}')
+                self.stop()
+                return
+            # Opening the stream failed, so the server (or client library) doesn't support it
+            self.logger.warning(f'Change streams unavailable for {self.collection_name}, polling instead: {e}')
+            self.mode = 'polling'
+        try:
+            self.poll()
+        except Exception as e:
+            self.logger.error(f'Change feed for {self.collection_name} stopped: {e}')
+            self.stop()
+
+    def stop(self):
+        # Disconnect every client after an unrecoverable error so they reconnect and start a new watcher
+        with self.lock:
+            subscribers = list(self.subscribers)
+            self.thread = None
+        for subscriber in subscribers:
+            self.drop(subscriber)
+
+    def watch_change_stream(self):
+        while True:
+            try:
+                with self.repository.watch(resume_after=self.resume_token, max_await_time_ms=1000) as stream:
+                    self.mode = 'change_stream'
+                    while True:
+                        if not self.keep_running():
+                            return
+                        change = stream.try_next()
+                        if change is not None:
+                            self.resume_token = stream.resume_token
+                            self.publish(self.from_change(change))
+            except OperationFailure as e:
+                if self.mode != 'change_stream':
+                    raise  # The server doesn't support change streams at all
+                # The stored position may have fallen off the oplog; continue from now
+                self.logger.warning(f'Restarting change stream for {self.collection_name}: {e}')
+                self.resume_token = None
+            except PyMongoError as e:
+                self.logger.warning(f'Change stream for {self.collection_name} interrupted, resuming: {e}')
+                time.sleep(1)
+
+    def from_change(self, change):
+        # Reduce a change stream document to the event sent to clients
+        operation = change['operationType']
+        event = {'id': change['_id']['_data'], 'operation': operation, '_id': change.get('documentKey', {}).get('_id')}
+        if operation in ('insert', 'replace'):
+            event['document'] = change.get('fullDocument')
+        elif operation == 'update':
+            # Only the changed fields are sent, so a new picture isn't resent on every edit
+            description = change.get('updateDescription', {})
+            event['updatedFields'] = description.get('updatedFields', {})
+            event['removedFields'] = description.get('removedFields', [])
+        return event
+
+    def poll(self):
+        # Oplog-free fallback: read what changed since the last poll from the updatedAt index and the delta sync
+        # tombstones; only the documents that changed are read in full
+        # Ids are sequential, so a document is new when its id is past the highest one at the start or it was never
+        # published before; no set of every id in the collection is kept
+        self.first_new_id = self.repository.next_id()
+        self.recent_ids.clear()
+        since = now_ms() - SAFETY_WINDOW_MS
+        recent = self.read_changes(since)[2]  # Changes the next poll reads again but are not news to the clients
+        while True:
+            time.sleep(self.poll_interval)
+            if not self.keep_running():
+                return
+            try:
+                since, recent = self.poll_changes(since, recent)
+            except PyMongoError as e:
+                self.logger.warning(f'Polling {self.collection_name} failed, retrying: {e}')
+
+    def read_changes(self, since):
+        # Tombstones and the _id and updatedAt of the changed documents, from the indexes, plus a key for each
+        deleted = list(self.tombstones.find({'collection': self.collection_name, 'deletedAt': {'$gte': since}},
+                                            {'documentId': 1, 'deletedAt': 1}, sort=[('deletedAt', 1), ('_id', 1)]))
+        changed = list(self.repository.find({'updatedAt': {'$gte': since}}, {'updatedAt': 1}, sort=[('updatedAt', 1), ('_id', 1)]))
+        seen = {('deleted', tombstone['documentId'], tombstone['deletedAt']) for tombstone in deleted}
+        seen.update(('changed', document['_id'], document['updatedAt']) for document in changed)
+        return deleted, changed, seen
+
+    def poll_changes(self, since, recent):
+        # Publish the deletions, then the changes, stamped at or after since; returns the next since and the changes
+        # it will read again, as writes stamped just before a poll may commit just after it
+        now = now_ms()
+        deleted, changed, seen = self.read_changes(since)
+        for tombstone in deleted:
+            if ('deleted', tombstone['documentId'], tombstone['deletedAt']) not in recent:
+                self.recent_ids.pop(tombstone['documentId'], None)
+                self.publish(self.polled_event('delete', tombstone['documentId']))
+        fresh = [document['_id'] for document in changed if ('changed', document['_id'], document['updatedAt']) not in recent]
+        for start in range(0, len(fresh), POLL_BATCH):
+            ids = fresh[start:start + POLL_BATCH]
+            documents = {document['_id']: document for document in self.repository.find({'_id': {'$in': ids}})}
+            for document_id in ids:
+                if document_id in documents:  # Not deleted again since
+                    operation = 'replace' if self.existed(document_id) else 'insert'
+                    self.publish(self.polled_event(operation, document_id, documents[document_id]))
+                    self.recent_ids[document_id] = True
+                    self.recent_ids.move_to_end(document_id)
+                    if len(self.recent_ids) > RECENT_IDS:
+                        self.recent_ids.popitem(last=False)
+
+        since = max(since, now - SAFETY_WINDOW_MS)
+        return since, {key for key in seen if key[2] >= since}
+
+    def existed(self, document_id):
+        # Whether a changed document was there before, i.e. its event is a replace rather than an insert
+        if document_id in self.recent_ids:
+            return True
+        return not (isinstance(document_id, int) and self.first_new_id is not None and document_id >= self.first_new_id)
+
+    def polled_event(self, operation, document_id, document=None):
+        event = {'id': f'poll-{next(self.sequence)}', 'operation': operation, '_id': document_id}
+        if document is not None:
+            event['document'] = document
+        return event
+
+    def catch_up(self, last_event_id):
+        # Events a reconnecting client missed, or None when they can no longer be replayed
+        with self.lock:
+            ids = [event['id'] for event in self.history]
+            if last_event_id in ids:
+                return list(self.history)[ids.index(last_event_id) + 1:]
+        if self.mode != 'change_stream' or last_event_id.startswith('poll-'):
+            return None
+        # The id is a resume token from another worker or an older stream; read the gap from the oplog
+        missed = []
+        try:
+            with self.repository.watch(resume_after={'_data': last_event_id}, max_await_time_ms=100) as stream:
+                change = stream.try_next()
+                while change is not None and len(missed) < self.history.maxlen:
+                    missed.append(self.from_change(change))
+                    change = stream.try_next()
+        except PyMongoError:
+            return None
+        return missed
+
+    def stream(self, last_event_id=None):
+        # Server-Sent Events text for one client, from the feed of the request's tenant
+        # The feed is picked now: the generator runs after the request's tenant scope has ended
+        return self.tenant_feed(current_tenant.get()).events(last_event_id)
+
+    def events(self, last_event_id=None):
+        # Generator of Server-Sent Events text for one client
+        subscriber = self.subscribe()
+        sent = set()
+        try:
+            yield f'retry: {int(self.poll_interval * 1000)}\n\n'
+            if last_event_id:
+                with tenant_scope(self.tenant):
+                    missed = self.catch_up(last_event_id)
+                if missed is None:
+                    # Too far behind to replay; the client should reload the list
+                    yield self.format({'id': last_event_id, 'operation': 'reset'})
+                else:
+                    for event in missed:
+                        sent.add(event['id'])
+                        yield self.format(event)
+            while True:
+                try:
+                    event = subscriber.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                if event is None:
+                    return  # Dropped for falling behind
+                if event['id'] in sent:
+                    continue  # Already delivered while catching up
+                yield self.format(event)
+        finally:
+            self.unsubscribe(subscriber)
+
+    def format(self, event):
+        data = json.dumps({key: value for key, value in event.items() if key != 'id'}, default=str)
+        return f'id: {event["id"]}\nevent: change\ndata: {data}\n\n'
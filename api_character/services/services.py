@@ -1,17 +1,48 @@
 # Import necessary modules
 from flask import jsonify
 from logger.logger_base import Logger
+from services.change_feed import ChangeFeed
+from services.archive import export_archive, import_archive, archive_path
+from services.delta_sync import now_ms, ensure_sync_indexes, record_tombstone, get_changes
+from services.jobs import JobQueue
+from services.stats import StatsCache, count_by, facet_counts
+from services.summaries import SummaryStore, CHARACTER_FIELDS
+from services.cascade import CascadeQueue
 
 class CharacterService:
     def __init__(self, db_conn):
         # Set up logging and database connection
         self.logger = Logger()  # Logger for logging messages
         self.db_conn = db_conn  # Database connection
+        self.repository = db_conn.repository('characters')  # Storage of the characters
+        self.tombstones = db_conn.repository('tombstones')  # Deletion records used by delta sync
+        self.change_feed = ChangeFeed(self.repository, self.tombstones, 'characters')  # Pushes collection changes to event stream clients
+        self.stats = StatsCache(self.repository, self.compute_stats)  # Dashboard stats, recomputed after writes
+        self.summaries = SummaryStore(db_conn)  # Per-player and per-campaign summaries for the landing page
+        self.cascade = CascadeQueue.from_environment(db_conn, self.summaries)  # Renames and deletions applied to campaigns.pc
+        # Long operations run off the request path; JOB_WORKERS threads or `python -m services.jobs` run them
+        self.jobs = JobQueue.from_environment(db_conn, 'characters', {
+            'reindex': self.reindex_job,
+            'rebuild-summaries': self.rebuild_summaries_job,
+            'export': self.export_job,
+            'import': self.import_job,
+        })
+
+    def ensure_indexes(self):
+        try:
+            # updatedAt and tombstone indexes used by delta sync
+            ensure_sync_indexes(self.repository, self.tombstones)
+            self.jobs.ensure_indexes()  # Job claims and the cleanup of finished jobs
+            # Indexes of the summaries, built from the stored data on their first start
+            self.summaries.ensure_indexes()
+        except Exception as e:
+            # Indexes only speed things up, so log and keep serving
+            self.logger.error(f'Error creating the character indexes: {e}')
 
     def get_all_characters(self):
         try:
             # Fetch all characters from the database and return them as a list
-            characters = list(self.db_conn.db.characters.find())
+            characters = list(self.repository.find())
             return characters
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -20,14 +51,15 @@ class CharacterService:
 
     def add_character(self, new_character):
         try:
-            # Try to get the highest ID in the collection
-            max_character = self.db_conn.db.characters.find_one(sort=[('_id', -1)])
-            # If a character exists, increment its ID by 1; otherwise, start from 1
-            next_id = max_character['_id'] + 1 if max_character else 1
+            # Highest ID in the collection plus one, or 1 for the first character
+            next_id = self.repository.next_id()
             # Assign the new ID to the character
             new_character['_id'] = next_id  
+            new_character['updatedAt'] = now_ms()  # Change time used by delta sync
             # Insert the new character into the database
-            self.db_conn.db.characters.insert_one(new_character)
+            self.repository.insert_one(new_character)
+            self.stats.invalidate()  # The cached stats are out of date
+            self.summaries.sync_character(next_id)  # List the character in the summaries
             
             # Return the newly added character
             return new_character
@@ -42,7 +74,7 @@ class CharacterService:
     def get_character_by_id(self, character_id):
         try:
             # Fetch a specific character by its ID from the database
-            character_data = self.db_conn.db.characters.find_one({'_id': character_id})
+            character_data = self.repository.find_one({'_id': character_id})
             return character_data  # Return the character data
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -51,16 +83,19 @@ class CharacterService:
         
     def update_character(self, character_id, character_data):
         try:
-            # First, check if the character exists
-            update_character = self.get_character_by_id(character_id)
-
-            if update_character:
-                # If the character exists, update it with the new data
-                updated_character = self.db_conn.db.characters.update_one({'_id': character_id}, {'$set': character_data})
-                if updated_character.modified_count > 0:
-                    return updated_character  # Return the updated character
-                else:
-                    return 'The character is already up-to-date'  # No changes made
+            character_data['updatedAt'] = now_ms()  # Change time used by delta sync
+            # Update the character and read its old name in the same round-trip: the old name is what a rename
+            # cascades from, and a separate read could see another write's name instead
+            previous = self.repository.find_one_and_update(
+                {'_id': character_id}, {'$set': character_data}, projection=['characterName'], before=True
+            )
+
+            if previous:
+                self.stats.invalidate()  # The cached stats are out of date
+                self.summaries.sync_character(character_id)  # Refresh the character in the summaries
+                if self.cascade:
+                    self.cascade.rename(previous.get('characterName'), character_data.get('characterName'))
+                return 1  # One character updated (updatedAt always changes)
             else:
                 return None  # Character not found
             
@@ -69,6 +104,35 @@ class CharacterService:
             self.logger.error(f'Error updating the character: {e}')
             return jsonify({'error': f'Error updating the character: {e}'}), 500
         
+    def patch_character(self, character_id, changes, expected_version=None):
+        try:
+            # Only match the version the client saw, when it sent one
+            query = {'_id': character_id}
+            if expected_version is not None:
+                query['updatedAt'] = expected_version
+
+            changes['updatedAt'] = now_ms()  # Change time used by delta sync, also the new version
+            # Set only the changed fields and read back their old values in the same round-trip: the old name is
+            # what a rename cascades from, and a separate read could see another write's name instead
+            previous = self.repository.find_one_and_update(query, {'$set': changes}, projection=list(changes), before=True)
+            patched_character = {'_id': previous['_id'], **changes} if previous else None  # The changed fields as stored now
+            renamed_from = previous.get('characterName') if previous and self.cascade and 'characterName' in changes else None
+            self.stats.invalidate()  # The cached stats are out of date
+            if patched_character and set(CHARACTER_FIELDS) & set(changes):
+                self.summaries.sync_character(character_id)  # Only when a summarized field changed
+            if patched_character and renamed_from:
+                self.cascade.rename(renamed_from, changes['characterName'])
+            if patched_character:
+                return patched_character  # Return the changed fields
+            if expected_version is not None and self.repository.count({'_id': character_id}, limit=1):
+                return False  # The character exists but has a newer version
+            return None  # Character not found
+
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error patching the character: {e}')
+            return jsonify({'error': f'Error patching the character: {e}'}), 500
+
     def delete_character(self, character_id):
         try:
             # Check if the character exists before deleting
@@ -76,7 +140,12 @@ class CharacterService:
             
             if deleted_character:
                 # If the character exists, delete it from the database
-                self.db_conn.db.characters.delete_one({'_id': character_id})
+                self.repository.delete_one({'_id': character_id})
+                self.stats.invalidate()  # The cached stats are out of date
+                self.summaries.sync_character(character_id)  # Drop the character from the summaries
+                if self.cascade:
+                    self.cascade.delete(deleted_character.get('characterName'))  # Take it off the campaign rosters
+                record_tombstone(self.tombstones, 'characters', character_id)  # Let offline clients sync the deletion
                 return deleted_character  # Return the deleted character data
             else:
                 return None  # Character not found
@@ -86,6 +155,114 @@ class CharacterService:
             self.logger.error(f'Error deleting the character data: {e}')
             return jsonify({'error': f'Error deleting the character data: {e}'}), 500
 
+    def compute_stats(self):
+        # Characters per class and per race
+        return facet_counts(self.repository, {'byClass': count_by('$className'), 'byRace': count_by('$race')})
+
+    def get_stats(self):
+        try:
+            # Cached aggregated stats with their version, recomputed only when the characters changed
+            return self.stats.get()
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing the character stats: {e}')
+            return jsonify({'error': f'Error computing the character stats: {e}'}), 500
+
+    def get_player_summary(self, player_name):
+        try:
+            # Fetch the materialized player summary, a single read by _id
+            return self.summaries.get_player(player_name)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the player summary: {e}')
+            return jsonify({'error': f'Error fetching the player summary: {e}'}), 500
+
+    def submit_job(self, job_type, params):
+        try:
+            # Queue a background job; the response only carries its id and status
+            return self.jobs.submit(job_type, params)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown job type
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error submitting the character job: {e}')
+            return jsonify({'error': f'Error submitting the character job: {e}'}), 500
+
+    def get_job(self, job_id):
+        try:
+            # Fetch a job of this service with its status, progress and result
+            return self.jobs.get(job_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the character job: {e}')
+            return jsonify({'error': f'Error fetching the character job: {e}'}), 500
+
+    def reindex_job(self, context, params):
+        # Job handler: create the indexes and run the backfills again, e.g. after restoring a dump
+        self.ensure_indexes()
+        return {'indexes': sorted(self.repository.index_names())}
+
+    def rebuild_summaries_job(self, context, params):
+        # Job handler: recompute the player and campaign summaries from scratch
+        return self.summaries.rebuild(progress=context.progress)
+
+    def export_archive(self, archive_format):
+        try:
+            # Compressed archive of every character, produced chunk by chunk while the response is sent
+            return export_archive(self.repository, 'characters', archive_format)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error exporting the characters: {e}')
+            return jsonify({'error': f'Error exporting the characters: {e}'}), 500
+
+    def import_archive(self, stream, archive_format, mode):
+        try:
+            # Import an archive read from the request body as it arrives
+            return self.load_archive(stream, archive_format, mode)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format or mode, or not a characters archive
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error importing the characters: {e}')
+            return jsonify({'error': f'Error importing the characters: {e}'}), 500
+
+    def load_archive(self, stream, archive_format, mode, progress=None):
+        # Import an archive, then bring what is derived from the characters up to date
+        counts = import_archive(stream, self.repository, 'characters', archive_format, mode, progress=progress)
+        self.ensure_indexes()  # Backfills the derived fields of characters from older archives
+        self.summaries.rebuild()  # The imported characters replace what the summaries were built from
+        self.stats.invalidate()
+        return counts
+
+    def export_job(self, context, params):
+        # Job handler: write an archive into ARCHIVE_DIR
+        archive_format = params.get('format', 'bson')
+        with open(archive_path(params.get('path')), 'wb') as archive:
+            for chunk in export_archive(self.repository, 'characters', archive_format):
+                archive.write(chunk)
+            return {'path': archive.name, 'format': archive_format, 'bytes': archive.tell()}
+
+    def import_job(self, context, params):
+        # Job handler: import an archive from ARCHIVE_DIR, for archives too large to send in one request
+        with open(archive_path(params.get('path')), 'rb') as archive:
+            return self.load_archive(archive, params.get('format', 'bson'), params.get('mode', 'upsert'), progress=context.progress)
+
+    def get_changes(self, since, limit):
+        try:
+            # Fetch only the characters changed or deleted since the client's last sync
+            return get_changes(self.repository, self.tombstones, 'characters', since, limit)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the character changes: {e}')
+            return jsonify({'error': f'Error fetching the character changes: {e}'}), 500
+
+    def close(self):
+        # Apply queued campaign cascades; called on shutdown before the database connection is closed
+        if self.cascade:
+            self.cascade.close()
+
 # Main block of code for testing the CharacterService
 if __name__ == '__main__':
     from models.models import CharacterModel
@@ -0,0 +1,49 @@
+from models.tenancy import current_tenant
+
+
+def count_by(expression, unwind=None):
+    # Pipeline stages counting the documents per value of an expression, most common first
+    stages = [{'$unwind': unwind}] if unwind else []
+    return stages + [{'$group': {'_id': expression, 'count': {'$sum': 1}}}, {'$sort': {'count': -1, '_id': 1}}]
+
+
+def facet_counts(repository, facets):
+    # Every breakdown plus the total in a single $facet aggregation
+    # facets: {'byStatus': count_by('$status'), ...} -> {'total': 12, 'byStatus': [{'value': 'ongoing', 'count': 7}, ...]}
+    pipeline = [{'$facet': dict(facets, total=[{'$count': 'count'}])}]
+    result = list(repository.aggregate(pipeline))
+    result = result[0] if result else {}
+    stats = {'total': result['total'][0]['count'] if result.get('total') else 0}
+    for name in facets:
+        stats[name] = [{'value': row['_id'], 'count': row['count']} for row in result.get(name, [])]
+    return stats
+
+
+def collection_version(repository):
+    # Document count from the collection metadata plus the latest updatedAt read from its index, so no scan
+    # Any insert, update or delete changes it, whichever worker or service made it; in a collection shared by
+    # tenants the count covers all of them, so another tenant's insert or delete only costs a recompute
+    latest = repository.find_one(projection={'updatedAt': 1}, sort=[('updatedAt', -1)])
+    return f'{repository.estimated_count()}-{latest.get("updatedAt", 0) if latest else 0}'
+
+
+class StatsCache:
+    # Last stats computed for a collection, reused until the collection changes
+    # One entry per tenant, as each tenant sees only its own documents
+    def __init__(self, repository, compute):
+        self.repository = repository  # Collection the stats describe
+        self.compute = compute  # Function that runs the aggregation
+        self.entries = {}  # Tenant -> last stats, with the version they were computed at
+
+    def get(self):
+        # Stats and their version, computing them only when the version moved since last time
+        tenant = current_tenant.get()
+        version = collection_version(self.repository)
+        entry = self.entries.get(tenant)
+        if entry is None or entry['version'] != version:
+            entry = self.entries[tenant] = dict(self.compute(), version=version)
+        return entry
+
+    def invalidate(self):
+        # Called after this worker's own writes
+        self.entries.pop(current_tenant.get(), None)
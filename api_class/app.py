@@ -1,34 +1,51 @@
 # Import necessary modules
+import atexit
+
 from flask import Flask
 
 from models.models import ClassModel  # Import the model to interact with the database
 from services.services import ClassService  # Import the service to handle business logic
 from schemas.schemas import ClassSchema  # Import the schema for data validation
 from routes.routes import ClassRoutes  # Import the routes to manage the API endpoints
-from flasgger import Swagger  # Import Swagger for API documentation
+from middleware.rate_limit import RateLimiter  # Import the per-client rate limiter
+from middleware.tenant import TenantResolver  # Import the tenant selection for TENANCY
+from middleware.idempotency import IdempotencyKeys  # Import the Idempotency-Key replay for POST retries
+from middleware.tracing import init_tracing, traced  # Import the opt-in request tracing
+from routes.docs import init_docs  # Import the API documentation setup
+from routes.debug import init_debug  # Import the config-protected diagnostics routes
 
 from flask_cors import CORS  # Import CORS to handle cross-origin requests
 
 # Initialize the Flask application
 app = Flask(__name__)
 CORS(app)  # Enable Cross-Origin Resource Sharing for the app
+RateLimiter.from_environment(app)  # Throttle each client and shed load before the routes run
+init_tracing(app, 'class-api')  # Record spans for each request when TRACING is set (before the database connects)
 
-# Set up Swagger for automatic API documentation
-swagger = Swagger(app)
+# Set up the API documentation: live Swagger, a prebuilt static spec or none (API_DOCS)
+swagger = init_docs(app)
 
 # Initialize the database connection
 db_conn = ClassModel()
 db_conn.connect_to_database()  # Connect to the database
+TenantResolver.from_environment(app, db_conn)  # Scope each API request to its tenant (when TENANCY is set)
+IdempotencyKeys.from_environment(app, db_conn, 'classes')  # Answer retried POSTs with the stored response
 
 # Initialize the service with the database connection
 class_service = ClassService(db_conn)
+class_service.ensure_indexes()  # Create the indexes used by the service
+db_conn.on_new_tenant(class_service.ensure_indexes)  # Same indexes in each tenant database
 
 # Initialize the schema for data validation
 class_schema = ClassSchema()
 
 # Initialize the routes for the API and register them
-class_routes = ClassRoutes(class_service, class_schema)
+class_routes = ClassRoutes(traced(class_service), traced(class_schema))
 app.register_blueprint(class_routes)  # Register the routes with the Flask app
+init_debug(app, db_conn.profiler)  # Slow-query report at /debug/slow-queries when DEBUG_ENDPOINTS is set
+
+# Gunicorn workers exit through sys.exit on a graceful shutdown, which runs atexit handlers
+atexit.register(db_conn.close_connection)
 
 # Start the Flask app
 if __name__ == '__main__':
@@ -0,0 +1,207 @@
+from abc import ABC, abstractmethod
+
+from pymongo import ReplaceOne, ReturnDocument
+
+
+class Repository(ABC):
+    # Storage operations the services rely on, in MongoDB query and update syntax
+    # Implementations: MongoRepository (PyMongo) and MemoryRepository (in-process engine)
+    @abstractmethod
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        # Iterate over the matching documents
+        ...
+
+    @abstractmethod
+    def find_one(self, filter=None, projection=None, sort=None):
+        # First matching document, or None
+        ...
+
+    @abstractmethod
+    def insert_one(self, document):
+        ...
+
+    @abstractmethod
+    def insert_many(self, documents):
+        ...
+
+    @abstractmethod
+    def upsert_many(self, documents):
+        # Insert or replace each document by its _id, in one round-trip
+        ...
+
+    @abstractmethod
+    def update_one(self, filter, update, upsert=False, array_filters=None):
+        # Apply an update document ({'$set': ...}) to the first match; returns the number modified
+        ...
+
+    @abstractmethod
+    def update_many(self, filter, update, array_filters=None):
+        # Apply an update document to every match; returns the number modified
+        ...
+
+    @abstractmethod
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, before=False):
+        # Update the first match and return it as it is after the update (before=True: as it was before), or None
+        ...
+
+    @abstractmethod
+    def replace_one(self, filter, document, upsert=False):
+        ...
+
+    @abstractmethod
+    def delete_one(self, filter):
+        # Returns the number of documents deleted
+        ...
+
+    @abstractmethod
+    def delete_many(self, filter):
+        ...
+
+    @abstractmethod
+    def count(self, filter=None, limit=0):
+        ...
+
+    def estimated_count(self):
+        # Documents in the whole collection, from its metadata instead of a scan; enough to notice that it changed
+        return self.count()
+
+    @abstractmethod
+    def distinct(self, field, filter=None):
+        ...
+
+    @abstractmethod
+    def aggregate(self, pipeline):
+        # Iterate over the results of an aggregation pipeline
+        ...
+
+    @abstractmethod
+    def create_index(self, keys, unique=False, expire_after_seconds=None):
+        # keys is a field name or a list of (field, direction) pairs
+        ...
+
+    @abstractmethod
+    def index_names(self):
+        # Names of the indexes on the collection, '_id_' included
+        ...
+
+    @abstractmethod
+    def watch(self, resume_after=None, max_await_time_ms=None):
+        # Change stream over the collection; engines without one raise NotImplementedError
+        ...
+
+    @abstractmethod
+    def explain(self, filter=None, sort=None):
+        # How a find with this filter and sort would run: {'stages': [...], 'indexes': [...]}
+        ...
+
+    def next_id(self):
+        # Sequential integer id for a new document: highest _id plus one
+        last = self.find_one(projection={'_id': 1}, sort=[('_id', -1)])
+        return last['_id'] + 1 if last else 1
+
+
+class MongoRepository(Repository):
+    # Repository backed by a PyMongo collection, resolved on every call so it can be built before connecting
+    def __init__(self, db_conn, collection_name, database=None):
+        self.db_conn = db_conn  # Database connection
+        self.collection_name = collection_name  # Collection this repository reads and writes
+        self.tenant_database = database  # A tenant's own database (TENANCY=database), else the main one
+
+    @property
+    def database(self):
+        return self.tenant_database if self.tenant_database is not None else self.db_conn.db
+
+    @property
+    def collection(self):
+        return self.database[self.collection_name]
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        cursor = self.collection.find(filter or {}, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        if skip:
+            cursor = cursor.skip(skip)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        return self.collection.find_one(filter or {}, projection, sort=sort)
+
+    def insert_one(self, document):
+        self.collection.insert_one(document)
+
+    def insert_many(self, documents):
+        if documents:
+            self.collection.insert_many(documents)
+
+    def upsert_many(self, documents):
+        if documents:
+            self.collection.bulk_write([ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in documents],
+                                       ordered=False)
+
+    def update_one(self, filter, update, upsert=False, array_filters=None):
+        return self.collection.update_one(filter, update, upsert=upsert, array_filters=array_filters).modified_count
+
+    def update_many(self, filter, update, array_filters=None):
+        return self.collection.update_many(filter, update, array_filters=array_filters).modified_count
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, before=False):
+        return self.collection.find_one_and_update(
+            filter, update, projection=projection, sort=sort, upsert=upsert,
+            return_document=ReturnDocument.BEFORE if before else ReturnDocument.AFTER
+        )
+
+    def replace_one(self, filter, document, upsert=False):
+        return self.collection.replace_one(filter, document, upsert=upsert).modified_count
+
+    def delete_one(self, filter):
+        return self.collection.delete_one(filter).deleted_count
+
+    def delete_many(self, filter):
+        return self.collection.delete_many(filter).deleted_count
+
+    def count(self, filter=None, limit=0):
+        options = {'limit': limit} if limit else {}
+        return self.collection.count_documents(filter or {}, **options)
+
+    def estimated_count(self):
+        return self.collection.estimated_document_count()
+
+    def distinct(self, field, filter=None):
+        return self.collection.distinct(field, filter)
+
+    def aggregate(self, pipeline):
+        return self.collection.aggregate(pipeline)
+
+    def create_index(self, keys, unique=False, expire_after_seconds=None):
+        options = {'unique': unique}
+        if expire_after_seconds is not None:
+            options['expireAfterSeconds'] = expire_after_seconds
+        return self.collection.create_index(keys, **options)
+
+    def index_names(self):
+        return list(self.collection.index_information())
+
+    def watch(self, resume_after=None, max_await_time_ms=None):
+        return self.collection.watch(resume_after=resume_after, max_await_time_ms=max_await_time_ms)
+
+    def explain(self, filter=None, sort=None):
+        # queryPlanner verbosity only picks the plan, it doesn't run the query again
+        command = {'find': self.collection_name, 'filter': filter or {}}
+        if sort:
+            command['sort'] = dict(sort)
+        return plan_summary(self.database.command({'explain': command, 'verbosity': 'queryPlanner'}))
+
+
+def plan_summary(explain):
+    # Stages of the winning plan from the root down, e.g. ['FETCH', 'IXSCAN'] or ['COLLSCAN']
+    plan = explain.get('queryPlanner', {}).get('winningPlan', {})
+    plan = plan.get('queryPlan', plan)  # Servers using the slot-based engine nest the plan one level deeper
+    stages, indexes = [], []
+    while plan:
+        stages.append(plan.get('stage'))
+        if plan.get('indexName'):
+            indexes.append(plan['indexName'])
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return {'stages': stages, 'indexes': indexes}
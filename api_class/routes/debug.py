@@ -0,0 +1,39 @@
+import hmac
+import os
+
+from flask import Blueprint, jsonify, request
+
+# Diagnostics routes, off unless DEBUG_ENDPOINTS=1; with DEBUG_TOKEN set they also need a matching X-Debug-Token header
+DEBUG_ENDPOINTS = os.environ.get('DEBUG_ENDPOINTS', '0').lower() in ('1', 'true', 'yes')
+DEBUG_TOKEN = os.environ.get('DEBUG_TOKEN')
+
+
+def init_debug(app, profiler):
+    # Register the diagnostics routes when they are enabled and there is something to show
+    if DEBUG_ENDPOINTS and profiler:
+        app.register_blueprint(DebugRoutes(profiler))
+
+
+class DebugRoutes(Blueprint):
+    def __init__(self, profiler):
+        super().__init__('debug', __name__)
+        self.profiler = profiler  # QueryProfiler of the database connection
+        self.before_request(self.authorize)
+        self.route('/debug/slow-queries', methods=['GET'])(self.get_slow_queries)
+
+    def authorize(self):
+        if DEBUG_TOKEN and not hmac.compare_digest(request.headers.get('X-Debug-Token', ''), DEBUG_TOKEN):
+            return jsonify({'error': 'Forbidden'}), 403
+        return None
+
+    def get_slow_queries(self):
+        # Worst query shapes per collection, in this worker only (each gunicorn worker keeps its own)
+        try:
+            limit = int(request.args.get('limit', 10))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        return jsonify({
+            'pid': os.getpid(),
+            'thresholdMs': self.profiler.threshold_ms,
+            'collections': self.profiler.top(limit, request.args.get('collection')),
+        }), 200
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import sys
+
+from flask import Blueprint, Flask, Response, request
+from logger.logger_base import Logger
+
+# API documentation mode:
+#   live   - flasgger builds the spec from the @swag_from dicts and serves Swagger UI (development)
+#   static - serve the spec generated at build time from a JSON file; flasgger is never imported
+#   off    - no documentation routes at all
+API_DOCS = os.environ.get('API_DOCS', 'live').lower()
+
+# Same URL flasgger uses, so clients and tools work in both modes
+SPEC_URL = '/apispec_1.json'
+SPEC_PATH = os.environ.get('API_DOCS_SPEC', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'openapi.json'))
+
+if API_DOCS == 'live':
+    from flasgger import swag_from  # noqa: F401  (re-exported for the routes)
+else:
+    def swag_from(specs=None, **kwargs):
+        # The spec is prebuilt (or disabled), so the route documentation is not attached to the views
+        def decorator(function):
+            return function
+        return decorator
+
+
+def init_docs(app):
+    # Set up the documentation for the configured mode
+    if API_DOCS == 'live':
+        from flasgger import Swagger
+        return Swagger(app)
+    if API_DOCS == 'static':
+        if os.path.exists(SPEC_PATH):
+            app.register_blueprint(StaticSpec(SPEC_PATH))
+        else:
+            Logger().warning(f'API_DOCS=static but {SPEC_PATH} is missing; build it with python -m routes.docs')
+    return None
+
+
+class StaticSpec(Blueprint):
+    # Serves the prebuilt OpenAPI spec from memory, with an ETag so clients can revalidate for free
+    def __init__(self, spec_path):
+        super().__init__('docs', __name__)
+        with open(spec_path, 'rb') as spec_file:
+            self.spec = spec_file.read()  # Read once at boot; the file only changes with a new image
+        self.etag = f'"{hashlib.sha1(self.spec).hexdigest()[:16]}"'  # Same in every worker
+        self.route(SPEC_URL, methods=['GET'])(self.get_spec)
+
+    def get_spec(self):
+        if request.headers.get('If-None-Match') == self.etag:
+            return Response(status=304, headers={'ETag': self.etag})
+        return Response(self.spec, mimetype='application/json', headers={'ETag': self.etag, 'Cache-Control': 'public, max-age=3600'})
+
+
+def build_spec():
+    # Register the routes on a bare app (no database) and let flasgger assemble the spec
+    from flasgger import Swagger
+    import routes.routes as routes_module
+
+    app = Flask(__name__)
+    for value in vars(routes_module).values():
+        if isinstance(value, type) and issubclass(value, Blueprint) and value is not Blueprint:
+            app.register_blueprint(value(None, None))  # The views are never called, so no service or schema
+    swagger = Swagger(app)
+    with app.app_context():
+        return swagger.get_apispecs('apispec_1')
+
+
+if __name__ == '__main__':
+    # Build time: python -m routes.docs openapi.json
+    os.environ['API_DOCS'] = 'live'  # routes.routes imports this module again and needs the real swag_from
+    with open(sys.argv[1] if len(sys.argv) > 1 else SPEC_PATH, 'w') as output_file:
+        json.dump(build_spec(), output_file, separators=(',', ':'), default=str)
@@ -1,5 +1,6 @@
 from marshmallow import fields, validates, ValidationError
 import re
+from schemas.tags import parse_tags, ABILITY_ALIASES
 
 
 # This class defines the fields we need to validate
@@ -61,8 +62,8 @@ class ClassSchema:
         if not value:
             raise ValidationError('Saving Throw Proficiencies is required.')
         
-        # Check if the field always contains two elements separated by a comma
-        elif value.count(',') != 1:
+        # Check if the field always contains two different abilities separated by a comma
+        elif len(parse_tags(value, ABILITY_ALIASES)) != 2:
             raise ValidationError('Saving Throw Proficiencies must always have exactly two selections.')
         
 
@@ -0,0 +1,49 @@
+import re
+
+# Commas and semicolons separate tags, except inside parentheses: "Simple weapons, crossbows (hand, light)"
+TAG_SEPARATOR = re.compile(r'[,;](?![^()]*\))')
+LEADING_CONJUNCTION = re.compile(r'^(?:and|or)\s+')
+
+# Values that mean the list is empty
+EMPTY_TAGS = {'', '-', 'none', 'n/a', 'nothing'}
+
+# Saving throws are often written with the ability abbreviation
+ABILITY_ALIASES = {
+    'str': 'strength', 'dex': 'dexterity', 'con': 'constitution',
+    'int': 'intelligence', 'wis': 'wisdom', 'cha': 'charisma',
+}
+
+
+def parse_tags(value, aliases=None):
+    # Split a comma-separated string into canonical lowercase tags, without duplicates
+    # "Fire, Cold, and Poison." -> ['fire', 'cold', 'poison']; aliases map spellings to one tag ('str' -> 'strength')
+    if not isinstance(value, str):
+        return []
+    tags = []
+    for part in TAG_SEPARATOR.split(value):
+        tag = LEADING_CONJUNCTION.sub('', ' '.join(part.lower().split()).strip(' .'))
+        tag = (aliases or {}).get(tag, tag)
+        if tag not in EMPTY_TAGS and tag not in tags:
+            tags.append(tag)
+    return tags
+
+
+def tags_query(required_tags):
+    # {'immunityTags': ['fire']} -> {'immunityTags': 'fire'}; several tags must all be present ($all)
+    # Both forms are answered from a multikey index on the field
+    query = {}
+    for field, tags in required_tags.items():
+        if len(tags) == 1:
+            query[field] = tags[0]
+        elif tags:
+            query[field] = {'$all': tags}
+    return query
+
+
+if __name__ == '__main__':
+    from logger.logger_base import Logger  # Import the custom logger
+
+    logger = Logger()
+    for example in ['Light armor, shields, and simple weapons.', 'Simple weapons, crossbows (hand, light)', 'None']:
+        logger.info(f'{example!r} -> {parse_tags(example)}')
+    logger.info(f"'STR, Dex' -> {parse_tags('STR, Dex', ABILITY_ALIASES)}")
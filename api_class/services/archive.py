@@ -0,0 +1,188 @@
+import argparse
+import gzip
+import os
+import zlib
+from datetime import datetime, timezone
+
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from bson.errors import InvalidBSON
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from logger.logger_base import Logger
+from services.delta_sync import now_ms
+
+try:
+    import msgpack  # MessagePack archives; BSON ones only need pymongo
+except ImportError:
+    msgpack = None
+
+# Archive formats: a gzip stream of documents, each encoded as BSON or as MessagePack, after a header record
+FORMATS = ('bson', 'msgpack')
+ARCHIVE_VERSION = 1
+
+# Compressed bytes gathered before an export chunk is handed to the response
+CHUNK_BYTES = 64 * 1024
+
+# Same codec as the memory engine snapshots: dates come back timezone-aware, in UTC
+CODEC_OPTIONS = CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+
+# MessagePack extension type holding the 12 bytes of an ObjectId
+OBJECT_ID_EXT = 1
+
+
+def archive_path(name):
+    # Files read and written by the export and import jobs stay in ARCHIVE_DIR: only the file name of a job's path is used
+    if not name or not os.path.basename(name):
+        raise ValueError('An archive file name is required')
+    directory = os.environ.get('ARCHIVE_DIR', 'archives')
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, os.path.basename(name))
+
+
+def check_format(archive_format):
+    if archive_format not in FORMATS:
+        raise ValueError(f'Unknown archive format {archive_format!r}, expected one of: {", ".join(FORMATS)}')
+    if archive_format == 'msgpack' and msgpack is None:
+        raise ValueError('MessagePack archives need the msgpack package')
+
+
+def format_from_path(path):
+    # 'classes.msgpack.gz' -> 'msgpack', anything else -> 'bson'
+    return 'msgpack' if '.msgpack' in path or '.mpk' in path else 'bson'
+
+
+def pack_default(value):
+    # The BSON types MessagePack has no type for
+    if isinstance(value, ObjectId):
+        return msgpack.ExtType(OBJECT_ID_EXT, value.binary)
+    if isinstance(value, datetime):
+        return msgpack.Timestamp.from_datetime(value if value.tzinfo else value.replace(tzinfo=timezone.utc))
+    raise TypeError(f'Cannot store a {type(value).__name__} in a MessagePack archive')
+
+
+def unpack_ext(code, data):
+    if code == OBJECT_ID_EXT:
+        return ObjectId(data)
+    return msgpack.ExtType(code, data)
+
+
+def encoder(archive_format):
+    # Function turning one document into its bytes in the archive
+    if archive_format == 'bson':
+        return bson.encode  # BSON documents start with their length, so they are simply concatenated
+    return msgpack.Packer(default=pack_default, datetime=True).pack
+
+
+def decoder(archive_format, stream):
+    # Documents read one at a time from a decompressed stream, never the whole archive at once
+    if archive_format == 'bson':
+        return iter(bson.decode_file_iter(stream, codec_options=CODEC_OPTIONS))
+    return msgpack.Unpacker(stream, ext_hook=unpack_ext, timestamp=3)
+
+
+def export_archive(repository, collection_name, archive_format='bson'):
+    # Compressed archive of the collection as an iterator of byte chunks, read with a cursor in _id order
+    # Memory use is one cursor batch plus a chunk, whatever the size of the collection
+    check_format(archive_format)
+    encode = encoder(archive_format)
+    # Opened here rather than in the generator, so the cursor is scoped to the tenant of the request that asked
+    documents = repository.find({}, sort=[('_id', 1)])
+
+    def chunks():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip container, so gunzip can open it
+        header = {'archive': ARCHIVE_VERSION, 'collection': collection_name, 'format': archive_format, 'exportedAt': now_ms()}
+        pending = [compressor.compress(encode(header))]
+        size = 0
+        for document in documents:
+            data = compressor.compress(encode(document))
+            if data:
+                pending.append(data)
+                size += len(data)
+                if size >= CHUNK_BYTES:
+                    yield b''.join(pending)
+                    pending, size = [], 0
+        pending.append(compressor.flush())
+        yield b''.join(pending)
+
+    return chunks()
+
+
+def import_archive(stream, repository, collection_name, archive_format='bson', mode='upsert', batch_size=500, progress=None):
+    # Load an archive from a binary stream in batches: insert_many for mode 'insert' (faster, fails on existing ids),
+    # one bulk of replace-by-_id upserts for mode 'upsert' (safe to repeat)
+    # Only one batch is decoded at a time; progress(done, total, message) is called after each batch, when given
+    check_format(archive_format)
+    if mode not in ('insert', 'upsert'):
+        raise ValueError(f'Unknown import mode {mode!r}, expected insert or upsert')
+    write = repository.insert_many if mode == 'insert' else repository.upsert_many
+    imported = 0
+    try:
+        records = decoder(archive_format, gzip.GzipFile(fileobj=stream, mode='rb'))
+        header = next(records, None)
+        if not isinstance(header, dict) or 'archive' not in header:
+            raise ValueError(f'Not a {archive_format} archive')
+        if header.get('collection') != collection_name:
+            raise ValueError(f'The archive holds {header.get("collection")}, not {collection_name}')
+
+        updated_at = now_ms()  # Imported documents count as changed for delta sync
+        batch = []
+        for document in records:
+            document['updatedAt'] = updated_at
+            batch.append(document)
+            if len(batch) >= batch_size:
+                write(batch)
+                imported += len(batch)
+                batch = []
+                if progress:
+                    progress(imported, None, f'{collection_name} imported')
+        write(batch)
+        imported += len(batch)
+    except (DuplicateKeyError, BulkWriteError):
+        raise ValueError(f'An ID in the batch after {imported} documents already exists; import with mode upsert to replace them')
+    except (OSError, EOFError, InvalidBSON) as e:
+        raise ValueError(f'Unreadable archive after {imported} documents: {e}')
+    except ValueError as e:
+        if imported:
+            raise ValueError(f'{e} (after {imported} documents)')
+        raise
+    return {'collection': collection_name, 'mode': mode, 'documents': imported}
+
+
+if __name__ == '__main__':
+    # Command line: python -m services.archive export classes.bson.gz | import classes.bson.gz [--mode insert]
+    from models.models import ClassModel
+    from services.services import ClassService
+    from models.tenancy import current_tenant
+
+    parser = argparse.ArgumentParser(description='Export or import the classes as a compressed BSON or MessagePack archive')
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('path', help='Archive file; a name containing .msgpack selects MessagePack unless --format is given')
+    parser.add_argument('--format', choices=FORMATS, help='Archive format (default: from the file name)')
+    parser.add_argument('--mode', choices=('insert', 'upsert'), default='upsert', help='Import mode (default: upsert)')
+    arguments = parser.parse_args()
+
+    logger = Logger()  # Logger for logging messages
+    db_conn = ClassModel()  # Database connection
+    current_tenant.set(os.environ.get('TENANT') or None)  # With TENANCY set, TENANT=guild archives that tenant only
+
+    try:
+        db_conn.connect_to_database()  # Connect to the database
+        class_service = ClassService(db_conn)
+        archive_format = arguments.format or format_from_path(arguments.path)
+        if arguments.action == 'export':
+            with open(arguments.path, 'wb') as archive:
+                for chunk in export_archive(class_service.repository, 'classes', archive_format):
+                    archive.write(chunk)
+                logger.info(f'Export finished: {archive.tell()} bytes written to {arguments.path}')
+        else:
+            with open(arguments.path, 'rb') as archive:
+                counts = class_service.load_archive(archive, archive_format, arguments.mode,
+                                                   progress=lambda done, total, message: logger.info(f'{done} {message}'))
+            logger.info(f'Import finished: {counts}')
+    except Exception as e:
+        # If something goes wrong, log the error
+        logger.error(f'An error has occurred: {e}')
+    finally:
+        db_conn.close_connection()  # Close the database connection (the memory engine writes its snapshot)
@@ -1,17 +1,51 @@
 # Import necessary modules
 from flask import jsonify
 from logger.logger_base import Logger
+from services.change_feed import ChangeFeed
+from services.archive import export_archive, import_archive, archive_path
+from services.delta_sync import now_ms, ensure_sync_indexes, record_tombstone, get_changes
+from services.jobs import JobQueue
+from services.stats import StatsCache, count_by, facet_counts
+from schemas.tags import parse_tags, tags_query, ABILITY_ALIASES
 
 class ClassService:
     def __init__(self, db_conn):
         # Set up logging and database connection
         self.logger = Logger()  # Logger for logging messages
         self.db_conn = db_conn  # Database connection
+        self.repository = db_conn.repository('classes')  # Storage of the classes
+        self.tombstones = db_conn.repository('tombstones')  # Deletion records used by delta sync
+        self.change_feed = ChangeFeed(self.repository, self.tombstones, 'classes')  # Pushes collection changes to event stream clients
+        self.stats = StatsCache(self.repository, self.compute_stats)  # Dashboard stats, recomputed after writes
+        # Long operations run off the request path; JOB_WORKERS threads or `python -m services.jobs` run them
+        self.jobs = JobQueue.from_environment(db_conn, 'classes', {
+            'reindex': self.reindex_job,
+            'export': self.export_job,
+            'import': self.import_job,
+        })
 
-    def get_all_classes(self):
+    def ensure_indexes(self):
         try:
-            # Fetch all classes from the database and return them as a list
-            classes = list(self.db_conn.db.classes.find())
+            # updatedAt and tombstone indexes used by delta sync
+            ensure_sync_indexes(self.repository, self.tombstones)
+            self.jobs.ensure_indexes()  # Job claims and the cleanup of finished jobs
+            # Multikey indexes for the ?stp= and ?awp= filters
+            self.repository.create_index('stpTags')
+            self.repository.create_index('awpTags')
+            # Backfill classes stored before the proficiency tags were set on write
+            for class_data in self.repository.find({'stpTags': {'$exists': False}}, {'stp': 1, 'awp': 1}):
+                self.repository.update_one({'_id': class_data['_id']}, {'$set': {
+                    'stpTags': parse_tags(class_data.get('stp'), ABILITY_ALIASES),
+                    'awpTags': parse_tags(class_data.get('awp')),
+                }})
+        except Exception as e:
+            # Indexes only speed things up, so log and keep serving
+            self.logger.error(f'Error creating the class indexes: {e}')
+
+    def get_all_classes(self, required_tags=None):
+        try:
+            # Fetch all classes from the database, or only those with every required tag, and return them as a list
+            classes = list(self.repository.find(tags_query(required_tags or {})))
             return classes
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -20,14 +54,14 @@ class ClassService:
 
     def add_class(self, new_class):
         try:
-            # Try to get the highest ID in the collection
-            max_class = self.db_conn.db.classes.find_one(sort=[('_id', -1)])
-            # If a class exists, increment its ID by 1; otherwise, start from 1
-            next_id = max_class['_id'] + 1 if max_class else 1
+            # Highest ID in the collection plus one, or 1 for the first class
+            next_id = self.repository.next_id()
             # Assign the new ID to the class
             new_class['_id'] = next_id  
+            new_class['updatedAt'] = now_ms()  # Change time used by delta sync
             # Insert the new class into the database
-            self.db_conn.db.classes.insert_one(new_class)
+            self.repository.insert_one(new_class)
+            self.stats.invalidate()  # The cached stats are out of date
             
             # Return the newly added class
             return new_class
@@ -42,7 +76,7 @@ class ClassService:
     def get_class_by_id(self, class_id):
         try:
             # Fetch a specific class by its ID from the database
-            class_data = self.db_conn.db.classes.find_one({'_id': class_id})
+            class_data = self.repository.find_one({'_id': class_id})
             return class_data  # Return the class data
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -56,8 +90,10 @@ class ClassService:
 
             if update_class:
                 # If the class exists, update it with the new data
-                updated_class = self.db_conn.db.classes.update_one({'_id': class_id}, {'$set': class_data})
-                if updated_class.modified_count > 0:
+                class_data['updatedAt'] = now_ms()  # Change time used by delta sync
+                updated_class = self.repository.update_one({'_id': class_id}, {'$set': class_data})
+                self.stats.invalidate()  # The cached stats are out of date
+                if updated_class > 0:
                     return updated_class  # Return the updated class
                 else:
                     return 'The class is already up-to-date'  # No changes made
@@ -69,6 +105,28 @@ class ClassService:
             self.logger.error(f'Error updating the class: {e}')
             return jsonify({'error': f'Error updating the class: {e}'}), 500
         
+    def patch_class(self, class_id, changes, expected_version=None):
+        try:
+            # Only match the version the client saw, when it sent one
+            query = {'_id': class_id}
+            if expected_version is not None:
+                query['updatedAt'] = expected_version
+
+            changes['updatedAt'] = now_ms()  # Change time used by delta sync, also the new version
+            # Set only the changed fields and read back just those, in a single round-trip
+            patched_class = self.repository.find_one_and_update(query, {'$set': changes}, projection=list(changes))
+            self.stats.invalidate()  # The cached stats are out of date
+            if patched_class:
+                return patched_class  # Return the changed fields
+            if expected_version is not None and self.repository.count({'_id': class_id}, limit=1):
+                return False  # The class exists but has a newer version
+            return None  # Class not found
+
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error patching the class: {e}')
+            return jsonify({'error': f'Error patching the class: {e}'}), 500
+
     def delete_class(self, class_id):
         try:
             # Check if the class exists before deleting
@@ -76,7 +134,9 @@ class ClassService:
             
             if deleted_class:
                 # If the class exists, delete it from the database
-                self.db_conn.db.classes.delete_one({'_id': class_id})
+                self.repository.delete_one({'_id': class_id})
+                self.stats.invalidate()  # The cached stats are out of date
+                record_tombstone(self.tombstones, 'classes', class_id)  # Let offline clients sync the deletion
                 return deleted_class  # Return the deleted class data
             else:
                 return None  # Class not found
@@ -86,6 +146,95 @@ class ClassService:
             self.logger.error(f'Error deleting the class data: {e}')
             return jsonify({'error': f'Error deleting the class data: {e}'}), 500
 
+    def compute_stats(self):
+        # Classes per hit die and per saving throw proficiency
+        return facet_counts(self.repository, {'byHitDie': count_by('$hd'), 'bySavingThrow': count_by('$stpTags', unwind='$stpTags')})
+
+    def get_stats(self):
+        try:
+            # Cached aggregated stats with their version, recomputed only when the classes changed
+            return self.stats.get()
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing the class stats: {e}')
+            return jsonify({'error': f'Error computing the class stats: {e}'}), 500
+
+    def submit_job(self, job_type, params):
+        try:
+            # Queue a background job; the response only carries its id and status
+            return self.jobs.submit(job_type, params)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown job type
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error submitting the class job: {e}')
+            return jsonify({'error': f'Error submitting the class job: {e}'}), 500
+
+    def get_job(self, job_id):
+        try:
+            # Fetch a job of this service with its status, progress and result
+            return self.jobs.get(job_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the class job: {e}')
+            return jsonify({'error': f'Error fetching the class job: {e}'}), 500
+
+    def reindex_job(self, context, params):
+        # Job handler: create the indexes and run the backfills again, e.g. after restoring a dump
+        self.ensure_indexes()
+        return {'indexes': sorted(self.repository.index_names())}
+
+    def export_archive(self, archive_format):
+        try:
+            # Compressed archive of every class, produced chunk by chunk while the response is sent
+            return export_archive(self.repository, 'classes', archive_format)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error exporting the classes: {e}')
+            return jsonify({'error': f'Error exporting the classes: {e}'}), 500
+
+    def import_archive(self, stream, archive_format, mode):
+        try:
+            # Import an archive read from the request body as it arrives
+            return self.load_archive(stream, archive_format, mode)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format or mode, or not a classes archive
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error importing the classes: {e}')
+            return jsonify({'error': f'Error importing the classes: {e}'}), 500
+
+    def load_archive(self, stream, archive_format, mode, progress=None):
+        # Import an archive, then bring what is derived from the classes up to date
+        counts = import_archive(stream, self.repository, 'classes', archive_format, mode, progress=progress)
+        self.ensure_indexes()  # Backfills the derived fields of classes from older archives
+        self.stats.invalidate()
+        return counts
+
+    def export_job(self, context, params):
+        # Job handler: write an archive into ARCHIVE_DIR
+        archive_format = params.get('format', 'bson')
+        with open(archive_path(params.get('path')), 'wb') as archive:
+            for chunk in export_archive(self.repository, 'classes', archive_format):
+                archive.write(chunk)
+            return {'path': archive.name, 'format': archive_format, 'bytes': archive.tell()}
+
+    def import_job(self, context, params):
+        # Job handler: import an archive from ARCHIVE_DIR, for archives too large to send in one request
+        with open(archive_path(params.get('path')), 'rb') as archive:
+            return self.load_archive(archive, params.get('format', 'bson'), params.get('mode', 'upsert'), progress=context.progress)
+
+    def get_changes(self, since, limit):
+        try:
+            # Fetch only the classes changed or deleted since the client's last sync
+            return get_changes(self.repository, self.tombstones, 'classes', since, limit)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the class changes: {e}')
+            return jsonify({'error': f'Error fetching the class changes: {e}'}), 500
+
 # Main block of code for testing the ClassService
 if __name__ == '__main__':
     from models.models import ClassModel
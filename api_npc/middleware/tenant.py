@@ -0,0 +1,71 @@
+import os
+
+from flask import g, jsonify, request
+
+from models.tenancy import TENANT_NAME, current_tenant
+
+HEADER = 'X-Tenant-ID'
+
+
+def parse_api_keys(value):
+    # "key1:guild-a,key2:guild-b" -> {'key1': 'guild-a', 'key2': 'guild-b'}
+    mapping = {}
+    for pair in (value or '').split(','):
+        key, _, tenant = pair.strip().partition(':')
+        if key and tenant:
+            mapping[key] = tenant
+    return mapping
+
+
+class TenantResolver:
+    # Picks the tenant (campaign group) of each API request and sets it for every repository call the request makes
+    # When TENANT_API_KEYS maps keys to tenants, the X-API-Key decides the tenant and any other key is refused
+    # (a header can't override it); otherwise the tenant header does, and requests without one belong to the
+    # default tenant unless TENANT_REQUIRED is set
+    def __init__(self, app, header=HEADER, api_keys=None, required=False, default_tenant='default'):
+        self.header = header  # Request header naming the tenant
+        self.api_keys = api_keys or {}  # X-API-Key -> tenant
+        self.required = required  # Refuse API requests that name no tenant
+        self.default_tenant = default_tenant
+        app.before_request(self.resolve)
+        app.teardown_request(self.reset)
+
+    @classmethod
+    def from_environment(cls, app, db_conn):
+        # Only when the model has tenancy on (TENANCY=field or database)
+        if db_conn.tenancy not in ('field', 'database'):
+            return None
+        return cls(
+            app,
+            header=os.environ.get('TENANT_HEADER', HEADER),
+            api_keys=parse_api_keys(os.environ.get('TENANT_API_KEYS')),
+            required=os.environ.get('TENANT_REQUIRED', '0').lower() in ('1', 'true', 'yes'),
+            default_tenant=db_conn.default_tenant,
+        )
+
+    def resolve(self):
+        if not request.path.startswith('/api/'):
+            return None  # Docs, healthchecks and diagnostics are not tenant data
+        named = request.headers.get(self.header)
+        tenant = named
+        if self.api_keys:
+            # A missing or unknown key would otherwise reach whichever tenant the header names
+            tenant = self.api_keys.get(request.headers.get('X-API-Key', ''))
+            if tenant is None:
+                return jsonify({'error': 'This API key is not assigned to a tenant'}), 403
+            if named and named != tenant:
+                return jsonify({'error': f'{self.header} does not match the tenant of this API key'}), 403
+        if not tenant:
+            if self.required:
+                return jsonify({'error': f'Invalid data: the {self.header} header is required'}), 400
+            tenant = self.default_tenant
+        if not TENANT_NAME.match(tenant):
+            return jsonify({'error': f'Invalid data: {self.header} may only hold letters, digits, - and _ (48 at most)'}), 400
+        g.tenant = tenant
+        g.tenant_token = current_tenant.set(tenant)
+        return None
+
+    def reset(self, exception=None):
+        token = g.pop('tenant_token', None)
+        if token is not None:
+            current_tenant.reset(token)
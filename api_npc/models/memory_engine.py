@@ -0,0 +1,1061 @@
+import copy
+import itertools
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import bson
+from bson import ObjectId
+from bson.codec_options import CodecOptions
+from pymongo.errors import DuplicateKeyError
+
+from logger.logger_base import Logger
+from models.repository import Repository
+
+# Snapshots keep timezone-aware datetimes, like the values the services store
+CODEC_OPTIONS = CodecOptions(tz_aware=True, tzinfo=timezone.utc)
+
+MISSING = object()  # Marks a field that isn't in the document
+
+
+# ---------------------------------------------------------------------------
+# Values: ordering and hashing the way MongoDB compares BSON types
+# ---------------------------------------------------------------------------
+
+def type_rank(value):
+    # BSON comparison order: null, numbers, strings, objects, arrays, binary, ObjectId, booleans, dates
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def sort_key(value):
+    # Key that orders any mix of values like MongoDB does
+    rank = type_rank(value)
+    if rank == 1:
+        return (1, 0)
+    if rank == 4:
+        return (4, tuple((key, sort_key(item)) for key, item in value.items()))
+    if rank == 5:
+        return (5, tuple(sort_key(item) for item in value))
+    if rank == 9 and value.tzinfo is None:
+        return (9, value.replace(tzinfo=timezone.utc))
+    if rank == 10:
+        return (10, str(value))
+    return (rank, value)
+
+
+def hash_key(value):
+    # Hashable stand-in for a value, used by indexes and $group
+    return sort_key(value)
+
+
+def equals(left, right):
+    # Equality without Python's True == 1
+    if isinstance(left, bool) != isinstance(right, bool):
+        return False
+    if type_rank(left) != type_rank(right):
+        return False
+    return sort_key(left) == sort_key(right)
+
+
+def compare(left, right):
+    left_key, right_key = sort_key(left), sort_key(right)
+    return (left_key > right_key) - (left_key < right_key)
+
+
+# ---------------------------------------------------------------------------
+# Queries
+# ---------------------------------------------------------------------------
+
+def get_path(document, path):
+    # Values found at a dotted path; arrays along the way are expanded like in MongoDB queries
+    values = [document]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit():
+                    if int(part) < len(value):
+                        found.append(value[int(part)])
+                else:
+                    found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    return values
+
+
+def expand(values):
+    # A query on an array field matches the array itself or any of its elements
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def is_operator_dict(value):
+    return isinstance(value, dict) and bool(value) and all(key.startswith('$') for key in value)
+
+
+def match(document, query):
+    # Whether a document satisfies a MongoDB query
+    for key, condition in (query or {}).items():
+        if key == '$and':
+            if not all(match(document, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(match(document, part) for part in condition):
+                return False
+        elif key == '$nor':
+            if any(match(document, part) for part in condition):
+                return False
+        elif key == '$expr':
+            if not truthy(evaluate(condition, document)):
+                return False
+        elif not match_field(get_path(document, key), condition):
+            return False
+    return True
+
+
+def match_field(values, condition):
+    if is_operator_dict(condition):
+        return all(match_operator(values, operator, argument, condition) for operator, argument in condition.items())
+    return match_operator(values, '$eq', condition, {})
+
+
+def match_operator(values, operator, argument, condition):
+    candidates = expand(values)
+    if operator == '$eq':
+        if argument is None and not values:
+            return True  # A missing field equals null
+        return any(equals(value, argument) for value in candidates)
+    if operator == '$ne':
+        return not match_operator(values, '$eq', argument, condition)
+    if operator == '$in':
+        return any(match_operator(values, '$eq', item, condition) for item in argument)
+    if operator == '$nin':
+        return not match_operator(values, '$in', argument, condition)
+    if operator in ('$gt', '$gte', '$lt', '$lte'):
+        for value in candidates:
+            if type_rank(value) != type_rank(argument) or value is None:
+                continue  # Range operators only compare values of the same type
+            result = compare(value, argument)
+            if ((operator == '$gt' and result > 0) or (operator == '$gte' and result >= 0)
+                    or (operator == '$lt' and result < 0) or (operator == '$lte' and result <= 0)):
+                return True
+        return False
+    if operator == '$exists':
+        return bool(values) == bool(argument)
+    if operator == '$all':
+        return all(match_operator(values, '$eq', item, condition) for item in argument)
+    if operator == '$size':
+        return any(isinstance(value, list) and len(value) == argument for value in values)
+    if operator == '$elemMatch':
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                if is_operator_dict(argument) and match_field([item], argument):
+                    return True
+                if not is_operator_dict(argument) and isinstance(item, dict) and match(item, argument):
+                    return True
+        return False
+    if operator == '$regex':
+        flags = 0
+        for option in condition.get('$options', ''):
+            flags |= {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}.get(option, 0)
+        pattern = argument if isinstance(argument, re.Pattern) else re.compile(argument, flags)
+        return any(isinstance(value, str) and pattern.search(value) for value in candidates)
+    if operator == '$options':
+        return True  # Read together with $regex
+    if operator == '$not':
+        return not match_field(values, argument)
+    raise ValueError(f'Unsupported query operator: {operator}')
+
+
+def project(document, projection):
+    # Copy of a document with a MongoDB projection applied
+    if not projection:
+        return copy.deepcopy(document)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include_id = projection.get('_id', 1)
+    fields = {field: value for field, value in projection.items() if field != '_id'}
+
+    if all(fields.values()) if fields else include_id:
+        # Inclusion: only the listed fields ({'_id': 1} alone keeps just the id)
+        result = {}
+        if include_id and '_id' in document:
+            result['_id'] = document['_id']
+        for field in fields:
+            source, target = document, result
+            parts = field.split('.')
+            for part in parts[:-1]:
+                source = source.get(part) if isinstance(source, dict) else None
+                if not isinstance(source, dict):
+                    break
+                target = target.setdefault(part, {})
+            else:
+                if isinstance(source, dict) and parts[-1] in source:
+                    target[parts[-1]] = copy.deepcopy(source[parts[-1]])
+        return result
+
+    # Exclusion: everything but the listed fields
+    result = copy.deepcopy(document)
+    for field in fields:
+        container = result
+        parts = field.split('.')
+        for part in parts[:-1]:
+            container = container.get(part) if isinstance(container, dict) else None
+        if isinstance(container, dict):
+            container.pop(parts[-1], None)
+    if not include_id:
+        result.pop('_id', None)
+    return result
+
+
+def sort_documents(documents, sort):
+    # Stable multi-key sort; sort is a field name or a list of (field, direction) pairs
+    if isinstance(sort, str):
+        sort = [(sort, 1)]
+    elif isinstance(sort, dict):
+        sort = list(sort.items())
+    for field, direction in reversed(sort):
+        documents.sort(key=lambda document: sort_key(first_value(document, field)), reverse=direction < 0)
+    return documents
+
+
+def first_value(document, field):
+    values = get_path(document, field)
+    return values[0] if values else None
+
+
+# ---------------------------------------------------------------------------
+# Updates
+# ---------------------------------------------------------------------------
+
+def get_item(container, key):
+    if isinstance(container, list):
+        return container[key] if key < len(container) else MISSING
+    return container.get(key, MISSING)
+
+
+def set_item(container, key, value):
+    if isinstance(container, list):
+        container.extend([None] * (key + 1 - len(container)))
+    container[key] = value
+
+
+def matches_array_filter(item, identifier, array_filters):
+    # Whether an array element is selected by the arrayFilters entry for $[identifier]
+    for array_filter in array_filters or []:
+        conditions = {key: value for key, value in array_filter.items()
+                      if key == identifier or key.startswith(identifier + '.')}
+        if not conditions:
+            continue
+        for key, condition in conditions.items():
+            if key == identifier:
+                values = [item]
+            else:
+                values = get_path(item, key[len(identifier) + 1:]) if isinstance(item, dict) else []
+            if not match_field(values, condition):
+                return False
+        return True
+    raise ValueError(f'No array filter found for identifier {identifier}')
+
+
+def update_targets(document, path, array_filters, create=True):
+    # (container, key) pairs an update path refers to, supporting $[] and $[identifier]
+    parts = path.split('.')
+    containers = [document]
+    for part in parts[:-1]:
+        found = []
+        for container in containers:
+            if part.startswith('$['):
+                if isinstance(container, list):
+                    identifier = part[2:-1]
+                    found.extend(item for item in container
+                                 if not identifier or matches_array_filter(item, identifier, array_filters))
+            elif isinstance(container, list):
+                if part.isdigit() and int(part) < len(container):
+                    found.append(container[int(part)])
+            elif isinstance(container, dict):
+                if not isinstance(container.get(part), (dict, list)):
+                    if not create:
+                        continue
+                    container[part] = {}
+                found.append(container[part])
+        containers = found
+
+    last = parts[-1]
+    targets = []
+    for container in containers:
+        if last.startswith('$['):
+            identifier = last[2:-1]
+            if isinstance(container, list):
+                targets.extend((container, index) for index, item in enumerate(container)
+                               if not identifier or matches_array_filter(item, identifier, array_filters))
+        elif isinstance(container, list):
+            if last.isdigit():
+                targets.append((container, int(last)))
+        elif isinstance(container, dict):
+            targets.append((container, last))
+    return targets
+
+
+def apply_update(document, update, array_filters=None, inserting=False):
+    # Apply a MongoDB update document in place; returns whether anything changed
+    changed = False
+    # Resolve every path before changing anything, so array filters see the document as it was, like MongoDB
+    resolved = []
+    for operator, fields in update.items():
+        if operator == '$setOnInsert' and not inserting:
+            continue
+        for path, argument in fields.items():
+            create = operator not in ('$unset', '$pull')
+            resolved.append((operator, argument, update_targets(document, path, array_filters, create)))
+    for operator, argument, targets in resolved:
+        for container, key in targets:
+            current = get_item(container, key)
+            if operator in ('$set', '$setOnInsert'):
+                if current is MISSING or not equals(current, argument) or current != argument:
+                    set_item(container, key, copy.deepcopy(argument))
+                    changed = True
+            elif operator == '$unset':
+                if current is not MISSING:
+                    if isinstance(container, list):
+                        container[key] = None
+                    else:
+                        del container[key]
+                    changed = True
+            elif operator == '$inc':
+                set_item(container, key, (0 if current is MISSING else current) + argument)
+                changed = changed or argument != 0
+            elif operator in ('$min', '$max'):
+                if current is MISSING or (compare(argument, current) < 0 if operator == '$min' else compare(argument, current) > 0):
+                    set_item(container, key, copy.deepcopy(argument))
+                    changed = True
+            elif operator in ('$push', '$addToSet'):
+                if current is MISSING:
+                    current = []
+                    set_item(container, key, current)
+                items = argument['$each'] if isinstance(argument, dict) and '$each' in argument else [argument]
+                for item in items:
+                    if operator == '$push' or not any(equals(existing, item) for existing in current):
+                        current.append(copy.deepcopy(item))
+                        changed = True
+            elif operator == '$pull':
+                if isinstance(current, list):
+                    kept = [item for item in current if not pull_matches(item, argument)]
+                    if len(kept) != len(current):
+                        current[:] = kept
+                        changed = True
+            else:
+                raise ValueError(f'Unsupported update operator: {operator}')
+    return changed
+
+
+def pull_matches(item, condition):
+    if is_operator_dict(condition):
+        return match_field([item], condition)
+    if isinstance(condition, dict) and isinstance(item, dict):
+        return match(item, condition)
+    return equals(item, condition)
+
+
+def upsert_document(query, update, array_filters=None):
+    # New document for an upsert: the query's equality fields, then the update
+    document = {}
+    for key, value in query.items():
+        if key.startswith('$'):
+            continue
+        if is_operator_dict(value):
+            if '$eq' not in value:
+                continue
+            value = value['$eq']
+        apply_update(document, {'$set': {key: value}})
+    apply_update(document, update, array_filters, inserting=True)
+    document.setdefault('_id', ObjectId())
+    return document
+
+
+# ---------------------------------------------------------------------------
+# Aggregation
+# ---------------------------------------------------------------------------
+
+def resolve(value, path):
+    # Field reference in an aggregation expression; arrays of sub-documents yield arrays of values
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            value = [item[part] for item in value if isinstance(item, dict) and part in item]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def evaluate(expression, document):
+    # Evaluate an aggregation expression against a document
+    if isinstance(expression, str) and expression.startswith('$'):
+        if expression == '$$ROOT':
+            return document
+        value = resolve(document, expression[1:])
+        return None if value is MISSING else value
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if not is_operator_dict(expression) or len(expression) != 1:
+        return {key: evaluate(value, document) for key, value in expression.items()}
+
+    (operator, argument), = expression.items()
+    if operator == '$literal':
+        return argument
+    arguments = [evaluate(item, document) for item in argument] if isinstance(argument, list) else [evaluate(argument, document)]
+    if operator in ('$sum', '$add'):
+        values = arguments[0] if operator == '$sum' and len(arguments) == 1 and isinstance(arguments[0], list) else arguments
+        return sum(value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool))
+    if operator == '$subtract':
+        return arguments[0] - arguments[1]
+    if operator == '$multiply':
+        result = 1
+        for value in arguments:
+            result *= value
+        return result
+    if operator == '$divide':
+        return arguments[0] / arguments[1]
+    if operator == '$floor':
+        return int(arguments[0] // 1) if arguments[0] is not None else None
+    if operator == '$size':
+        return len(arguments[0])
+    if operator == '$ifNull':
+        return next((value for value in arguments if value is not None), None)
+    if operator == '$toLower':
+        return (arguments[0] or '').lower()
+    if operator == '$toUpper':
+        return (arguments[0] or '').upper()
+    if operator == '$concat':
+        return None if any(value is None for value in arguments) else ''.join(arguments)
+    if operator == '$in':
+        return any(equals(arguments[0], item) for item in arguments[1])
+    if operator == '$cond':
+        if isinstance(argument, dict):
+            condition, then, otherwise = argument['if'], argument['then'], argument['else']
+        else:
+            condition, then, otherwise = argument
+        return evaluate(then, document) if truthy(evaluate(condition, document)) else evaluate(otherwise, document)
+    if operator in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+        result = compare(arguments[0], arguments[1])
+        return {'$eq': result == 0, '$ne': result != 0, '$gt': result > 0,
+                '$gte': result >= 0, '$lt': result < 0, '$lte': result <= 0}[operator]
+    if operator == '$and':
+        return all(truthy(value) for value in arguments)
+    if operator == '$or':
+        return any(truthy(value) for value in arguments)
+    if operator == '$not':
+        return not truthy(arguments[0])
+    raise ValueError(f'Unsupported expression operator: {operator}')
+
+
+def truthy(value):
+    return value not in (None, False, 0, MISSING)
+
+
+def group(documents, specification):
+    # $group: bucket documents by the _id expression and run the accumulators
+    groups = {}
+    for document in documents:
+        key = evaluate(specification['_id'], document)
+        state = groups.setdefault(hash_key(key), {'_id': key, 'values': {}})
+        for field, accumulator in specification.items():
+            if field == '_id':
+                continue
+            (operator, expression), = accumulator.items()
+            value = 1 if operator == '$count' else evaluate(expression, document)
+            state['values'].setdefault(field, []).append(value)
+
+    results = []
+    for state in groups.values():
+        result = {'_id': state['_id']}
+        for field, accumulator in specification.items():
+            if field == '_id':
+                continue
+            operator = next(iter(accumulator))
+            values = state['values'].get(field, [])
+            numbers = [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+            present = [value for value in values if value is not None]
+            if operator in ('$sum', '$count'):
+                result[field] = sum(numbers)
+            elif operator == '$avg':
+                result[field] = sum(numbers) / len(numbers) if numbers else None
+            elif operator == '$min':
+                result[field] = min(present, key=sort_key) if present else None
+            elif operator == '$max':
+                result[field] = max(present, key=sort_key) if present else None
+            elif operator == '$first':
+                result[field] = values[0] if values else None
+            elif operator == '$last':
+                result[field] = values[-1] if values else None
+            elif operator == '$push':
+                result[field] = values
+            elif operator == '$addToSet':
+                unique = {}
+                for value in values:
+                    unique.setdefault(hash_key(value), value)
+                result[field] = list(unique.values())
+            else:
+                raise ValueError(f'Unsupported accumulator: {operator}')
+        results.append(result)
+    return results
+
+
+def run_pipeline(documents, pipeline):
+    # Evaluate an aggregation pipeline over a list of (copied) documents
+    for stage in pipeline:
+        (operator, argument), = stage.items()
+        if operator == '$match':
+            documents = [document for document in documents if match(document, argument)]
+        elif operator == '$project':
+            if all(value in (0, 1, True, False) for value in argument.values()):
+                documents = [project(document, argument) for document in documents]
+            else:
+                documents = [project_expressions(document, argument) for document in documents]
+        elif operator in ('$addFields', '$set'):
+            documents = [{**document, **{field: evaluate(expression, document) for field, expression in argument.items()}}
+                         for document in documents]
+        elif operator == '$unset':
+            fields = [argument] if isinstance(argument, str) else argument
+            documents = [project(document, {field: 0 for field in fields}) for document in documents]
+        elif operator == '$group':
+            documents = group(documents, argument)
+        elif operator == '$unwind':
+            path = argument if isinstance(argument, str) else argument['path']
+            preserve = isinstance(argument, dict) and argument.get('preserveNullAndEmptyArrays', False)
+            field = path[1:]
+            unwound = []
+            for document in documents:
+                value = resolve(document, field)
+                if isinstance(value, list) and value:
+                    for item in value:
+                        copied = copy.copy(document)
+                        apply_update(copied, {'$set': {field: item}})
+                        unwound.append(copied)
+                elif value not in (MISSING, None) and not isinstance(value, list):
+                    unwound.append(document)
+                elif preserve:
+                    unwound.append(document)
+            documents = unwound
+        elif operator == '$sort':
+            documents = sort_documents(list(documents), list(argument.items()))
+        elif operator == '$skip':
+            documents = documents[argument:]
+        elif operator == '$limit':
+            documents = documents[:argument]
+        elif operator == '$count':
+            documents = [{argument: len(documents)}] if documents else []
+        elif operator == '$sortByCount':
+            documents = sort_documents(group(documents, {'_id': argument, 'count': {'$sum': 1}}), [('count', -1)])
+        elif operator == '$facet':
+            documents = [{name: run_pipeline(list(documents), stages) for name, stages in argument.items()}]
+        elif operator == '$replaceRoot':
+            documents = [evaluate(argument['newRoot'], document) for document in documents]
+        else:
+            raise ValueError(f'Unsupported aggregation stage: {operator}')
+    return documents
+
+
+def project_expressions(document, projection):
+    # $project with computed fields; like MongoDB, a field whose path is missing is left out
+    result = {'_id': document['_id']} if projection.get('_id', 1) in (1, True) and '_id' in document else {}
+    for field, expression in projection.items():
+        if field == '_id' or expression in (0, False):
+            continue
+        if expression in (1, True):
+            value = resolve(document, field)
+        elif isinstance(expression, str) and expression.startswith('$') and not expression.startswith('$$'):
+            value = resolve(document, expression[1:])
+        else:
+            value = evaluate(expression, document)
+        if value is not MISSING:
+            result[field] = value
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Storage
+# ---------------------------------------------------------------------------
+
+class MemoryIndex:
+    # Secondary hash index on the first key of an index specification; multikey for arrays
+    def __init__(self, keys, unique=False, expire_after_seconds=None):
+        self.keys = keys
+        self.field = keys[0][0]
+        self.unique = unique
+        self.expire_after_seconds = expire_after_seconds
+        self.entries = {}  # hash_key(value) -> [value, set of _ids]
+
+    def values_for(self, document):
+        values = get_path(document, self.field)
+        if not values:
+            return [None]  # Missing fields are indexed as null
+        result = []
+        for value in values:
+            if isinstance(value, list):
+                result.extend(value if value else [None])
+            else:
+                result.append(value)
+        return result
+
+    def add(self, document):
+        for value in self.values_for(document):
+            entry = self.entries.setdefault(hash_key(value), [value, set()])
+            entry[1].add(hash_key(document['_id']))
+
+    def remove(self, document):
+        for value in self.values_for(document):
+            key = hash_key(value)
+            entry = self.entries.get(key)
+            if entry:
+                entry[1].discard(hash_key(document['_id']))
+                if not entry[1]:
+                    del self.entries[key]
+
+    def check_unique(self, document, ignore_id=None):
+        # Unique indexes only cover single-field specifications here
+        if not self.unique or len(self.keys) != 1:
+            return
+        for value in self.values_for(document):
+            entry = self.entries.get(hash_key(value))
+            if entry and entry[1] - {hash_key(ignore_id)}:
+                raise DuplicateKeyError(f'E11000 duplicate key error index: {self.field}_1 dup key: {value!r}')
+
+    def candidates(self, condition):
+        # Ids that may match a condition on the indexed field, or None when the index can't help
+        if not is_operator_dict(condition):
+            if isinstance(condition, (list, dict)):
+                return None
+            entry = self.entries.get(hash_key(condition))
+            return set(entry[1]) if entry else set()
+        if '$eq' in condition and not isinstance(condition['$eq'], (list, dict)):
+            entry = self.entries.get(hash_key(condition['$eq']))
+            return set(entry[1]) if entry else set()
+        if '$in' in condition and not any(isinstance(item, (list, dict)) for item in condition['$in']):
+            ids = set()
+            for item in condition['$in']:
+                entry = self.entries.get(hash_key(item))
+                if entry:
+                    ids |= entry[1]
+            return ids
+        if condition.get('$all') and not any(isinstance(item, (list, dict)) for item in condition['$all']):
+            # Multikey: only documents listed under every value
+            ids = None
+            for item in condition['$all']:
+                entry = self.entries.get(hash_key(item))
+                ids = set(entry[1] if entry else ()) if ids is None else ids & (entry[1] if entry else set())
+            return ids
+        ranges = {operator: value for operator, value in condition.items() if operator in ('$gt', '$gte', '$lt', '$lte')}
+        if ranges:
+            # Range over the distinct indexed values, not over the documents
+            ids = set()
+            for value, entry_ids in self.entries.values():
+                if match_field([value], ranges):
+                    ids |= entry_ids
+            return ids
+        return None
+
+
+class MemoryCollection:
+    # Documents of one collection keyed by _id, plus secondary indexes
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.documents = {}  # hash_key(_id) -> document
+        self.positions = {}  # hash_key(_id) -> insertion sequence number, the natural order
+        self.sequence = itertools.count()
+        self.indexes = {}  # index name -> MemoryIndex
+        self.highest = None  # Highest _id in BSON order, MISSING when it must be found again after a delete
+
+    def plan(self, query):
+        # Pick the most selective usable index: (index name, candidate ids), or (None, None) for a full scan
+        query = query or {}
+        best_name, best = None, None
+        if '_id' in query:
+            condition = query['_id']
+            if not is_operator_dict(condition) and not isinstance(condition, (list, dict)):
+                best_name, best = '_id_', {hash_key(condition)}
+            elif is_operator_dict(condition) and '$in' in condition:
+                best_name, best = '_id_', {hash_key(item) for item in condition['$in']}
+        for name, index in self.indexes.items():
+            if index.field in query:
+                ids = index.candidates(query[index.field])
+                if ids is not None and (best is None or len(ids) < len(best)):
+                    best_name, best = name, ids
+        return best_name, best
+
+    def candidates(self, query):
+        # Narrow the scan with the planned index, in natural (insertion) order
+        _, best = self.plan(query)
+        if best is None:
+            return list(self.documents.values())  # Dicts keep insertion order already
+        keys = sorted((key for key in best if key in self.documents), key=self.positions.__getitem__)
+        return [self.documents[key] for key in keys]
+
+    def matching(self, query, sort=None):
+        documents = [document for document in self.candidates(query) if match(document, query)]
+        if sort:
+            sort_documents(documents, sort)
+        return documents
+
+    def highest_id(self):
+        # Highest _id, kept up to date on inserts; a delete of the highest one makes the next call look again
+        if self.highest is MISSING:
+            self.highest = max((document['_id'] for document in self.documents.values()), key=sort_key, default=None)
+        return self.highest
+
+    def index_add(self, document):
+        for index in self.indexes.values():
+            index.add(document)
+
+    def index_remove(self, document):
+        for index in self.indexes.values():
+            index.remove(document)
+
+    def insert(self, document):
+        document = copy.deepcopy(document)
+        document.setdefault('_id', ObjectId())
+        key = hash_key(document['_id'])
+        if key in self.documents:
+            raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} dup key: {document["_id"]!r}')
+        for index in self.indexes.values():
+            index.check_unique(document)
+        self.documents[key] = document
+        self.positions[key] = next(self.sequence)
+        self.index_add(document)
+        if self.highest is not MISSING and (self.highest is None or sort_key(document['_id']) > sort_key(self.highest)):
+            self.highest = document['_id']
+        return document
+
+    def update(self, document, update, array_filters=None):
+        # Update a stored document in place, keeping the indexes in sync
+        if not any(key.startswith('$') for key in update):
+            raise ValueError('Update documents must use update operators')
+        updated = copy.deepcopy(document)
+        changed = apply_update(updated, update, array_filters)
+        if not changed:
+            return False
+        for index in self.indexes.values():
+            index.check_unique(updated, ignore_id=document['_id'])
+        self.index_remove(document)
+        document.clear()
+        document.update(updated)
+        self.index_add(document)
+        return True
+
+    def remove(self, document):
+        self.index_remove(document)
+        key = hash_key(document['_id'])
+        del self.documents[key]
+        del self.positions[key]
+        if self.highest is not MISSING and self.highest is not None and hash_key(self.highest) == key:
+            self.highest = MISSING
+
+    def purge_expired(self, now):
+        # Delete documents past a TTL index deadline
+        removed = 0
+        for index in self.indexes.values():
+            if index.expire_after_seconds is None:
+                continue
+            deadline = now - timedelta(seconds=index.expire_after_seconds)
+            for document in self.matching({index.field: {'$lt': deadline}}):
+                if hash_key(document['_id']) in self.documents:
+                    self.remove(document)
+                    removed += 1
+        return removed
+
+
+class MemoryDatabase:
+    # In-process database: collections in dicts, periodically snapshotted to a BSON file
+    def __init__(self, snapshot_path=None, snapshot_interval=30):
+        self.logger = Logger()  # Logger for logging messages
+        self.snapshot_path = snapshot_path  # File the data is loaded from and saved to, or None to keep it in memory only
+        self.snapshot_interval = snapshot_interval  # Seconds between background snapshots and TTL sweeps
+        self.collections = {}
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __getitem__(self, name):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = MemoryCollection(self, name)
+            return self.collections[name]
+
+    def list_collection_names(self):
+        with self.lock:
+            return list(self.collections)
+
+    def load(self):
+        # Restore the collections and indexes from the snapshot file, if there is one
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        with self.lock, open(self.snapshot_path, 'rb') as snapshot:
+            for record in bson.decode_file_iter(snapshot, codec_options=CODEC_OPTIONS):
+                collection = self[record['collection']]
+                if 'index' in record:
+                    index = record['index']
+                    collection.indexes[index['name']] = MemoryIndex(
+                        [tuple(key) for key in index['keys']], index['unique'], index.get('expireAfterSeconds')
+                    )
+                else:
+                    collection.insert(record['document'])
+        self.logger.info(f'Loaded in-memory database snapshot from {self.snapshot_path}')
+
+    def snapshot(self):
+        # Write every collection to a temporary file, then swap it in so a crash never leaves half a snapshot
+        if not self.snapshot_path:
+            return
+        temporary_path = f'{self.snapshot_path}.tmp'
+        with self.lock:
+            with open(temporary_path, 'wb') as snapshot:
+                for name, collection in self.collections.items():
+                    for index_name, index in collection.indexes.items():
+                        record = {'name': index_name, 'keys': [list(key) for key in index.keys], 'unique': index.unique}
+                        if index.expire_after_seconds is not None:
+                            record['expireAfterSeconds'] = index.expire_after_seconds
+                        snapshot.write(bson.encode({'collection': name, 'index': record}))
+                    for document in collection.documents.values():
+                        snapshot.write(bson.encode({'collection': name, 'document': document}))
+            os.replace(temporary_path, self.snapshot_path)
+            self.dirty = False
+
+    def start(self):
+        # Background thread for TTL expiry and periodic snapshots
+        self.thread = threading.Thread(target=self.maintain, name='memory-engine', daemon=True)
+        self.thread.start()
+
+    def maintain(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            try:
+                with self.lock:
+                    now = datetime.now(timezone.utc)
+                    if sum(collection.purge_expired(now) for collection in self.collections.values()):
+                        self.dirty = True
+                    if self.dirty:
+                        self.snapshot()
+            except Exception as e:
+                self.logger.error(f'In-memory database maintenance failed: {e}')
+
+    def close(self):
+        # Stop the background thread and write a final snapshot
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+        if self.dirty:
+            self.snapshot()
+
+
+class MemoryRepository(Repository):
+    # Repository backed by the in-process engine; same behavior as MongoRepository for the supported operators
+    def __init__(self, db_conn, collection_name):
+        self.db_conn = db_conn  # Database connection holding the MemoryDatabase
+        self.collection_name = collection_name  # Collection this repository reads and writes
+
+    @property
+    def database(self):
+        return self.db_conn.db
+
+    @property
+    def collection(self):
+        return self.db_conn.db[self.collection_name]
+
+    def written(self):
+        self.database.dirty = True
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        with self.database.lock:
+            documents = self.collection.matching(filter, sort)
+            if skip:
+                documents = documents[skip:]
+            if limit:
+                documents = documents[:limit]
+            return [project(document, projection) for document in documents]
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        with self.database.lock:
+            documents = self.collection.matching(filter, sort)
+            return project(documents[0], projection) if documents else None
+
+    def insert_one(self, document):
+        with self.database.lock:
+            stored = self.collection.insert(document)
+            document.setdefault('_id', stored['_id'])
+            self.written()
+
+    def insert_many(self, documents):
+        with self.database.lock:
+            for document in documents:
+                self.insert_one(document)
+
+    def upsert_many(self, documents):
+        with self.database.lock:
+            for document in documents:
+                self.replace_one({'_id': document['_id']}, document, upsert=True)
+
+    def update_one(self, filter, update, upsert=False, array_filters=None):
+        with self.database.lock:
+            documents = self.collection.matching(filter)
+            if documents:
+                modified = int(self.collection.update(documents[0], update, array_filters))
+            elif upsert:
+                self.collection.insert(upsert_document(filter, update, array_filters))
+                modified = 0
+            else:
+                return 0
+            self.written()
+            return modified
+
+    def update_many(self, filter, update, array_filters=None):
+        with self.database.lock:
+            modified = sum(int(self.collection.update(document, update, array_filters))
+                           for document in self.collection.matching(filter))
+            if modified:
+                self.written()
+            return modified
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, before=False):
+        with self.database.lock:
+            documents = self.collection.matching(filter, sort)
+            if documents:
+                document = documents[0]
+                previous = project(document, projection)  # The update changes the stored document in place
+                self.collection.update(document, update)
+            elif upsert:
+                document = self.collection.insert(upsert_document(filter, update))
+                previous = None  # Like MongoDB, an upsert has no document from before
+            else:
+                return None
+            self.written()
+            return previous if before else project(document, projection)
+
+    def replace_one(self, filter, document, upsert=False):
+        with self.database.lock:
+            documents = self.collection.matching(filter)
+            if documents:
+                replacement = dict(document, _id=documents[0]['_id'])
+                self.collection.remove(documents[0])
+                self.collection.insert(replacement)
+                self.written()
+                return 1
+            if upsert:
+                # Like MongoDB, a replacement without an _id takes the one the filter names
+                identifier = upsert_document({'_id': filter['_id']}, {}).get('_id') if '_id' in filter else None
+                self.collection.insert(dict(document, _id=identifier) if identifier is not None and '_id' not in document else document)
+                self.written()
+            return 0
+
+    def delete_one(self, filter):
+        with self.database.lock:
+            documents = self.collection.matching(filter)
+            if not documents:
+                return 0
+            self.collection.remove(documents[0])
+            self.written()
+            return 1
+
+    def delete_many(self, filter):
+        with self.database.lock:
+            documents = self.collection.matching(filter)
+            for document in documents:
+                self.collection.remove(document)
+            if documents:
+                self.written()
+            return len(documents)
+
+    def count(self, filter=None, limit=0):
+        with self.database.lock:
+            total = len(self.collection.matching(filter)) if filter else len(self.collection.documents)
+            return min(total, limit) if limit else total
+
+    def distinct(self, field, filter=None):
+        with self.database.lock:
+            values = {}
+            for document in self.collection.matching(filter):
+                for value in expand(get_path(document, field)):
+                    if not isinstance(value, list):
+                        values.setdefault(hash_key(value), value)
+            return list(values.values())
+
+    def aggregate(self, pipeline):
+        with self.database.lock:
+            # A leading $match can use the indexes
+            if pipeline and '$match' in pipeline[0]:
+                documents = self.collection.matching(pipeline[0]['$match'])
+                pipeline = pipeline[1:]
+            else:
+                documents = self.collection.matching({})
+            return run_pipeline([copy.deepcopy(document) for document in documents], pipeline)
+
+    def create_index(self, keys, unique=False, expire_after_seconds=None):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = [tuple(key) for key in keys]
+        name = '_'.join(f'{field}_{direction}' for field, direction in keys)
+        with self.database.lock:
+            if name not in self.collection.indexes:
+                index = MemoryIndex(keys, unique, expire_after_seconds)
+                for document in self.collection.documents.values():
+                    index.check_unique(document, ignore_id=document['_id'])
+                    index.add(document)
+                self.collection.indexes[name] = index
+                self.written()
+        return name
+
+    def watch(self, resume_after=None, max_await_time_ms=None):
+        raise NotImplementedError('The in-memory engine has no change streams')
+
+    def next_id(self):
+        # From the tracked highest _id, without sorting or copying the collection
+        with self.database.lock:
+            highest = self.collection.highest_id()
+        return highest + 1 if highest is not None else 1
+
+    def index_names(self):
+        with self.database.lock:
+            return ['_id_'] + list(self.collection.indexes)
+
+    def explain(self, filter=None, sort=None):
+        # Same shape as MongoDB's winning plan; sorts always happen in memory here
+        with self.database.lock:
+            name, _ = self.collection.plan(filter)
+        stages = ['SORT'] if sort else []
+        if name is None:
+            return {'stages': stages + ['COLLSCAN'], 'indexes': []}
+        if name == '_id_':
+            return {'stages': stages + ['IDHACK'], 'indexes': [name]}
+        return {'stages': stages + ['FETCH', 'IXSCAN'], 'indexes': [name]}
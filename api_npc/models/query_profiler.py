@@ -0,0 +1,214 @@
+import json
+import os
+import random
+import threading
+import time
+
+from logger.logger_base import Logger
+from models.repository import Repository
+
+
+def query_shape(value):
+    # Field names and operators of a filter with the values left out: {'name': {'$in': '?'}}
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return [query_shape(item) for item in value]  # $and / $or clauses
+    return '?'
+
+
+def sort_shape(sort):
+    # [('name', 1), ('_id', -1)] -> 'name_1,_id_-1'
+    if not sort:
+        return None
+    if isinstance(sort, str):
+        return f'{sort}_1'
+    return ','.join(f'{field}_{direction}' for field, direction in sort)
+
+
+class QueryProfiler:
+    # Times every storage operation, logs the slow ones and keeps the worst query shapes per collection
+    def __init__(self, threshold_ms=100, explain_sample=0.1, max_shapes=100, explain_interval=60):
+        self.logger = Logger()  # Logger for logging messages
+        self.threshold_ms = threshold_ms  # Operations at or over this many milliseconds are slow
+        self.explain_sample = explain_sample  # Fraction of slow operations whose plan is captured
+        self.max_shapes = max_shapes  # Shapes kept per collection; the one with the least total time goes first
+        self.explain_interval = explain_interval  # Seconds before the same shape is explained again
+        self.shapes = {}  # collection -> {shape key -> entry}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        # On unless SLOW_QUERY_LOG=0; SLOW_QUERY_MS is the threshold, SLOW_QUERY_EXPLAIN the explain sample rate
+        if os.environ.get('SLOW_QUERY_LOG', '1').lower() in ('0', 'false', 'no'):
+            return None
+        return cls(
+            threshold_ms=float(os.environ.get('SLOW_QUERY_MS', 100)),
+            explain_sample=float(os.environ.get('SLOW_QUERY_EXPLAIN', 0.1)),
+        )
+
+    def wrap(self, repository):
+        return ProfiledRepository(repository, self)
+
+    def record(self, repository, operation, filter, sort, seconds):
+        elapsed_ms = seconds * 1000
+        if elapsed_ms < self.threshold_ms:
+            return
+        filter_shape = json.dumps(query_shape(filter or {}), sort_keys=True)
+        sort_key = sort_shape(sort)
+        collection = repository.collection_name
+        self.logger.warning(
+            f'Slow query on {collection}: {operation} filter={filter_shape} sort={sort_key} took {elapsed_ms:.1f} ms'
+        )
+
+        key = f'{operation} {filter_shape} {sort_key}'
+        now = time.time()
+        with self.lock:
+            shapes = self.shapes.setdefault(collection, {})
+            entry = shapes.get(key)
+            if entry is None:
+                if len(shapes) >= self.max_shapes:
+                    del shapes[min(shapes, key=lambda name: shapes[name]['totalMs'])]
+                entry = shapes[key] = {
+                    'operation': operation, 'filter': filter_shape, 'sort': sort_key,
+                    'count': 0, 'totalMs': 0.0, 'maxMs': 0.0, 'lastMs': 0.0, 'lastSeen': None,
+                    'plan': None, 'explainedAt': 0,
+                }
+            entry['count'] += 1
+            entry['totalMs'] += elapsed_ms
+            entry['maxMs'] = max(entry['maxMs'], elapsed_ms)
+            entry['lastMs'] = elapsed_ms
+            entry['lastSeen'] = int(now * 1000)  # Epoch milliseconds, like updatedAt
+            # Inserts and bulk upserts have no plan; everything else is planned like a find with the same filter
+            explain = (not operation.startswith(('insert', 'upsert')) and now - entry['explainedAt'] >= self.explain_interval
+                       and random.random() < self.explain_sample)
+            if explain:
+                entry['explainedAt'] = now
+
+        if explain:
+            # Off the request thread: the plan is for the report, the caller already waited long enough
+            threading.Thread(target=self.explain, args=(repository, entry, filter, sort), daemon=True).start()
+
+    def explain(self, repository, entry, filter, sort):
+        try:
+            plan = repository.explain(filter, sort)
+        except Exception as e:
+            self.logger.warning(f'Could not explain a slow query on {repository.collection_name}: {e}')
+            return
+        with self.lock:
+            entry['plan'] = plan
+        if 'COLLSCAN' in plan['stages']:
+            self.logger.warning(f'Slow query on {repository.collection_name} is a collection scan: {entry["filter"]}')
+
+    def top(self, limit=10, collection=None):
+        # Worst shapes per collection by total time spent in them
+        with self.lock:
+            return {
+                name: [report_entry(entry) for entry in sorted(shapes.values(), key=lambda entry: entry['totalMs'], reverse=True)[:limit]]
+                for name, shapes in self.shapes.items()
+                if collection is None or name == collection
+            }
+
+
+def report_entry(entry):
+    report = {key: value for key, value in entry.items() if key != 'explainedAt'}
+    for key in ('totalMs', 'maxMs', 'lastMs'):
+        report[key] = round(report[key], 3)
+    return report
+
+
+class ProfiledRepository(Repository):
+    # Times each call of the wrapped repository; cursors are timed while they are being read
+    def __init__(self, repository, profiler):
+        self.repository = repository
+        self.profiler = profiler
+        self.collection_name = repository.collection_name
+
+    def timed(self, operation, filter, sort, call, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            self.profiler.record(self.repository, operation, filter, sort, time.perf_counter() - started)
+
+    def timed_cursor(self, operation, filter, sort, call, *args):
+        # Only the time spent fetching counts, not the time the caller spends on each document
+        started = time.perf_counter()
+        iterator = iter(call(*args))
+        elapsed = time.perf_counter() - started
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    document = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield document
+        finally:
+            self.profiler.record(self.repository, operation, filter, sort, elapsed)
+
+    def find(self, filter=None, projection=None, sort=None, limit=0, skip=0):
+        return self.timed_cursor('find', filter, sort, self.repository.find, filter, projection, sort, limit, skip)
+
+    def find_one(self, filter=None, projection=None, sort=None):
+        return self.timed('find_one', filter, sort, self.repository.find_one, filter, projection, sort)
+
+    def insert_one(self, document):
+        return self.timed('insert_one', None, None, self.repository.insert_one, document)
+
+    def insert_many(self, documents):
+        return self.timed('insert_many', None, None, self.repository.insert_many, documents)
+
+    def upsert_many(self, documents):
+        return self.timed('upsert_many', None, None, self.repository.upsert_many, documents)
+
+    def update_one(self, filter, update, upsert=False, array_filters=None):
+        return self.timed('update_one', filter, None, self.repository.update_one, filter, update, upsert, array_filters)
+
+    def update_many(self, filter, update, array_filters=None):
+        return self.timed('update_many', filter, None, self.repository.update_many, filter, update, array_filters)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, before=False):
+        return self.timed('find_one_and_update', filter, sort, self.repository.find_one_and_update,
+                          filter, update, projection, sort, upsert, before)
+
+    def replace_one(self, filter, document, upsert=False):
+        return self.timed('replace_one', filter, None, self.repository.replace_one, filter, document, upsert)
+
+    def delete_one(self, filter):
+        return self.timed('delete_one', filter, None, self.repository.delete_one, filter)
+
+    def delete_many(self, filter):
+        return self.timed('delete_many', filter, None, self.repository.delete_many, filter)
+
+    def count(self, filter=None, limit=0):
+        return self.timed('count', filter, None, self.repository.count, filter, limit)
+
+    def estimated_count(self):
+        return self.timed('estimated_count', None, None, self.repository.estimated_count)
+
+    def distinct(self, field, filter=None):
+        return self.timed('distinct', filter, None, self.repository.distinct, field, filter)
+
+    def aggregate(self, pipeline):
+        # Shape of the leading $match, which is what the indexes can serve
+        match = pipeline[0]['$match'] if pipeline and '$match' in pipeline[0] else None
+        return self.timed_cursor('aggregate', match, None, self.repository.aggregate, pipeline)
+
+    def create_index(self, keys, unique=False, expire_after_seconds=None):
+        return self.repository.create_index(keys, unique, expire_after_seconds)
+
+    def index_names(self):
+        return self.repository.index_names()
+
+    def watch(self, resume_after=None, max_await_time_ms=None):
+        return self.repository.watch(resume_after, max_await_time_ms)
+
+    def explain(self, filter=None, sort=None):
+        return self.repository.explain(filter, sort)
+
+    def next_id(self):
+        # The wrapped engine's own next_id, which may be cheaper than the generic sort
+        return self.timed('next_id', None, [('_id', -1)], self.repository.next_id)
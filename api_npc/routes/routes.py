@@ -1,10 +1,15 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from marshmallow import ValidationError
 from logger.logger_base import Logger
-from flasgger import swag_from
+from routes.docs import swag_from  # flasgger's swag_from, or a no-op when the docs are prebuilt
+from services.delta_sync import parse_cursor
+from schemas.inventory import parse_inventory, parse_money
 
 # Define routes for managing npcs (add, update, delete, etc.)
 class NpcRoutes(Blueprint):
+    # Fields a PATCH request may change, each checked with the matching validate_* method
+    PATCH_FIELDS = ('named', 'role', 'picture', 'personality', 'inventory', 'likes', 'money', 'backstory')
+
     def __init__(self, npc_service, npc_schema):
         super().__init__('npc', __name__)  # Initialize the Blueprint
         self.npc_service = npc_service  # Service to handle database operations
@@ -17,7 +22,17 @@ class NpcRoutes(Blueprint):
         self.route('/api/v1/npcs', methods=['GET'])(self.get_npcs)
         self.route('/api/v1/npcs', methods=['POST'])(self.add_npcs)
         self.route('/api/v1/npcs/<int:npc_id>', methods=['PUT'])(self.update_npc)
+        self.route('/api/v1/npcs/<int:npc_id>', methods=['PATCH'])(self.patch_npc)
         self.route('/api/v1/npcs/<int:npc_id>', methods=['DELETE'])(self.delete_npc)
+        self.route('/api/v1/npcs/events', methods=['GET'])(self.stream_events)
+        self.route('/api/v1/npcs/changes', methods=['GET'])(self.get_changes)
+        self.route('/api/v1/npcs/stats', methods=['GET'])(self.get_stats)
+        self.route('/api/v1/npcs/jobs', methods=['POST'])(self.submit_job)
+        self.route('/api/v1/npcs/jobs/<job_id>', methods=['GET'])(self.get_job)
+        self.route('/api/v1/npcs/export', methods=['GET'])(self.export_npcs)
+        self.route('/api/v1/npcs/import', methods=['POST'])(self.import_npcs)
+        self.route('/api/v1/npcs/gold', methods=['GET'])(self.get_party_gold)
+        self.route('/api/v1/npcs/items', methods=['GET'])(self.find_item)
         self.route('/healthcheck', methods=['GET'])(self.healthcheck)
 
     @swag_from({
@@ -41,11 +56,20 @@ class NpcRoutes(Blueprint):
                     },
                     'required': ['named', 'role', 'picture', 'personality', 'inventory', 'likes', 'money', 'backstory']  # These fields are required
                 }
+            },
+            {
+                'name': 'Idempotency-Key',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Unique key per logical request; a retry with the same key gets the first response back instead of a duplicate'
             }
         ],
         'responses': {
             200: {'description': 'Npc successfully created'},
             400: {'description': 'Invalid data'},
+            409: {'description': 'A request with the same Idempotency-Key is still in progress'},
+            422: {'description': 'The Idempotency-Key was already used for a different request'},
             500: {'description': 'Internal server error'}
         }
     })
@@ -93,7 +117,9 @@ class NpcRoutes(Blueprint):
                 'inventory': inventory,
                 'likes': likes,
                 'money': money,
-                'backstory': backstory
+                'backstory': backstory,
+                'items': parse_inventory(inventory),  # Structured inventory for the item lookup
+                'moneyCp': parse_money(money),  # Money in copper pieces, None if not readable
             }
             created_npc = self.npc_service.add_npc(new_npc)  # Add the npc to the database
             self.logger.info(f'New npc: {created_npc}')  # Log the new npc creation
@@ -143,7 +169,9 @@ class NpcRoutes(Blueprint):
                 'inventory': inventory,
                 'likes': likes,
                 'money': money,
-                'backstory': backstory
+                'backstory': backstory,
+                'items': parse_inventory(inventory),  # Structured inventory for the item lookup
+                'moneyCp': parse_money(money),  # Money in copper pieces, None if not readable
             }
             updated_npc = self.npc_service.update_npc(npc_id, update_npc)  # Update the npc in the database
             if updated_npc:
@@ -155,6 +183,100 @@ class NpcRoutes(Blueprint):
             self.logger.error(f'Error updating the npc in the database: {e}')
             return jsonify({'error': f'Error updating the npc in the database: {e}'}), 500  # Handle any errors
 
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Update only some fields of a npc',
+        'parameters': [
+            {
+                'name': 'npc_id',
+                'in': 'path',
+                'required': True,
+                'type': 'integer',
+                'description': 'ID of the npc to update'
+            },
+            {
+                'name': 'If-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; the update is rejected if the npc changed since'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'named': {'type': 'string'},
+                        'role': {'type': 'string'},
+                        'picture': {'type': 'string'},
+                        'personality': {'type': 'string'},
+                        'inventory': {'type': 'string'},
+                        'likes': {'type': 'string'},
+                        'money': {'type': 'string'},
+                        'backstory': {'type': 'string'},
+                    }
+                }
+            }
+        ],
+        'responses': {
+            200: {'description': 'The changed fields, with the new version in the ETag header'},
+            400: {'description': 'Invalid data'},
+            404: {'description': 'Npc not found'},
+            412: {'description': 'The npc was changed by someone else'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def patch_npc(self, npc_id):
+        # Update only the fields sent by the client
+        try:
+            request_data = request.json  # Get the changed fields
+
+            if not request_data:
+                return jsonify({'error': 'Invalid data, empty'}), 400  # Check if data is empty
+
+            unknown_fields = sorted(set(request_data) - set(self.PATCH_FIELDS))
+            if unknown_fields:
+                return jsonify({'error': f'Invalid data: unknown fields {unknown_fields}'}), 400
+
+            # Optional optimistic concurrency check against the version the client last saw
+            expected_version = None
+            if_match = request.headers.get('If-Match')
+            if if_match:
+                expected_version = if_match.removeprefix('W/').strip('"')
+                if not expected_version.isdigit():
+                    return jsonify({'error': 'Invalid If-Match header'}), 400
+                expected_version = int(expected_version)
+
+            # Validate only the supplied fields using the schema
+            try:
+                for field, value in request_data.items():
+                    if value is None:
+                        raise ValidationError(f'{field} must not be null')
+                    getattr(self.npc_schema, f'validate_{field}')(value)
+            except ValidationError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400  # Return error if validation fails
+
+            changes = dict(request_data)
+            if 'inventory' in changes:
+                changes['items'] = parse_inventory(changes['inventory'])  # Keep the structured inventory in sync
+            if 'money' in changes:
+                changes['moneyCp'] = parse_money(changes['money'])
+            patched_npc = self.npc_service.patch_npc(npc_id, changes, expected_version)  # Update the npc in the database
+            if patched_npc is None:
+                return jsonify({'error': 'Npc not found'}), 404  # If npc not found, return an error
+            if patched_npc is False:
+                return jsonify({'error': 'Npc was modified by another request'}), 412  # Version mismatch
+
+            response = jsonify(patched_npc)
+            response.headers['ETag'] = f'"{patched_npc["updatedAt"]}"'  # New version for the next If-Match
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error patching the npc in the database: {e}')
+            return jsonify({'error': f'Error patching the npc in the database: {e}'}), 500  # Handle any errors
+
     def delete_npc(self, npc_id):
         # Delete a npc by its ID
         try:
@@ -169,6 +291,353 @@ class NpcRoutes(Blueprint):
             self.logger.error(f'Error deleting the npc from the database: {e}')
             return jsonify({'error': f'Error deleting the npc from the database: {e}'}), 500  # Handle any errors
         
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Stream npcs changes as Server-Sent Events',
+        'parameters': [
+            {
+                'name': 'Last-Event-ID',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Id of the last event received, to replay what was missed while disconnected'
+            }
+        ],
+        'produces': ['text/event-stream'],
+        'responses': {
+            200: {'description': 'Stream of insert, update, replace and delete events'},
+            503: {'description': 'Too many open event streams in this process'}
+        }
+    })
+    def stream_events(self):
+        # Push changes to the client instead of having it poll the list endpoint
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+        change_feed = self.npc_service.change_feed
+        if not change_feed.open_stream():
+            # Each open stream holds a server thread, so past the cap the client should come back later
+            response = jsonify({'error': 'Too many open event streams, try again shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        response = Response(change_feed.stream(last_event_id), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Don't let a reverse proxy hold events back
+        })
+        response.call_on_close(change_feed.close_stream)
+        return response
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Npc changes since the last sync',
+        'parameters': [
+            {
+                'name': 'since',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Epoch milliseconds, or the next value of the previous response (0 or omitted for everything)'
+            },
+            {
+                'name': 'limit',
+                'in': 'query',
+                'required': False,
+                'type': 'integer',
+                'description': 'Maximum changes per response, 1 to 5000 (default 1000)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Deleted ids and changed npcs; apply deleted first, then changed'},
+            400: {'description': 'Invalid since or limit'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_changes(self):
+        # Get only the npcs changed or deleted since the given time
+        try:
+            limit = request.args.get('limit', '1000')
+            if not limit.isdigit() or not 1 <= int(limit) <= 5000:
+                return jsonify({'error': 'Invalid data: limit must be between 1 and 5000'}), 400
+            try:
+                since = parse_cursor(request.args.get('since', '0'))  # Epoch milliseconds or the cursor of the last page
+            except ValueError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400
+
+            changes = self.npc_service.get_changes(since, int(limit))
+            return jsonify(changes), 200  # Return the changes as JSON
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the npc changes: {e}')
+            return jsonify({'error': f'Error fetching the npc changes: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Counts of the npcs per role',
+        'parameters': [
+            {
+                'name': 'If-None-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; answered with 304 while the npcs are unchanged'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Total and counts per value, most common first, with the version in the ETag header'},
+            304: {'description': 'The npcs did not change since the given ETag'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_stats(self):
+        # Get the dashboard counts, aggregated in the database and cached until the npcs change
+        try:
+            stats = self.npc_service.get_stats()
+            if isinstance(stats, tuple):
+                return stats  # Error response from the service
+
+            etag = f'"{stats["version"]}"'
+            if etag in request.headers.get('If-None-Match', ''):
+                return '', 304, {'ETag': etag}  # The client's copy is still current
+            response = jsonify(stats)
+            response.headers['ETag'] = etag
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error computing the npc stats: {e}')
+            return jsonify({'error': f'Error computing the npc stats: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Run a long operation in the background',
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'type': {'type': 'string', 'description': 'Job type: reindex, export or import'},
+                        'params': {'type': 'object', 'description': 'Parameters of the job; export and import take path (a file name in ARCHIVE_DIR), format and, for import, mode'}
+                    },
+                    'required': ['type']
+                }
+            }
+        ],
+        'responses': {
+            202: {'description': 'Job queued; poll the URL in the Location header for its status'},
+            400: {'description': 'Unknown job type or invalid params'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def submit_job(self):
+        # Queue a job for the workers instead of running it inside the request
+        try:
+            request_data = request.json or {}
+            params = request_data.get('params', {})
+            if not isinstance(request_data.get('type'), str) or not isinstance(params, dict):
+                return jsonify({'error': 'Invalid data: type must be a string and params an object'}), 400
+
+            job = self.npc_service.submit_job(request_data['type'], params)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            response = jsonify({'_id': job['_id'], 'type': job['type'], 'status': job['status']})
+            response.headers['Location'] = f'/api/v1/npcs/jobs/{job["_id"]}'
+            return response, 202
+
+        except Exception as e:
+            self.logger.error(f'Error submitting the npc job: {e}')
+            return jsonify({'error': f'Error submitting the npc job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Status of a background job',
+        'parameters': [
+            {
+                'name': 'job_id',
+                'in': 'path',
+                'required': True,
+                'type': 'string',
+                'description': 'ID returned when the job was submitted'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Status (queued, running, succeeded or failed), attempts, progress, result and last error'},
+            404: {'description': 'Job not found'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_job(self, job_id):
+        # Get the status and progress of a job
+        try:
+            job = self.npc_service.get_job(job_id)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            if not job:
+                return jsonify({'error': 'Job not found'}), 404
+            return jsonify(job), 200
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the npc job: {e}')
+            return jsonify({'error': f'Error fetching the npc job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Download every npc as a compressed archive',
+        'produces': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Gzip stream of a header record followed by the npcs, sent as it is read'},
+            400: {'description': 'Unknown format'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def export_npcs(self):
+        # Stream the archive so neither side holds the whole collection in memory
+        try:
+            archive_format = request.args.get('format', 'bson')
+            chunks = self.npc_service.export_archive(archive_format)
+            if isinstance(chunks, tuple):
+                return chunks  # Error response from the service
+            return Response(chunks, mimetype='application/gzip', headers={
+                'Content-Disposition': f'attachment; filename="npcs.{archive_format}.gz"',
+            })
+
+        except Exception as e:
+            self.logger.error(f'Error exporting the npcs: {e}')
+            return jsonify({'error': f'Error exporting the npcs: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Load npcs from a compressed archive',
+        'consumes': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            },
+            {
+                'name': 'mode',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['upsert', 'insert'],
+                'description': 'upsert replaces npcs with the same ID (default); insert is faster but fails on existing IDs'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {'type': 'string', 'format': 'binary'},
+                'description': 'Archive as written by the export endpoint'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Number of npcs imported'},
+            400: {'description': 'Unknown format or mode, or not a npcs archive'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def import_npcs(self):
+        # Import the archive in batches while the body is still arriving; larger files go through an import job
+        try:
+            result = self.npc_service.import_archive(
+                request.stream, request.args.get('format', 'bson'), request.args.get('mode', 'upsert'),
+            )
+            if isinstance(result, tuple):
+                return result  # Error response from the service
+            return jsonify(result), 200
+
+        except Exception as e:
+            self.logger.error(f'Error importing the npcs: {e}')
+            return jsonify({'error': f'Error importing the npcs: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Total money of a group of npcs',
+        'parameters': [
+            {
+                'name': 'ids',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Comma-separated npc IDs the party can reach (e.g. 1,4,7); all npcs when omitted'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Number of npcs and their money in copper, in gold and in coins'},
+            400: {'description': 'Invalid ids'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_party_gold(self):
+        # Add up the money of the npcs in the database instead of downloading them
+        try:
+            ids = request.args.get('ids', '')
+            npc_ids = [part.strip() for part in ids.split(',') if part.strip()]
+            if not all(npc_id.isdigit() for npc_id in npc_ids):
+                return jsonify({'error': 'Invalid data: ids must be comma-separated integers'}), 400
+
+            gold = self.npc_service.get_party_gold([int(npc_id) for npc_id in npc_ids])
+            return jsonify(gold), 200
+
+        except Exception as e:
+            self.logger.error(f'Error adding up the npc money: {e}')
+            return jsonify({'error': f'Error adding up the npc money: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['Npcs'],
+        'summary': 'Npcs carrying an item',
+        'parameters': [
+            {
+                'name': 'name',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Item name, singular or plural (e.g. dagger)'
+            },
+            {
+                'name': 'weaponId',
+                'in': 'query',
+                'required': False,
+                'type': 'integer',
+                'description': 'Weapon ID, instead of the name'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Total quantity and the npcs carrying the item, most first'},
+            400: {'description': 'Missing name or weaponId'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def find_item(self):
+        # Look an item up across every npc inventory
+        try:
+            name = request.args.get('name', '').strip()
+            weapon_id = request.args.get('weaponId', '')
+            if weapon_id and not weapon_id.isdigit():
+                return jsonify({'error': 'Invalid data: weaponId must be an integer'}), 400
+            if not name and not weapon_id:
+                return jsonify({'error': 'Invalid data: name or weaponId is required'}), 400
+
+            items = self.npc_service.find_item(name, int(weapon_id) if weapon_id else None)
+            return jsonify(items), 200
+
+        except Exception as e:
+            self.logger.error(f'Error looking up the item in the npc inventories: {e}')
+            return jsonify({'error': f'Error looking up the item in the npc inventories: {e}'}), 500  # Handle any errors
+
     def healthcheck(self):
         # Health check to verify the server is up
         return jsonify({'status': 'up'}), 200
@@ -0,0 +1,90 @@
+import re
+
+# Items are separated by commas or semicolons, except inside parentheses: "Rope (hemp, 50 ft), 2 daggers"
+ITEM_SEPARATOR = re.compile(r'[,;](?![^()]*\))')
+
+# Quantity before the name ("2 daggers", "3x torches") or after it ("torch x3", "torches (3)")
+LEADING_QUANTITY = re.compile(r'^(?:and\s+)?(?P<qty>\d+)\s*[x×]?\s+(?P<name>.+)$', re.IGNORECASE)
+TRAILING_QUANTITY = re.compile(r'^(?:and\s+)?(?P<name>.+?)\s*(?:[x×]\s*(?P<qty>\d+)|\((?P<paren>\d+)\))$', re.IGNORECASE)
+
+PARENTHESES = re.compile(r'\([^()]*\)')
+
+# Value of each coin in copper pieces
+COIN_VALUES = {'cp': 1, 'sp': 10, 'ep': 50, 'gp': 100, 'pp': 1000}
+COIN_NAMES = {'copper': 'cp', 'silver': 'sp', 'electrum': 'ep', 'gold': 'gp', 'platinum': 'pp'}
+COIN_PATTERN = re.compile(
+    r'(?P<amount>\d+(?:\.\d+)?)\s*(?P<coin>cp|sp|ep|gp|pp|copper|silver|electrum|gold|platinum)\b(?:\s*pieces?)?',
+    re.IGNORECASE,
+)
+
+# Values that mean the NPC carries nothing
+EMPTY_VALUES = {'', '-', 'none', 'nothing', 'n/a'}
+
+
+def item_key(name):
+    # Lookup key shared by the stored items and the ?name= query: lowercase, no notes in parentheses, singular
+    key = ' '.join(PARENTHESES.sub(' ', name).lower().split())
+    if len(key) > 3 and key.endswith('es') and key[-3] in 'shxz':
+        return key[:-2]  # torches -> torch
+    if len(key) > 3 and key.endswith('s') and not key.endswith('ss'):
+        return key[:-1]  # daggers -> dagger
+    return key
+
+
+def parse_inventory(value):
+    # "2 daggers, rope (50 ft), torch x3" -> [{'name': 'daggers', 'key': 'dagger', 'qty': 2},
+    #     {'name': 'rope (50 ft)', 'key': 'rope', 'qty': 1}, {'name': 'torch', 'key': 'torch', 'qty': 3}]
+    if not isinstance(value, str):
+        return []
+    items = {}
+    for part in ITEM_SEPARATOR.split(value):
+        part = ' '.join(part.split()).strip(' .')
+        if part.lower() in EMPTY_VALUES:
+            continue
+        qty = 1
+        match = LEADING_QUANTITY.match(part)
+        if match:
+            qty, part = int(match.group('qty')), match.group('name')
+        else:
+            match = TRAILING_QUANTITY.match(part)
+            if match:
+                qty, part = int(match.group('qty') or match.group('paren')), match.group('name')
+        key = item_key(part)
+        if not key:
+            continue
+        if key in items:
+            items[key]['qty'] += qty  # "dagger, dagger" is two daggers
+        elif qty > 0:
+            items[key] = {'name': part, 'key': key, 'qty': qty}
+    return list(items.values())
+
+
+def parse_money(value):
+    # Total in copper pieces: "15 gp, 3 sp" -> 1530; None when there is no amount to read
+    if not isinstance(value, str):
+        return None
+    if value.strip().lower() in EMPTY_VALUES:
+        return 0
+    total, found = 0, False
+    for match in COIN_PATTERN.finditer(value):
+        coin = match.group('coin').lower()
+        total += float(match.group('amount')) * COIN_VALUES[COIN_NAMES.get(coin, coin)]
+        found = True
+    return round(total) if found else None
+
+
+def format_copper(copper):
+    # 1530 -> {'gp': 15, 'sp': 3, 'cp': 0}, the way a shopkeeper would count it out
+    gold, rest = divmod(copper, COIN_VALUES['gp'])
+    silver, copper = divmod(rest, COIN_VALUES['sp'])
+    return {'gp': gold, 'sp': silver, 'cp': copper}
+
+
+if __name__ == '__main__':
+    from logger.logger_base import Logger  # Import the custom logger
+
+    logger = Logger()
+    for example in ['2 daggers, 1 rope, 3 torches', 'Longsword; healing potion x2; rope (hemp, 50 ft)', 'None']:
+        logger.info(f'{example!r} -> {parse_inventory(example)}')
+    for example in ['15 gp, 3 sp', '2 platinum pieces and 5 copper', 'a few coins']:
+        logger.info(f'{example!r} -> {parse_money(example)}')
@@ -1,4 +1,5 @@
 from marshmallow import fields, validates, ValidationError
+import re
 
 # This npc defines the fields we need to validate
 class NpcSchema:
@@ -0,0 +1,110 @@
+import base64
+import binascii
+import time
+from datetime import datetime, timedelta, timezone
+
+import bson
+from bson.errors import InvalidBSON
+
+# Tombstones are kept this long; clients offline for longer must do a full resync
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+# Writes stamped just before a sync may commit just after it, so the next sync re-reads this window
+SAFETY_WINDOW_MS = 1000
+
+
+def now_ms():
+    # Current time in epoch milliseconds, the unit used for updatedAt and the since parameter
+    return int(time.time() * 1000)
+
+
+def ensure_sync_indexes(repository, tombstones):
+    # Index the change keysets (timestamp, then _id) so delta queries never scan the collection
+    repository.create_index([('updatedAt', 1), ('_id', 1)])
+    tombstones.create_index([('collection', 1), ('deletedAt', 1), ('_id', 1)])
+    tombstones.create_index('expiresAt', expire_after_seconds=0)
+    # Documents written before updatedAt existed are reported once as changed
+    repository.update_many({'updatedAt': {'$exists': False}}, {'$set': {'updatedAt': now_ms()}})
+
+
+def record_tombstone(tombstones, collection_name, document_id):
+    # Remember a deletion so offline clients can drop the document on their next sync
+    deleted_at = now_ms()
+    tombstones.insert_one({
+        'collection': collection_name,
+        'documentId': document_id,
+        'deletedAt': deleted_at,
+        'expiresAt': datetime.now(timezone.utc) + TOMBSTONE_RETENTION,
+    })
+    return deleted_at
+
+
+def make_cursor(since, changed_after, deleted_after):
+    # Position inside a millisecond: the last changed document and tombstone already sent at that time
+    # Many documents can share an updatedAt (a backfill stamps them all at once), so a time alone can't resume a page
+    encoded = bson.encode({'since': since, 'changed': changed_after, 'deleted': deleted_after})
+    return base64.urlsafe_b64encode(encoded).decode().rstrip('=')
+
+
+def parse_cursor(value):
+    # The since parameter: epoch milliseconds, or the cursor of a previous page -> (since, changed_after, deleted_after)
+    if value.isdigit():
+        return int(value), None, None
+    try:
+        cursor = bson.decode(base64.urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+        return int(cursor['since']), cursor.get('changed'), cursor.get('deleted')
+    except (binascii.Error, InvalidBSON, KeyError, TypeError, ValueError, IndexError):
+        raise ValueError('since must be epoch milliseconds or the next value of a previous response')
+
+
+def after(field, since, last_id):
+    # Keyset condition: later than since, or at since with a greater _id than the last one sent
+    if last_id is None:
+        return {field: {'$gte': since}}
+    return {'$or': [{field: {'$gt': since}}, {field: since, '_id': {'$gt': last_id}}]}
+
+
+def last_id(items, field, cut, previous):
+    # _id of the last item sent at the cut time; the previous cursor's when this page sent none at that time
+    if items and items[-1][field] == cut:
+        return items[-1]['_id']
+    return previous
+
+
+def get_changes(repository, tombstones, collection_name, since, limit):
+    # Documents changed and deleted since the given time, oldest first; since is inclusive
+    # since is epoch milliseconds or a parsed cursor (since, changed_after, deleted_after) from parse_cursor
+    since, changed_after, deleted_after = since if isinstance(since, tuple) else (since, None, None)
+    now = now_ms()
+    if since and since < now - TOMBSTONE_RETENTION.total_seconds() * 1000:
+        # Deletions this old have expired, so only a full reload is correct
+        return {'fullResync': True}
+
+    changed = list(repository.find(after('updatedAt', since, changed_after), sort=[('updatedAt', 1), ('_id', 1)], limit=limit + 1))
+    deleted = list(tombstones.find(
+        {'collection': collection_name, **after('deletedAt', since, deleted_after)}, {'documentId': 1, 'deletedAt': 1},
+        sort=[('deletedAt', 1), ('_id', 1)], limit=limit + 1,
+    ))
+
+    has_more = len(changed) > limit or len(deleted) > limit
+    if has_more:
+        # Resume from the earliest point either list was cut at, so nothing is skipped; the cursor also holds the
+        # last _id sent at that time in each list, so the next page continues inside the millisecond
+        cut = min(items[limit - 1][field] for items, field in ((changed, 'updatedAt'), (deleted, 'deletedAt')) if len(items) > limit)
+        changed = [document for document in changed[:limit] if document['updatedAt'] <= cut]
+        deleted = [tombstone for tombstone in deleted[:limit] if tombstone['deletedAt'] <= cut]
+        next_since = make_cursor(
+            cut,
+            last_id(changed, 'updatedAt', cut, changed_after if cut == since else None),
+            last_id(deleted, 'deletedAt', cut, deleted_after if cut == since else None),
+        )
+    else:
+        next_since = max(since, now - SAFETY_WINDOW_MS)
+
+    # Clients apply deleted before changed, so an id that was deleted and then reused ends up present
+    return {
+        'deleted': list(dict.fromkeys(tombstone['documentId'] for tombstone in deleted)),
+        'changed': changed,
+        'next': next_since,  # Pass back as since on the next call: a cursor while hasMore, then epoch ms (items may repeat)
+        'hasMore': has_more,
+    }
@@ -1,30 +1,115 @@
 # Import necessary modules
+import time
+
 from flask import jsonify
 from logger.logger_base import Logger
+from models.tenancy import current_tenant, for_each_tenant
+from services.change_feed import ChangeFeed
+from services.archive import export_archive, import_archive, archive_path
+from services.delta_sync import now_ms, ensure_sync_indexes, record_tombstone, get_changes
+from services.jobs import JobQueue
+from services.stats import StatsCache, count_by, facet_counts
+from services.write_behind import WriteBehindQueue
+from schemas.inventory import item_key, parse_inventory, parse_money, format_copper
+
+# Seconds the weapon name lookup is reused before it is read again; weapons rarely change
+WEAPON_CACHE_SECONDS = 60
 
 class NpcService:
     def __init__(self, db_conn):
         # Set up logging and database connection
         self.logger = Logger()  # Logger for logging messages
         self.db_conn = db_conn  # Database connection
+        self.repository = db_conn.repository('npcs')  # Storage of the npcs
+        self.tombstones = db_conn.repository('tombstones')  # Deletion records used by delta sync
+        self.change_feed = ChangeFeed(self.repository, self.tombstones, 'npcs')  # Pushes collection changes to event stream clients
+        self.stats = StatsCache(self.repository, self.compute_stats)  # Dashboard stats, recomputed after writes
+        self.counters = db_conn.repository('counters')  # Id counters for the write-behind queue
+        # Batches inserts in a background thread when WRITE_BEHIND is set, otherwise None
+        self.write_behind = WriteBehindQueue.from_environment(self.repository, self.counters, 'npcs')
+        self.weapons = db_conn.foreign('weapons', 'Inventory weapon links')  # Weapon catalog, to reference weapons in the inventories
+        self.weapon_cache = {}  # Tenant -> (read at, item key -> weapon ID)
+        # Long operations run off the request path; JOB_WORKERS threads or `python -m services.jobs` run them
+        self.jobs = JobQueue.from_environment(db_conn, 'npcs', {
+            'reindex': self.reindex_job,
+            'export': self.export_job,
+            'import': self.import_job,
+        })
+
+    def ensure_indexes(self):
+        try:
+            # updatedAt and tombstone indexes used by delta sync
+            ensure_sync_indexes(self.repository, self.tombstones)
+            self.jobs.ensure_indexes()  # Job claims and the cleanup of finished jobs
+            # Multikey index for the item lookup across npcs
+            self.repository.create_index('items.key')
+            # Backfill npcs stored before the inventory and money were parsed on write, each tenant against its own weapons
+            if current_tenant.get() is None:
+                for_each_tenant(self.db_conn, self.backfill_inventories, 'npcs')
+            else:
+                self.backfill_inventories()
+        except Exception as e:
+            # Indexes only speed things up, so log and keep serving
+            self.logger.error(f'Error creating the npc indexes: {e}')
+
+    def backfill_inventories(self):
+        for npc in self.repository.find({'moneyCp': {'$exists': False}}, {'inventory': 1, 'money': 1}):
+            self.repository.update_one({'_id': npc['_id']}, {'$set': {
+                'items': self.link_weapons(parse_inventory(npc.get('inventory'))),
+                'moneyCp': parse_money(npc.get('money')),
+            }})
 
     def get_all_npcs(self):
         try:
             # Fetch all npcs from the database and return them as a list
-            npcs = list(self.db_conn.db.npcs.find())
+            npcs = list(self.repository.find())
             return npcs
         except Exception as e:
             # If something goes wrong, log the error and return an error message
             self.logger.error(f'Error fetching all npcs from the database: {e}')
             return jsonify({'error': f'Error fetching all npcs from the database: {e}'}), 500
 
+    def weapon_ids(self):
+        # Item key of every weapon name -> weapon ID, cached for WEAPON_CACHE_SECONDS (per tenant)
+        now = time.monotonic()
+        tenant = current_tenant.get()
+        cached = self.weapon_cache.get(tenant)
+        if cached is None or now - cached[0] > WEAPON_CACHE_SECONDS:
+            weapons = self.weapons.find({}, {'named': 1})
+            cached = self.weapon_cache[tenant] = (now, {item_key(weapon['named']): weapon['_id'] for weapon in weapons if isinstance(weapon.get('named'), str)})
+        return cached[1]
+
+    def link_weapons(self, items):
+        # Add the weaponId of the items that are weapons from the catalog
+        try:
+            weapon_ids = self.weapon_ids()
+        except Exception as e:
+            # The items are still useful without the references, so log and keep going
+            self.logger.warning(f'Could not read the weapons to link the inventory: {e}')
+            return items
+        for item in items:
+            if item['key'] in weapon_ids:
+                item['weaponId'] = weapon_ids[item['key']]
+        return items
+
     def add_npc(self, new_npc):
         try:
-            # Find the npc with the highest ID and set the new npc ID to be the next one
-            max_npc = self.db_conn.db.npcs.find_one(sort=[('_id', -1)])
-            next_id = max_npc['_id'] + 1 if max_npc else 1
+            if 'items' in new_npc:
+                self.link_weapons(new_npc['items'])  # Reference the weapons carried
+            if self.write_behind:
+                # Reserve the ID and queue the insert; the background thread writes it with others in one batch
+                new_npc['_id'] = self.write_behind.allocate_id()
+                new_npc['updatedAt'] = now_ms()  # Change time used by delta sync
+                self.write_behind.enqueue(new_npc)
+                self.stats.invalidate()  # The cached stats are out of date
+                return new_npc
+
+            # The new npc ID is the highest ID in the collection plus one
+            next_id = self.repository.next_id()
             new_npc['_id'] = next_id  # Assign new ID to the npc
-            self.db_conn.db.npcs.insert_one(new_npc)  # Add the new npc to the database
+            new_npc['updatedAt'] = now_ms()  # Change time used by delta sync
+            self.repository.insert_one(new_npc)  # Add the new npc to the database
+            self.stats.invalidate()  # The cached stats are out of date
             return new_npc  # Return the newly added npc
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -33,8 +118,10 @@ class NpcService:
 
     def get_npc_by_id(self, npc_id):
         try:
+            if self.write_behind:
+                self.write_behind.wait_for(npc_id)  # Write it first if it is still queued
             # Fetch a specific npc by its ID from the database
-            npc_data = self.db_conn.db.npcs.find_one({'_id': npc_id})
+            npc_data = self.repository.find_one({'_id': npc_id})
             return npc_data  # Return the npc data
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -47,9 +134,13 @@ class NpcService:
             update_npc = self.get_npc_by_id(npc_id)
 
             if update_npc:
+                if 'items' in npc_data:
+                    self.link_weapons(npc_data['items'])  # Reference the weapons carried
                 # If the npc exists, update it with the new data
-                updated_npc = self.db_conn.db.npcs.update_one({'_id': npc_id}, {'$set': npc_data})
-                if updated_npc.modified_count > 0:
+                npc_data['updatedAt'] = now_ms()  # Change time used by delta sync
+                updated_npc = self.repository.update_one({'_id': npc_id}, {'$set': npc_data})
+                self.stats.invalidate()  # The cached stats are out of date
+                if updated_npc > 0:
                     return updated_npc  # Return the updated npc
                 else:
                     return 'The npc is already up-to-date'  # No changes made
@@ -61,6 +152,32 @@ class NpcService:
             self.logger.error(f'Error updating the npc: {e}')
             return jsonify({'error': f'Error updating the npc: {e}'}), 500
         
+    def patch_npc(self, npc_id, changes, expected_version=None):
+        try:
+            if self.write_behind:
+                self.write_behind.wait_for(npc_id)  # Write it first if it is still queued
+            # Only match the version the client saw, when it sent one
+            query = {'_id': npc_id}
+            if expected_version is not None:
+                query['updatedAt'] = expected_version
+
+            if 'items' in changes:
+                self.link_weapons(changes['items'])  # Reference the weapons carried
+            changes['updatedAt'] = now_ms()  # Change time used by delta sync, also the new version
+            # Set only the changed fields and read back just those, in a single round-trip
+            patched_npc = self.repository.find_one_and_update(query, {'$set': changes}, projection=list(changes))
+            self.stats.invalidate()  # The cached stats are out of date
+            if patched_npc:
+                return patched_npc  # Return the changed fields
+            if expected_version is not None and self.repository.count({'_id': npc_id}, limit=1):
+                return False  # The npc exists but has a newer version
+            return None  # Npc not found
+
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error patching the npc: {e}')
+            return jsonify({'error': f'Error patching the npc: {e}'}), 500
+
     def delete_npc(self, npc_id):
         try:
             # Check if the npc exists before deleting
@@ -68,7 +185,9 @@ class NpcService:
             
             if deleted_npc:
                 # If the npc exists, delete it from the database
-                self.db_conn.db.npcs.delete_one({'_id': npc_id})
+                self.repository.delete_one({'_id': npc_id})
+                self.stats.invalidate()  # The cached stats are out of date
+                record_tombstone(self.tombstones, 'npcs', npc_id)  # Let offline clients sync the deletion
                 return deleted_npc  # Return the deleted npc data
             else:
                 return None  # npc not found
@@ -78,6 +197,149 @@ class NpcService:
             self.logger.error(f'Error deleting the npc data: {e}')
             return jsonify({'error': f'Error deleting the npc data: {e}'}), 500
 
+    def get_party_gold(self, npc_ids=None):
+        try:
+            # Add up the money of the given npcs (all of them when no IDs are given) in the database
+            pipeline = [{'$match': {'_id': {'$in': npc_ids}}}] if npc_ids else []
+            pipeline.append({'$group': {'_id': None, 'npcs': {'$sum': 1}, 'totalCp': {'$sum': '$moneyCp'}}})
+            totals = list(self.repository.aggregate(pipeline))
+            total_cp = totals[0]['totalCp'] if totals else 0
+            return {
+                'npcs': totals[0]['npcs'] if totals else 0,
+                'totalCp': total_cp,
+                'totalGp': total_cp / 100,
+                'coins': format_copper(total_cp),
+            }
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error adding up the npc money: {e}')
+            return jsonify({'error': f'Error adding up the npc money: {e}'}), 500
+
+    def find_item(self, name=None, weapon_id=None):
+        try:
+            # Npcs carrying an item, by name or by weapon ID, with how many each has and the total
+            condition = {'items.weaponId': weapon_id} if weapon_id is not None else {'items.key': item_key(name)}
+            result = list(self.repository.aggregate([
+                {'$match': condition},  # Served by the items.key index
+                {'$unwind': '$items'},
+                {'$match': condition},  # Keep only the matching item of each npc
+                {'$facet': {
+                    'npcs': [
+                        {'$project': {'named': 1, 'item': '$items.name', 'qty': '$items.qty', 'weaponId': '$items.weaponId'}},
+                        {'$sort': {'qty': -1, '_id': 1}},
+                    ],
+                    'total': [{'$group': {'_id': None, 'qty': {'$sum': '$items.qty'}}}],
+                }},
+            ]))
+            facets = result[0] if result else {'npcs': [], 'total': []}
+            return {
+                'totalQty': facets['total'][0]['qty'] if facets['total'] else 0,
+                'npcs': facets['npcs'],
+            }
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error looking up the item in the npc inventories: {e}')
+            return jsonify({'error': f'Error looking up the item in the npc inventories: {e}'}), 500
+
+    def compute_stats(self):
+        # Npcs per role
+        return facet_counts(self.repository, {'byRole': count_by('$role')})
+
+    def get_stats(self):
+        try:
+            # Cached aggregated stats with their version, recomputed only when the npcs changed
+            return self.stats.get()
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing the npc stats: {e}')
+            return jsonify({'error': f'Error computing the npc stats: {e}'}), 500
+
+    def submit_job(self, job_type, params):
+        try:
+            # Queue a background job; the response only carries its id and status
+            return self.jobs.submit(job_type, params)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown job type
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error submitting the npc job: {e}')
+            return jsonify({'error': f'Error submitting the npc job: {e}'}), 500
+
+    def get_job(self, job_id):
+        try:
+            # Fetch a job of this service with its status, progress and result
+            return self.jobs.get(job_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the npc job: {e}')
+            return jsonify({'error': f'Error fetching the npc job: {e}'}), 500
+
+    def reindex_job(self, context, params):
+        # Job handler: create the indexes and run the backfills again, e.g. after restoring a dump
+        self.ensure_indexes()
+        return {'indexes': sorted(self.repository.index_names())}
+
+    def export_archive(self, archive_format):
+        try:
+            if self.write_behind:
+                self.write_behind.flush()  # Queued inserts belong in the archive
+            # Compressed archive of every npc, produced chunk by chunk while the response is sent
+            return export_archive(self.repository, 'npcs', archive_format)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error exporting the npcs: {e}')
+            return jsonify({'error': f'Error exporting the npcs: {e}'}), 500
+
+    def import_archive(self, stream, archive_format, mode):
+        try:
+            # Import an archive read from the request body as it arrives
+            return self.load_archive(stream, archive_format, mode)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format or mode, or not a npcs archive
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error importing the npcs: {e}')
+            return jsonify({'error': f'Error importing the npcs: {e}'}), 500
+
+    def load_archive(self, stream, archive_format, mode, progress=None):
+        # Import an archive, then bring what is derived from the npcs up to date
+        counts = import_archive(stream, self.repository, 'npcs', archive_format, mode, progress=progress)
+        self.ensure_indexes()  # Backfills the derived fields of npcs from older archives
+        if self.write_behind:
+            self.write_behind.reseed()  # Ids handed out next must come after the imported ones
+        self.stats.invalidate()
+        return counts
+
+    def export_job(self, context, params):
+        # Job handler: write an archive into ARCHIVE_DIR
+        archive_format = params.get('format', 'bson')
+        with open(archive_path(params.get('path')), 'wb') as archive:
+            for chunk in export_archive(self.repository, 'npcs', archive_format):
+                archive.write(chunk)
+            return {'path': archive.name, 'format': archive_format, 'bytes': archive.tell()}
+
+    def import_job(self, context, params):
+        # Job handler: import an archive from ARCHIVE_DIR, for archives too large to send in one request
+        with open(archive_path(params.get('path')), 'rb') as archive:
+            return self.load_archive(archive, params.get('format', 'bson'), params.get('mode', 'upsert'), progress=context.progress)
+
+    def get_changes(self, since, limit):
+        try:
+            # Fetch only the npcs changed or deleted since the client's last sync
+            return get_changes(self.repository, self.tombstones, 'npcs', since, limit)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the npc changes: {e}')
+            return jsonify({'error': f'Error fetching the npc changes: {e}'}), 500
+
+    def close(self):
+        # Flush queued inserts; called on shutdown before the database connection is closed
+        if self.write_behind:
+            self.write_behind.close()
+
+
 # Main block of code for testing the NpcService
 if __name__ == '__main__':
     from models.models import NpcModel
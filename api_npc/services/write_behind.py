@@ -0,0 +1,233 @@
+import os
+import queue
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+from logger.logger_base import Logger
+from models.tenancy import current_tenant, tenant_scope
+
+STOP = object()  # Tells the writer thread to write what is left and exit
+
+
+class Flush:
+    # Marker queued behind the documents that must be written before the caller continues
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class Ticket:
+    # Lets a durable insert wait until its batch is in the database
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.document_id = None  # Id the document was stored under, when it had to take a new one
+
+
+class WriteBehindQueue:
+    # Acknowledges inserts once they have an id and writes them in batches from a background thread
+    # Documents stay in memory until written: with durable=False a crash loses what is still queued
+    def __init__(self, repository, counters, collection_name, batch_size=100, flush_interval=0.2,
+                 durable=False, max_pending=10000, id_block=100):
+        self.logger = Logger()  # Logger for logging messages
+        self.repository = repository  # Collection the documents are written to
+        self.counters = counters  # Id counters shared by every worker process
+        self.collection_name = collection_name
+        self.batch_size = batch_size  # Documents per insert_many
+        # Seconds a document may wait for its batch to fill; keep it well under the delta sync safety window
+        self.flush_interval = flush_interval
+        self.durable = durable  # Wait for the batch to be written before acknowledging
+        self.id_block = id_block  # Ids reserved per round-trip to the counter
+        self.queue = queue.Queue(maxsize=max_pending)  # Full queue blocks new inserts instead of growing without limit
+        self.pending = set()  # Ids queued but not written yet
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)  # Signalled when no enqueue is between its closed check and its put
+        self.putting = 0  # Enqueues past the closed check whose put hasn't returned yet
+        self.ids = iter(())  # Rest of the reserved id block
+        self.counter_seeded = False
+        self.thread = None
+        self.closed = False
+
+    @classmethod
+    def from_environment(cls, repository, counters, collection_name):
+        # Write-behind is opt-in: WRITE_BEHIND=1, tuned with the WRITE_BEHIND_* variables
+        if os.environ.get('WRITE_BEHIND', '0').lower() not in ('1', 'true', 'yes'):
+            return None
+        return cls(
+            repository, counters, collection_name,
+            batch_size=int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 100)),
+            flush_interval=float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.2)),
+            durable=os.environ.get('WRITE_BEHIND_DURABLE', '0').lower() in ('1', 'true', 'yes'),
+            max_pending=int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 10000)),
+        )
+
+    def allocate_id(self):
+        # Sequential ids can't come from the highest stored _id while inserts are still queued,
+        # so every worker reserves blocks from an atomic counter instead
+        with self.lock:
+            for document_id in self.ids:
+                return document_id
+            if not self.counter_seeded:
+                self.seed_counter()
+            counter = self.counters.find_one_and_update(
+                {'_id': self.collection_name}, {'$inc': {'seq': self.id_block}}, upsert=True
+            )
+            last = counter['seq']
+            self.ids = iter(range(last - self.id_block + 1, last + 1))
+            return next(self.ids)
+
+    def seed_counter(self):
+        # Start the counter after the ids already in the collection
+        highest = self.repository.next_id() - 1
+        try:
+            self.counters.update_one({'_id': self.collection_name}, {'$max': {'seq': highest}}, upsert=True)
+        except DuplicateKeyError:
+            # Another worker created the counter at the same time
+            self.counters.update_one({'_id': self.collection_name}, {'$max': {'seq': highest}})
+        self.counter_seeded = True
+
+    def reseed(self):
+        # After an import: drop the reserved block, which may hold ids the imported documents took, and start the
+        # counter after them (other workers' blocks can still clash, which insert_with_retry resolves)
+        with self.lock:
+            self.ids = iter(())
+            self.seed_counter()
+
+    def enqueue(self, document):
+        # Queue a document that already has its _id; blocks until written when durable
+        ticket = Ticket() if self.durable else None
+        with self.lock:
+            # Checked under the lock so close() can't queue STOP between the check and the put
+            closed = self.closed
+            if not closed:
+                self.putting += 1
+                self.pending.add(document['_id'])
+        if closed:
+            self.repository.insert_one(document)  # Shutting down, write it directly
+            return
+        try:
+            self.start()
+            self.queue.put((dict(document), ticket, current_tenant.get()))  # Written later as the same tenant
+        finally:
+            with self.lock:
+                self.putting -= 1
+                self.idle.notify_all()
+        if ticket:
+            ticket.done.wait()
+            if ticket.error:
+                raise ticket.error
+            document['_id'] = ticket.document_id  # A clash may have moved it to a new id
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=f'{self.collection_name}-write-behind', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is STOP:
+                    stopping = True
+                    break
+                if isinstance(item, Flush):
+                    # Write what came before the marker now, then release the caller
+                    self.write(batch)
+                    batch = []
+                    item.done.set()
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            self.write(batch)
+
+    def write(self, batch):
+        # A batch may hold documents of several tenants; each tenant's part is written as that tenant
+        by_tenant = {}
+        for document, ticket, tenant in batch:
+            by_tenant.setdefault(tenant, []).append((document, ticket))
+        for tenant, items in by_tenant.items():
+            with tenant_scope(tenant):
+                self.write_batch(items)
+
+    def write_batch(self, batch):
+        failures = {}  # Position in the batch -> error
+        documents = [document for document, _ in batch]
+        queued_ids = [document['_id'] for document in documents]  # insert_with_retry may change a document's id
+        try:
+            self.repository.insert_many(documents)  # One round-trip for the whole batch
+        except Exception as e:
+            # Insert one by one so a single bad document doesn't lose the rest of the batch
+            self.logger.warning(f'Batch insert of {len(documents)} {self.collection_name} failed, retrying one by one: {e}')
+            for position, document in enumerate(documents):
+                error = self.insert_with_retry(document)
+                if error:
+                    failures[position] = error
+                    self.logger.error(f'Queued {self.collection_name} document {document["_id"]} was not written: {error}')
+
+        with self.lock:
+            self.pending.difference_update(queued_ids)
+        for position, (document, ticket) in enumerate(batch):
+            if ticket:
+                ticket.error = failures.get(position)
+                ticket.document_id = document['_id']
+                ticket.done.set()
+
+    def insert_with_retry(self, document, attempts=3):
+        for attempt in range(attempts):
+            try:
+                self.repository.insert_one(document)
+                return None
+            except DuplicateKeyError as e:
+                stored = self.repository.find_one({'_id': document['_id']})
+                if stored == document:
+                    return None  # The batch insert stored it before failing on another document
+                if stored is None:
+                    return e  # A clash on another unique index
+                # Another writer took the id (a direct insert, an import, another worker's stale block): store this
+                # document under a fresh id instead of dropping it
+                queued_id, document['_id'] = document['_id'], self.allocate_id()
+                self.logger.warning(f'{self.collection_name} id {queued_id} was already taken, '
+                                    f'queued document stored as {document["_id"]}')
+            except Exception as e:
+                if attempt == attempts - 1:
+                    return e
+                time.sleep(0.1 * 2 ** attempt)  # Back off on transient errors
+        return DuplicateKeyError(f'Every id tried for the queued {self.collection_name} document was taken')
+
+    def flush(self):
+        # Block until everything queued so far is in the database
+        if self.thread is None or self.closed:
+            return
+        marker = Flush()
+        self.queue.put(marker)
+        marker.done.wait()
+
+    def wait_for(self, document_id):
+        # Read-your-writes: flush early when the document is still queued
+        with self.lock:
+            queued = document_id in self.pending
+        if queued:
+            self.flush()
+
+    def close(self):
+        # Write everything still queued; called on shutdown before the connection is closed
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            # Let enqueues already past the closed check put their document ahead of STOP
+            # (the put itself can't hold the lock: the writer needs it to clear pending while the queue is full)
+            self.idle.wait_for(lambda: not self.putting)
+            thread = self.thread
+        if thread:
+            self.queue.put(STOP)
+            thread.join()
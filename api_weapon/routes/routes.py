@@ -1,10 +1,15 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from marshmallow import ValidationError
 from logger.logger_base import Logger
-from flasgger import swag_from
+from routes.docs import swag_from  # flasgger's swag_from, or a no-op when the docs are prebuilt
+from services.delta_sync import parse_cursor
+from schemas.dice import parse_damage
 
 # Define routes for managing weapons (add, update, delete, etc.)
 class WeaponRoutes(Blueprint):
+    # Fields a PATCH request may change, each checked with the matching validate_* method
+    PATCH_FIELDS = ('named', 'category', 'cost', 'damage', 'properties', 'description', 'weight')
+
     def __init__(self, weapon_service, weapon_schema):
         super().__init__('weapon', __name__)  # Initialize the Blueprint
         self.weapon_service = weapon_service  # Service to handle database operations
@@ -17,7 +22,16 @@ class WeaponRoutes(Blueprint):
         self.route('/api/v1/weapons', methods=['GET'])(self.get_weapons)
         self.route('/api/v1/weapons', methods=['POST'])(self.add_weapons)
         self.route('/api/v1/weapons/<int:weapon_id>', methods=['PUT'])(self.update_weapon)
+        self.route('/api/v1/weapons/<int:weapon_id>', methods=['PATCH'])(self.patch_weapon)
         self.route('/api/v1/weapons/<int:weapon_id>', methods=['DELETE'])(self.delete_weapon)
+        self.route('/api/v1/weapons/events', methods=['GET'])(self.stream_events)
+        self.route('/api/v1/weapons/changes', methods=['GET'])(self.get_changes)
+        self.route('/api/v1/weapons/stats', methods=['GET'])(self.get_stats)
+        self.route('/api/v1/weapons/jobs', methods=['POST'])(self.submit_job)
+        self.route('/api/v1/weapons/jobs/<job_id>', methods=['GET'])(self.get_job)
+        self.route('/api/v1/weapons/export', methods=['GET'])(self.export_weapons)
+        self.route('/api/v1/weapons/import', methods=['POST'])(self.import_weapons)
+        self.route('/api/v1/weapons/damage-stats', methods=['GET'])(self.get_damage_stats)
         self.route('/healthcheck', methods=['GET'])(self.healthcheck)
 
     @swag_from({
@@ -40,11 +54,20 @@ class WeaponRoutes(Blueprint):
                     },
                     'required': ['named', 'category', 'cost', 'damage', 'properties', 'description', 'weight']  # These fields are required
                 }
+            },
+            {
+                'name': 'Idempotency-Key',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Unique key per logical request; a retry with the same key gets the first response back instead of a duplicate'
             }
         ],
         'responses': {
             200: {'description': 'Weapon successfully created'},
             400: {'description': 'Invalid data'},
+            409: {'description': 'A request with the same Idempotency-Key is still in progress'},
+            422: {'description': 'The Idempotency-Key was already used for a different request'},
             500: {'description': 'Internal server error'}
         }
     })
@@ -90,6 +113,7 @@ class WeaponRoutes(Blueprint):
                 'properties': properties,
                 'description': description,
                 'weight': weight,
+                'damageDice': parse_damage(damage),  # Normalized dice expression, None if not parseable
             }
             created_weapon = self.weapon_service.add_weapon(new_weapon)  # Add the weapon to the database
             self.logger.info(f'New weapon: {created_weapon}')  # Log the new weapon creation
@@ -137,6 +161,7 @@ class WeaponRoutes(Blueprint):
                 'properties': properties,
                 'description': description,
                 'weight': weight,
+                'damageDice': parse_damage(damage),  # Normalized dice expression, None if not parseable
             }
             updated_weapon = self.weapon_service.update_weapon(weapon_id, update_weapon)  # Update the weapon in the database
             if updated_weapon:
@@ -148,6 +173,97 @@ class WeaponRoutes(Blueprint):
             self.logger.error(f'Error updating the weapon in the database: {e}')
             return jsonify({'error': f'Error updating the weapon in the database: {e}'}), 500  # Handle any errors
 
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Update only some fields of a weapon',
+        'parameters': [
+            {
+                'name': 'weapon_id',
+                'in': 'path',
+                'required': True,
+                'type': 'integer',
+                'description': 'ID of the weapon to update'
+            },
+            {
+                'name': 'If-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; the update is rejected if the weapon changed since'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'named': {'type': 'string'},
+                        'category': {'type': 'string'},
+                        'cost': {'type': 'string'},
+                        'damage': {'type': 'string'},
+                        'properties': {'type': 'string'},
+                        'description': {'type': 'string'},
+                        'weight': {'type': 'string'},
+                    }
+                }
+            }
+        ],
+        'responses': {
+            200: {'description': 'The changed fields, with the new version in the ETag header'},
+            400: {'description': 'Invalid data'},
+            404: {'description': 'Weapon not found'},
+            412: {'description': 'The weapon was changed by someone else'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def patch_weapon(self, weapon_id):
+        # Update only the fields sent by the client
+        try:
+            request_data = request.json  # Get the changed fields
+
+            if not request_data:
+                return jsonify({'error': 'Invalid data, empty'}), 400  # Check if data is empty
+
+            unknown_fields = sorted(set(request_data) - set(self.PATCH_FIELDS))
+            if unknown_fields:
+                return jsonify({'error': f'Invalid data: unknown fields {unknown_fields}'}), 400
+
+            # Optional optimistic concurrency check against the version the client last saw
+            expected_version = None
+            if_match = request.headers.get('If-Match')
+            if if_match:
+                expected_version = if_match.removeprefix('W/').strip('"')
+                if not expected_version.isdigit():
+                    return jsonify({'error': 'Invalid If-Match header'}), 400
+                expected_version = int(expected_version)
+
+            # Validate only the supplied fields using the schema
+            try:
+                for field, value in request_data.items():
+                    if value is None:
+                        raise ValidationError(f'{field} must not be null')
+                    getattr(self.weapon_schema, f'validate_{field}')(value)
+            except ValidationError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400  # Return error if validation fails
+
+            changes = dict(request_data)
+            if 'damage' in changes:
+                changes['damageDice'] = parse_damage(changes['damage'])  # Keep the normalized dice in sync
+            patched_weapon = self.weapon_service.patch_weapon(weapon_id, changes, expected_version)  # Update the weapon in the database
+            if patched_weapon is None:
+                return jsonify({'error': 'Weapon not found'}), 404  # If weapon not found, return an error
+            if patched_weapon is False:
+                return jsonify({'error': 'Weapon was modified by another request'}), 412  # Version mismatch
+
+            response = jsonify(patched_weapon)
+            response.headers['ETag'] = f'"{patched_weapon["updatedAt"]}"'  # New version for the next If-Match
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error patching the weapon in the database: {e}')
+            return jsonify({'error': f'Error patching the weapon in the database: {e}'}), 500  # Handle any errors
+
     def delete_weapon(self, weapon_id):
         # Delete a weapon by its ID
         try:
@@ -162,6 +278,319 @@ class WeaponRoutes(Blueprint):
             self.logger.error(f'Error deleting the weapon from the database: {e}')
             return jsonify({'error': f'Error deleting the weapon from the database: {e}'}), 500  # Handle any errors
         
+    @swag_from({
+        'tags': ['weapons'],
+        'parameters': [
+            {
+                'name': 'ids',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Comma-separated weapon ids, all weapons when omitted'
+            },
+            {
+                'name': 'distribution',
+                'in': 'query',
+                'required': False,
+                'type': 'boolean',
+                'description': 'Include the probability of every damage total (default true)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Expected value, variance and damage distribution per weapon'},
+            400: {'description': 'Invalid weapon ids'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_damage_stats(self):
+        # Get damage statistics for one or many weapons
+        try:
+            ids = request.args.get('ids')
+            try:
+                weapon_ids = [int(weapon_id) for weapon_id in ids.split(',')] if ids else None
+            except ValueError:
+                return jsonify({'error': 'Invalid data: ids must be comma-separated integers'}), 400
+
+            include_distribution = request.args.get('distribution', 'true').lower() != 'false'
+            stats = self.weapon_service.get_damage_stats(weapon_ids, include_distribution)
+            return jsonify(stats), 200  # Return the statistics as JSON
+
+        except Exception as e:
+            self.logger.error(f'Error computing weapon damage statistics: {e}')
+            return jsonify({'error': f'Error computing weapon damage statistics: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Stream weapons changes as Server-Sent Events',
+        'parameters': [
+            {
+                'name': 'Last-Event-ID',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'Id of the last event received, to replay what was missed while disconnected'
+            }
+        ],
+        'produces': ['text/event-stream'],
+        'responses': {
+            200: {'description': 'Stream of insert, update, replace and delete events'},
+            503: {'description': 'Too many open event streams in this process'}
+        }
+    })
+    def stream_events(self):
+        # Push changes to the client instead of having it poll the list endpoint
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+        change_feed = self.weapon_service.change_feed
+        if not change_feed.open_stream():
+            # Each open stream holds a server thread, so past the cap the client should come back later
+            response = jsonify({'error': 'Too many open event streams, try again shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        response = Response(change_feed.stream(last_event_id), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # Don't let a reverse proxy hold events back
+        })
+        response.call_on_close(change_feed.close_stream)
+        return response
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Weapon changes since the last sync',
+        'parameters': [
+            {
+                'name': 'since',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'description': 'Epoch milliseconds, or the next value of the previous response (0 or omitted for everything)'
+            },
+            {
+                'name': 'limit',
+                'in': 'query',
+                'required': False,
+                'type': 'integer',
+                'description': 'Maximum changes per response, 1 to 5000 (default 1000)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Deleted ids and changed weapons; apply deleted first, then changed'},
+            400: {'description': 'Invalid since or limit'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_changes(self):
+        # Get only the weapons changed or deleted since the given time
+        try:
+            limit = request.args.get('limit', '1000')
+            if not limit.isdigit() or not 1 <= int(limit) <= 5000:
+                return jsonify({'error': 'Invalid data: limit must be between 1 and 5000'}), 400
+            try:
+                since = parse_cursor(request.args.get('since', '0'))  # Epoch milliseconds or the cursor of the last page
+            except ValueError as e:
+                return jsonify({'error': f'Invalid data: {e}'}), 400
+
+            changes = self.weapon_service.get_changes(since, int(limit))
+            return jsonify(changes), 200  # Return the changes as JSON
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the weapon changes: {e}')
+            return jsonify({'error': f'Error fetching the weapon changes: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Counts of the weapons per category and damage type',
+        'parameters': [
+            {
+                'name': 'If-None-Match',
+                'in': 'header',
+                'required': False,
+                'type': 'string',
+                'description': 'ETag from a previous response; answered with 304 while the weapons are unchanged'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Total and counts per value, most common first, with the version in the ETag header'},
+            304: {'description': 'The weapons did not change since the given ETag'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_stats(self):
+        # Get the dashboard counts, aggregated in the database and cached until the weapons change
+        try:
+            stats = self.weapon_service.get_stats()
+            if isinstance(stats, tuple):
+                return stats  # Error response from the service
+
+            etag = f'"{stats["version"]}"'
+            if etag in request.headers.get('If-None-Match', ''):
+                return '', 304, {'ETag': etag}  # The client's copy is still current
+            response = jsonify(stats)
+            response.headers['ETag'] = etag
+            return response, 200
+
+        except Exception as e:
+            self.logger.error(f'Error computing the weapon stats: {e}')
+            return jsonify({'error': f'Error computing the weapon stats: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Run a long operation in the background',
+        'parameters': [
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'type': {'type': 'string', 'description': 'Job type: reindex, export or import'},
+                        'params': {'type': 'object', 'description': 'Parameters of the job; export and import take path (a file name in ARCHIVE_DIR), format and, for import, mode'}
+                    },
+                    'required': ['type']
+                }
+            }
+        ],
+        'responses': {
+            202: {'description': 'Job queued; poll the URL in the Location header for its status'},
+            400: {'description': 'Unknown job type or invalid params'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def submit_job(self):
+        # Queue a job for the workers instead of running it inside the request
+        try:
+            request_data = request.json or {}
+            params = request_data.get('params', {})
+            if not isinstance(request_data.get('type'), str) or not isinstance(params, dict):
+                return jsonify({'error': 'Invalid data: type must be a string and params an object'}), 400
+
+            job = self.weapon_service.submit_job(request_data['type'], params)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            response = jsonify({'_id': job['_id'], 'type': job['type'], 'status': job['status']})
+            response.headers['Location'] = f'/api/v1/weapons/jobs/{job["_id"]}'
+            return response, 202
+
+        except Exception as e:
+            self.logger.error(f'Error submitting the weapon job: {e}')
+            return jsonify({'error': f'Error submitting the weapon job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Status of a background job',
+        'parameters': [
+            {
+                'name': 'job_id',
+                'in': 'path',
+                'required': True,
+                'type': 'string',
+                'description': 'ID returned when the job was submitted'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Status (queued, running, succeeded or failed), attempts, progress, result and last error'},
+            404: {'description': 'Job not found'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def get_job(self, job_id):
+        # Get the status and progress of a job
+        try:
+            job = self.weapon_service.get_job(job_id)
+            if isinstance(job, tuple):
+                return job  # Error response from the service
+            if not job:
+                return jsonify({'error': 'Job not found'}), 404
+            return jsonify(job), 200
+
+        except Exception as e:
+            self.logger.error(f'Error fetching the weapon job: {e}')
+            return jsonify({'error': f'Error fetching the weapon job: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Download every weapon as a compressed archive',
+        'produces': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Gzip stream of a header record followed by the weapons, sent as it is read'},
+            400: {'description': 'Unknown format'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def export_weapons(self):
+        # Stream the archive so neither side holds the whole collection in memory
+        try:
+            archive_format = request.args.get('format', 'bson')
+            chunks = self.weapon_service.export_archive(archive_format)
+            if isinstance(chunks, tuple):
+                return chunks  # Error response from the service
+            return Response(chunks, mimetype='application/gzip', headers={
+                'Content-Disposition': f'attachment; filename="weapons.{archive_format}.gz"',
+            })
+
+        except Exception as e:
+            self.logger.error(f'Error exporting the weapons: {e}')
+            return jsonify({'error': f'Error exporting the weapons: {e}'}), 500  # Handle any errors
+
+    @swag_from({
+        'tags': ['weapons'],
+        'summary': 'Load weapons from a compressed archive',
+        'consumes': ['application/gzip'],
+        'parameters': [
+            {
+                'name': 'format',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['bson', 'msgpack'],
+                'description': 'Encoding of the documents inside the gzip stream (default bson)'
+            },
+            {
+                'name': 'mode',
+                'in': 'query',
+                'required': False,
+                'type': 'string',
+                'enum': ['upsert', 'insert'],
+                'description': 'upsert replaces weapons with the same ID (default); insert is faster but fails on existing IDs'
+            },
+            {
+                'name': 'body',
+                'in': 'body',
+                'required': True,
+                'schema': {'type': 'string', 'format': 'binary'},
+                'description': 'Archive as written by the export endpoint'
+            }
+        ],
+        'responses': {
+            200: {'description': 'Number of weapons imported'},
+            400: {'description': 'Unknown format or mode, or not a weapons archive'},
+            500: {'description': 'Internal server error'}
+        }
+    })
+    def import_weapons(self):
+        # Import the archive in batches while the body is still arriving; larger files go through an import job
+        try:
+            result = self.weapon_service.import_archive(
+                request.stream, request.args.get('format', 'bson'), request.args.get('mode', 'upsert'),
+            )
+            if isinstance(result, tuple):
+                return result  # Error response from the service
+            return jsonify(result), 200
+
+        except Exception as e:
+            self.logger.error(f'Error importing the weapons: {e}')
+            return jsonify({'error': f'Error importing the weapons: {e}'}), 500  # Handle any errors
+
     def healthcheck(self):
         # Health check to verify the server is up
         return jsonify({'status': 'up'}), 200
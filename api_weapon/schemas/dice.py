@@ -0,0 +1,66 @@
+import re
+
+# Compiled once at import: "<count>d<sides> [+/- modifier] [damage type]" or a flat "<n> [damage type]"
+# Examples: "1d8 slashing", "2d6 + 3 fire", "d4 piercing", "1 piercing"
+# Matched against the stripped string; each run of spaces belongs to exactly one part, so a failed match stays linear
+DICE_PATTERN = re.compile(
+    r'(?:(?P<count>\d*)\s*[dD]\s*(?P<sides>\d+))?'  # Optional dice term, count defaults to 1
+    r'(?:\s*(?P<modifier>(?:[+-]\s*)?\d+))?'  # Optional flat modifier (or flat damage when there are no dice)
+    r'(?:\s*(?P<type>[A-Za-z]+(?:[\s-]+[A-Za-z]+)*))?'  # Optional damage type: words split by spaces or hyphens
+)
+
+# Longest damage string accepted, far more than "10d10 + 10 bludgeoning or piercing" needs
+MAX_DAMAGE_LENGTH = 64
+
+# Upper bounds keep the precomputed distributions small
+MAX_DICE_COUNT = 100
+MAX_DICE_SIDES = 100
+
+
+def parse_damage(value):
+    # Parse a damage string into its normalized form, or return None if it is not a dice expression
+    if not isinstance(value, str) or len(value) > MAX_DAMAGE_LENGTH:
+        return None
+
+    match = DICE_PATTERN.fullmatch(value.strip())
+    if not match or not (match.group('sides') or match.group('modifier')):
+        return None  # Nothing numeric to work with (e.g. "-" or "special")
+
+    if match.group('sides'):
+        count = int(match.group('count') or 1)
+        sides = int(match.group('sides'))
+        modifier = int(''.join(match.group('modifier').split())) if match.group('modifier') else 0  # '+ 3' or '+\t3'
+    else:
+        # Flat damage such as "1 piercing" is stored as zero dice plus a modifier
+        if match.group('modifier').lstrip().startswith(('+', '-')):
+            return None
+        count, sides, modifier = 0, 0, int(match.group('modifier'))
+
+    if sides == 1 or count > MAX_DICE_COUNT or sides > MAX_DICE_SIDES or (count and not sides):
+        return None
+
+    damage_type = match.group('type')
+    return {
+        'count': count,
+        'sides': sides,
+        'modifier': modifier,
+        'damageType': ' '.join(damage_type.lower().split()) if damage_type else None,
+    }
+
+
+def format_damage(dice):
+    # Build the canonical expression for a normalized damage dict, e.g. "2d6+3"
+    if dice['count'] == 0:
+        return str(dice['modifier'])
+    expression = f"{dice['count']}d{dice['sides']}"
+    if dice['modifier']:
+        expression += f"{dice['modifier']:+d}"
+    return expression
+
+
+if __name__ == '__main__':
+    from logger.logger_base import Logger  # Import the custom logger
+
+    logger = Logger()
+    for example in ['1d8 slashing', '2d6 + 3 fire', 'd4 piercing', '1 piercing', '-']:
+        logger.info(f'{example!r} -> {parse_damage(example)}')
@@ -1,4 +1,5 @@
 from marshmallow import fields, validates, ValidationError
+from schemas.dice import MAX_DAMAGE_LENGTH  # Also bounds the work of the damage parser
 
 # This weapon defines the fields we need to validate
 class WeaponSchema:
@@ -33,6 +34,8 @@ class WeaponSchema:
     def validate_damage(self, value):
         if len(value) < 1:
             raise ValidationError('Damage must be not be empty')
+        if len(value) > MAX_DAMAGE_LENGTH:
+            raise ValidationError(f'Damage must be no longer than {MAX_DAMAGE_LENGTH} characters')
 
     # Validate saving throw proficiencies: Make sure it’s at least 5 characters long
     @validates('properties')
@@ -0,0 +1,52 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=1024)
+def damage_distribution(count, sides, modifier):
+    # Probability of every total for <count>d<sides>+<modifier>, computed once per distinct expression
+    pmf = np.ones(1)
+    if count:
+        die = np.full(sides, 1.0 / sides)  # A single die is uniform over 1..sides
+        # Square-and-multiply so large dice pools need O(log count) convolutions
+        power = count
+        while power:
+            if power & 1:
+                pmf = np.convolve(pmf, die)
+            power >>= 1
+            if power:
+                die = np.convolve(die, die)
+
+    minimum = count + modifier  # Lowest possible roll: every die shows 1
+    totals = np.arange(minimum, minimum + pmf.size)
+    mean = float(np.dot(totals, pmf))
+    variance = float(np.dot((totals - mean) ** 2, pmf))
+
+    pmf.setflags(write=False)  # Cached arrays are shared between requests
+    return {
+        'min': int(minimum),
+        'max': int(totals[-1]),
+        'mean': mean,
+        'variance': variance,
+        'pmf': pmf,
+    }
+
+
+def damage_stats(dice, include_distribution=True):
+    # Build the JSON-ready statistics for a normalized damage dict
+    stats = damage_distribution(dice['count'], dice['sides'], dice['modifier'])
+    result = {
+        'min': stats['min'],
+        'max': stats['max'],
+        'mean': round(stats['mean'], 4),
+        'variance': round(stats['variance'], 4),
+        'stdDev': round(stats['variance'] ** 0.5, 4),
+    }
+    if include_distribution:
+        # [total, probability] pairs from min to max
+        result['distribution'] = [
+            [total, round(float(p), 6)]
+            for total, p in zip(range(stats['min'], stats['max'] + 1), stats['pmf'])
+        ]
+    return result
@@ -1,17 +1,43 @@
 # Import necessary modules
 from flask import jsonify
 from logger.logger_base import Logger
+from services.change_feed import ChangeFeed
+from services.archive import export_archive, import_archive, archive_path
+from services.delta_sync import now_ms, ensure_sync_indexes, record_tombstone, get_changes
+from services.jobs import JobQueue
+from services.stats import StatsCache, count_by, facet_counts
+from schemas.dice import parse_damage, format_damage
+from services.dice_stats import damage_stats
 
 class WeaponService:
     def __init__(self, db_conn):
         # Set up logging and database connection
         self.logger = Logger()  # Logger for logging messages
         self.db_conn = db_conn  # Database connection
+        self.repository = db_conn.repository('weapons')  # Storage of the weapons
+        self.tombstones = db_conn.repository('tombstones')  # Deletion records used by delta sync
+        self.change_feed = ChangeFeed(self.repository, self.tombstones, 'weapons')  # Pushes collection changes to event stream clients
+        self.stats = StatsCache(self.repository, self.compute_stats)  # Dashboard stats, recomputed after writes
+        # Long operations run off the request path; JOB_WORKERS threads or `python -m services.jobs` run them
+        self.jobs = JobQueue.from_environment(db_conn, 'weapons', {
+            'reindex': self.reindex_job,
+            'export': self.export_job,
+            'import': self.import_job,
+        })
+
+    def ensure_indexes(self):
+        try:
+            # updatedAt and tombstone indexes used by delta sync
+            ensure_sync_indexes(self.repository, self.tombstones)
+            self.jobs.ensure_indexes()  # Job claims and the cleanup of finished jobs
+        except Exception as e:
+            # Indexes only speed things up, so log and keep serving
+            self.logger.error(f'Error creating the weapon indexes: {e}')
 
     def get_all_weapons(self):
         try:
             # Fetch all weapons from the database and return them as a list
-            weapons = list(self.db_conn.db.weapons.find())
+            weapons = list(self.repository.find())
             return weapons
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -20,11 +46,12 @@ class WeaponService:
 
     def add_weapon(self, new_weapon):
         try:
-            # Find the weapon with the highest ID and set the new weapon ID to be the next one
-            max_weapon = self.db_conn.db.weapons.find_one(sort=[('_id', -1)])
-            next_id = max_weapon['_id'] + 1 if max_weapon else 1
+            # The new weapon ID is the highest ID in the collection plus one
+            next_id = self.repository.next_id()
             new_weapon['_id'] = next_id  # Assign new ID to the weapon
-            self.db_conn.db.weapons.insert_one(new_weapon)  # Add the new weapon to the database
+            new_weapon['updatedAt'] = now_ms()  # Change time used by delta sync
+            self.repository.insert_one(new_weapon)  # Add the new weapon to the database
+            self.stats.invalidate()  # The cached stats are out of date
             return new_weapon  # Return the newly added weapon
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -34,7 +61,7 @@ class WeaponService:
     def get_weapon_by_id(self, weapon_id):
         try:
             # Fetch a specific weapon by its ID from the database
-            weapon_data = self.db_conn.db.weapons.find_one({'_id': weapon_id})
+            weapon_data = self.repository.find_one({'_id': weapon_id})
             return weapon_data  # Return the weapon data
         except Exception as e:
             # If something goes wrong, log the error and return an error message
@@ -48,8 +75,10 @@ class WeaponService:
 
             if update_weapon:
                 # If the weapon exists, update it with the new data
-                updated_weapon = self.db_conn.db.weapons.update_one({'_id': weapon_id}, {'$set': weapon_data})
-                if updated_weapon.modified_count > 0:
+                weapon_data['updatedAt'] = now_ms()  # Change time used by delta sync
+                updated_weapon = self.repository.update_one({'_id': weapon_id}, {'$set': weapon_data})
+                self.stats.invalidate()  # The cached stats are out of date
+                if updated_weapon > 0:
                     return updated_weapon  # Return the updated weapon
                 else:
                     return 'The weapon is already up-to-date'  # No changes made
@@ -61,6 +90,28 @@ class WeaponService:
             self.logger.error(f'Error updating the weapon: {e}')
             return jsonify({'error': f'Error updating the weapon: {e}'}), 500
         
+    def patch_weapon(self, weapon_id, changes, expected_version=None):
+        try:
+            # Only match the version the client saw, when it sent one
+            query = {'_id': weapon_id}
+            if expected_version is not None:
+                query['updatedAt'] = expected_version
+
+            changes['updatedAt'] = now_ms()  # Change time used by delta sync, also the new version
+            # Set only the changed fields and read back just those, in a single round-trip
+            patched_weapon = self.repository.find_one_and_update(query, {'$set': changes}, projection=list(changes))
+            self.stats.invalidate()  # The cached stats are out of date
+            if patched_weapon:
+                return patched_weapon  # Return the changed fields
+            if expected_version is not None and self.repository.count({'_id': weapon_id}, limit=1):
+                return False  # The weapon exists but has a newer version
+            return None  # Weapon not found
+
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error patching the weapon: {e}')
+            return jsonify({'error': f'Error patching the weapon: {e}'}), 500
+
     def delete_weapon(self, weapon_id):
         try:
             # Check if the weapon exists before deleting
@@ -68,7 +119,9 @@ class WeaponService:
             
             if deleted_weapon:
                 # If the weapon exists, delete it from the database
-                self.db_conn.db.weapons.delete_one({'_id': weapon_id})
+                self.repository.delete_one({'_id': weapon_id})
+                self.stats.invalidate()  # The cached stats are out of date
+                record_tombstone(self.tombstones, 'weapons', weapon_id)  # Let offline clients sync the deletion
                 return deleted_weapon  # Return the deleted weapon data
             else:
                 return None  # Weapon not found
@@ -78,6 +131,119 @@ class WeaponService:
             self.logger.error(f'Error deleting the weapon data: {e}')
             return jsonify({'error': f'Error deleting the weapon data: {e}'}), 500
 
+    def get_damage_stats(self, weapon_ids=None, include_distribution=True):
+        try:
+            # Only the damage fields are needed, so skip the rest of each document
+            query = {'_id': {'$in': weapon_ids}} if weapon_ids else {}
+            weapons = self.repository.find(query, {'named': 1, 'damage': 1, 'damageDice': 1})
+
+            results = []
+            for weapon in weapons:
+                # Older documents were stored before damage was normalized on write
+                dice = weapon.get('damageDice') or parse_damage(weapon.get('damage'))
+                entry = {'_id': weapon['_id'], 'named': weapon.get('named'), 'damage': weapon.get('damage')}
+                if dice:
+                    entry['expression'] = format_damage(dice)
+                    entry['damageType'] = dice['damageType']
+                    entry.update(damage_stats(dice, include_distribution))  # Cached per distinct expression
+                else:
+                    entry['error'] = 'Damage is not a dice expression'
+                results.append(entry)
+            return results
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing weapon damage statistics: {e}')
+            return jsonify({'error': f'Error computing weapon damage statistics: {e}'}), 500
+
+    def compute_stats(self):
+        # Weapons per category and per damage type
+        return facet_counts(self.repository, {'byCategory': count_by('$category'), 'byDamageType': count_by('$damageDice.damageType')})
+
+    def get_stats(self):
+        try:
+            # Cached aggregated stats with their version, recomputed only when the weapons changed
+            return self.stats.get()
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error computing the weapon stats: {e}')
+            return jsonify({'error': f'Error computing the weapon stats: {e}'}), 500
+
+    def submit_job(self, job_type, params):
+        try:
+            # Queue a background job; the response only carries its id and status
+            return self.jobs.submit(job_type, params)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown job type
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error submitting the weapon job: {e}')
+            return jsonify({'error': f'Error submitting the weapon job: {e}'}), 500
+
+    def get_job(self, job_id):
+        try:
+            # Fetch a job of this service with its status, progress and result
+            return self.jobs.get(job_id)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the weapon job: {e}')
+            return jsonify({'error': f'Error fetching the weapon job: {e}'}), 500
+
+    def reindex_job(self, context, params):
+        # Job handler: create the indexes and run the backfills again, e.g. after restoring a dump
+        self.ensure_indexes()
+        return {'indexes': sorted(self.repository.index_names())}
+
+    def export_archive(self, archive_format):
+        try:
+            # Compressed archive of every weapon, produced chunk by chunk while the response is sent
+            return export_archive(self.repository, 'weapons', archive_format)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error exporting the weapons: {e}')
+            return jsonify({'error': f'Error exporting the weapons: {e}'}), 500
+
+    def import_archive(self, stream, archive_format, mode):
+        try:
+            # Import an archive read from the request body as it arrives
+            return self.load_archive(stream, archive_format, mode)
+        except ValueError as e:
+            return jsonify({'error': f'Invalid data: {e}'}), 400  # Unknown format or mode, or not a weapons archive
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error importing the weapons: {e}')
+            return jsonify({'error': f'Error importing the weapons: {e}'}), 500
+
+    def load_archive(self, stream, archive_format, mode, progress=None):
+        # Import an archive, then bring what is derived from the weapons up to date
+        counts = import_archive(stream, self.repository, 'weapons', archive_format, mode, progress=progress)
+        self.ensure_indexes()  # Backfills the derived fields of weapons from older archives
+        self.stats.invalidate()
+        return counts
+
+    def export_job(self, context, params):
+        # Job handler: write an archive into ARCHIVE_DIR
+        archive_format = params.get('format', 'bson')
+        with open(archive_path(params.get('path')), 'wb') as archive:
+            for chunk in export_archive(self.repository, 'weapons', archive_format):
+                archive.write(chunk)
+            return {'path': archive.name, 'format': archive_format, 'bytes': archive.tell()}
+
+    def import_job(self, context, params):
+        # Job handler: import an archive from ARCHIVE_DIR, for archives too large to send in one request
+        with open(archive_path(params.get('path')), 'rb') as archive:
+            return self.load_archive(archive, params.get('format', 'bson'), params.get('mode', 'upsert'), progress=context.progress)
+
+    def get_changes(self, since, limit):
+        try:
+            # Fetch only the weapons changed or deleted since the client's last sync
+            return get_changes(self.repository, self.tombstones, 'weapons', since, limit)
+        except Exception as e:
+            # If something goes wrong, log the error and return an error message
+            self.logger.error(f'Error fetching the weapon changes: {e}')
+            return jsonify({'error': f'Error fetching the weapon changes: {e}'}), 500
+
 # Main block of code for testing the WeaponService
 if __name__ == '__main__':
     from models.models import WeaponModel
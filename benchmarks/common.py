@@ -0,0 +1,164 @@
+# Shared helpers for the benchmark scripts: service table, realistic payloads and in-process app loading
+import base64
+import importlib
+import logging
+import os
+import random
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Service name -> (directory, collection and URL resource)
+SERVICES = {
+    'boss': ('api_boss', 'bosses'),
+    'campaign': ('api_campaign', 'campaigns'),
+    'character': ('api_character', 'characters'),
+    'class': ('api_class', 'classes'),
+    'npc': ('api_npc', 'npcs'),
+    'weapon': ('api_weapon', 'weapons'),
+}
+
+WORDS = ('ancient', 'shadow', 'iron', 'silver', 'storm', 'ember', 'frost', 'whisper', 'crown', 'thorn',
+         'raven', 'stone', 'gale', 'hollow', 'bright', 'grim', 'oak', 'ash', 'dusk', 'vale')
+NAMES = ('Aldric', 'Brenna', 'Cormac', 'Dara', 'Elowen', 'Fenwick', 'Gwyn', 'Hale', 'Isolde', 'Jorah')
+DAMAGE_TYPES = ('slashing', 'piercing', 'bludgeoning', 'fire', 'cold', 'poison')
+
+
+def sentence(rng, words=8):
+    # Letters and spaces only, so it passes the strictest description validators
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def picture(rng, size_kb):
+    # A base64 data URI of roughly size_kb kilobytes, like the pictures clients upload
+    data = rng.randbytes(size_kb * 768)  # base64 grows the payload by a third
+    return 'data:image/png;base64,' + base64.b64encode(data).decode()
+
+
+def make_payload(service, index, rng=None, picture_kb=64):
+    # Build a request body that passes every validate_* method of the service
+    rng = rng or random.Random(index)
+    name = f'{rng.choice(NAMES)} {rng.choice(WORDS).capitalize()}'
+    if service == 'boss':
+        return {
+            'named': name, 'typed': rng.choice(('Dragon', 'Fiend', 'Undead', 'Giant')), 'picture': picture(rng, picture_kb),
+            'cr': rng.choice(('1/4', '1/2', '1', '3', '5', '8', '12', '17')), 'hp': str(rng.randint(10, 400)),
+            'ac': str(rng.randint(10, 22)), 'resistances': ', '.join(rng.sample(DAMAGE_TYPES, 2)),
+            'immunities': rng.choice(DAMAGE_TYPES), 'abilities': sentence(rng, 12),
+        }
+    if service == 'campaign':
+        return {
+            'title': f'The {name}', 'description': sentence(rng, 60), 'dm': rng.choice(NAMES), 'status': rng.choice(('pending', 'ongoing', 'finished')),
+            'pc': ', '.join(rng.sample(NAMES, 4)), 'startDate': '2024-01-01', 'endDate': '2024-12-31', 'ql': sentence(rng, 30),
+        }
+    if service == 'character':
+        return {
+            'characterName': name, 'race': rng.choice(('Elf', 'Dwarf', 'Human', 'Halfling')), 'className': rng.choice(('Wizard', 'Rogue', 'Fighter')),
+            'alignment': rng.choice(('Lawful Good', 'Chaotic Neutral', 'True Neutral')), 'level': str(rng.randint(1, 20)),
+            'background': sentence(rng, 10), 'playerName': rng.choice(NAMES), 'picture': picture(rng, picture_kb),
+        }
+    if service == 'class':
+        return {
+            'role': rng.choice(('Wizard', 'Rogue', 'Fighter', 'Cleric')), 'description': sentence(rng, 25), 'hd': 'd8',
+            'pa': 'Intelligence', 'stp': 'Intelligence, Wisdom', 'awp': 'Daggers, darts, slings, quarterstaffs, light crossbows',
+        }
+    if service == 'npc':
+        return {
+            'named': name, 'role': rng.choice(('Merchant', 'Guard', 'Innkeeper')), 'picture': picture(rng, picture_kb),
+            'personality': sentence(rng, 6), 'inventory': '2 daggers, 1 rope, 3 torches', 'likes': sentence(rng, 4),
+            'money': f'{rng.randint(1, 500)} gp', 'backstory': sentence(rng, 40),
+        }
+    if service == 'weapon':
+        return {
+            'named': name, 'category': rng.choice(('Simple Melee', 'Martial Melee', 'Martial Ranged')), 'cost': f'{rng.randint(1, 50)} gp',
+            'damage': f'{rng.randint(1, 2)}d{rng.choice((4, 6, 8, 10, 12))} {rng.choice(DAMAGE_TYPES[:3])}',
+            'properties': 'Versatile', 'description': sentence(rng, 15), 'weight': f'{rng.randint(1, 18)} lb',
+        }
+    raise ValueError(f'Unknown service: {service}')
+
+
+def make_document(service, index, rng=None, picture_kb=64):
+    # Stored form of a payload, shaped like what the routes insert
+    document = make_payload(service, index, rng, picture_kb)
+    if service == 'campaign':
+        document['pc'] = [{'characterName': name.strip()} for name in document['pc'].split(', ')]
+    document['_id'] = index
+    document['updatedAt'] = 0
+    return document
+
+
+def client_factory(backend, uri=None, database='bench_microservices'):
+    # MongoClient replacement for the service models: mongomock or a local mongod, using a throwaway database
+    if backend == 'mongomock':
+        import mongomock
+        base = mongomock.MongoClient
+    else:
+        import pymongo
+        base = pymongo.MongoClient
+
+    class BenchClient(base):
+        def __init__(self, **kwargs):
+            if backend == 'mongomock':
+                super().__init__()
+            else:
+                # Ignore the service credentials and talk to the benchmark server instead
+                super().__init__(uri or 'mongodb://localhost:27017', serverSelectionTimeoutMS=5000)
+
+        def __getitem__(self, name):
+            # The models hardcode the 'microservices' database; never touch real data
+            return super().__getitem__(database if name == 'microservices' else name)
+
+    return BenchClient
+
+
+# Top-level package names every service uses for its own modules
+SERVICE_PACKAGES = ('app', 'models', 'services', 'schemas', 'routes', 'logger', 'middleware')
+
+
+def unload_service_modules():
+    # Forget the previously imported service so the next one can be imported under the same module names
+    # Objects already created keep working, since their functions hold on to their own module globals
+    for name in list(sys.modules):
+        if name.split('.')[0] in SERVICE_PACKAGES:
+            del sys.modules[name]
+    service_directories = {os.path.join(REPO_ROOT, directory) for directory, _ in SERVICES.values()}
+    sys.path[:] = [entry for entry in sys.path if entry not in service_directories]
+
+
+def load_app(service, backend='mongomock', uri=None, database='bench_microservices'):
+    # Import a service's app module in this process against the benchmark database
+    # backend is 'mongomock', 'mongod' or 'memory' (the services' own in-process storage engine)
+    unload_service_modules()
+    directory = os.path.join(REPO_ROOT, SERVICES[service][0])
+    sys.path.insert(0, directory)
+    os.environ.setdefault('MONGODB_USER', 'bench')
+    os.environ.setdefault('MONGODB_PASS', 'bench')
+    os.environ.setdefault('MONGODB_HOST', 'localhost')
+    os.environ.setdefault('RATE_LIMIT', '0')  # The benchmarks are one client hammering the API on purpose
+
+    os.environ['STORAGE_BACKEND'] = 'memory' if backend == 'memory' else 'mongo'
+    os.environ.pop('STORAGE_SNAPSHOT', None)  # Never load or overwrite a real snapshot
+
+    models = importlib.import_module('models.models')
+    if backend != 'memory':
+        models.MongoClient = client_factory(backend, uri, database)
+    app_module = importlib.import_module('app')
+    logging.getLogger().setLevel(logging.WARNING)  # The routes log every created document at INFO
+    return app_module
+
+
+def git_commit():
+    # Commit the results belong to, so runs can be compared across commits
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
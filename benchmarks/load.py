@@ -0,0 +1,264 @@
+# End-to-end load benchmark for the six services
+#
+# Each service runs in its own process: its app is served by a threaded local HTTP server, backed by
+# mongomock (offline), a local mongod or the in-memory storage engine, seeded with realistic documents
+# and driven with a request mix at a fixed concurrency. Latency percentiles and throughput are written
+# to a JSON file.
+#
+# Usage:
+#   python benchmarks/load.py                                   # all services, mongomock
+#   python benchmarks/load.py --services character npc --backend mongod --uri mongodb://localhost:27017
+#   python benchmarks/load.py --backend memory
+#   python benchmarks/load.py --mix list=50,create=20,update=10,patch=10,delete=10 --concurrency 16
+#   python benchmarks/load.py --compare benchmarks/results/load-abc1234.json
+#
+# The mongod backend drops and reseeds the benchmark database (bench_microservices by default).
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import SERVICES, REPO_ROOT, make_payload, make_document, load_app, git_commit, percentile  # noqa: E402
+
+OPERATIONS = ('list', 'create', 'update', 'patch', 'delete')
+PATCH_FIELDS = {
+    'boss': 'hp', 'campaign': 'status', 'character': 'level', 'class': 'hd', 'npc': 'money', 'weapon': 'cost',
+}
+
+
+def parse_mix(text):
+    # "list=70,create=10" -> {'list': 70, 'create': 10}
+    mix = {}
+    for part in text.split(','):
+        operation, _, weight = part.partition('=')
+        if operation not in OPERATIONS or not weight.isdigit():
+            raise argparse.ArgumentTypeError(f'Invalid mix entry: {part}')
+        mix[operation] = int(weight)
+    return mix
+
+
+class Worker(threading.Thread):
+    # One simulated client issuing requests back to back over a keep-alive connection
+    def __init__(self, service, port, mix, deadline, ids, lock, picture_kb, seed):
+        super().__init__(daemon=True)
+        self.service = service
+        self.resource = SERVICES[service][1]
+        self.port = port
+        self.operations = list(mix)
+        self.weights = list(mix.values())
+        self.deadline = deadline
+        self.ids = ids  # Ids currently in the collection, shared between workers
+        self.lock = lock
+        self.picture_kb = picture_kb
+        self.rng = random.Random(seed)
+        self.samples = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        payload = json.dumps(body) if body is not None else None
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+                self.connection.request(method, path, payload, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                return response.status, data
+            except (http.client.HTTPException, OSError):
+                # The server closed the connection; reconnect once
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+    def pick_id(self):
+        with self.lock:
+            return self.rng.choice(self.ids) if self.ids else None
+
+    def run(self):
+        while time.perf_counter() < self.deadline:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            started = time.perf_counter()
+            try:
+                if operation == 'list':
+                    status, _ = self.request('GET', f'/api/v1/{self.resource}')
+                elif operation == 'create':
+                    body = make_payload(self.service, self.rng.randrange(1 << 30), self.rng, self.picture_kb)
+                    status, data = self.request('POST', f'/api/v1/{self.resource}', body)
+                    if status == 201:
+                        with self.lock:
+                            self.ids.append(json.loads(data)['_id'])
+                else:
+                    document_id = self.pick_id()
+                    if document_id is None:
+                        continue
+                    path = f'/api/v1/{self.resource}/{document_id}'
+                    if operation == 'update':
+                        status, _ = self.request('PUT', path, make_payload(self.service, document_id, self.rng, self.picture_kb))
+                    elif operation == 'patch':
+                        body = {PATCH_FIELDS[self.service]: make_payload(self.service, document_id, self.rng, 1)[PATCH_FIELDS[self.service]]}
+                        status, _ = self.request('PATCH', path, body)
+                    else:
+                        with self.lock:
+                            if document_id in self.ids:
+                                self.ids.remove(document_id)
+                        status, _ = self.request('DELETE', path)
+                        status = 200 if status == 404 else status  # Another worker deleted it first
+            except Exception:
+                status = None
+            elapsed = time.perf_counter() - started
+            if status is not None and status < 400:
+                self.samples[operation].append(elapsed)
+            else:
+                self.errors[operation] += 1
+
+
+def summarize(latencies, errors, duration):
+    latencies.sort()
+    milliseconds = [value * 1000 for value in latencies]
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 2),
+        'p50_ms': round(percentile(milliseconds, 0.50), 3) if milliseconds else None,
+        'p95_ms': round(percentile(milliseconds, 0.95), 3) if milliseconds else None,
+        'p99_ms': round(percentile(milliseconds, 0.99), 3) if milliseconds else None,
+        'mean_ms': round(sum(milliseconds) / len(milliseconds), 3) if milliseconds else None,
+    }
+
+
+def run_service(args):
+    # Runs inside the per-service child process and prints the result as JSON
+    from werkzeug.serving import make_server
+
+    os.chdir(tempfile.mkdtemp(prefix=f'bench-{args.worker}-'))  # The services write their log file to the cwd
+    app_module = load_app(args.worker, args.backend, args.uri, args.database)
+    repository = app_module.db_conn.repository(SERVICES[args.worker][1])
+
+    # Seed directly through the storage layer; the benchmark measures the API, not the seeding
+    repository.delete_many({})
+    rng = random.Random(args.seed)
+    for start in range(1, args.documents + 1, 500):
+        batch = [make_document(args.worker, index, rng, args.picture_kb) for index in range(start, min(start + 500, args.documents + 1))]
+        repository.insert_many(batch)
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    ids = list(range(1, args.documents + 1))
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    workers = [
+        Worker(args.worker, server.server_port, args.mix, deadline, ids, lock, args.picture_kb, args.seed + number)
+        for number in range(args.concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.perf_counter() - started
+    server.shutdown()
+
+    operations = {}
+    all_latencies = []
+    all_errors = 0
+    for operation in OPERATIONS:
+        latencies = [sample for worker in workers for sample in worker.samples[operation]]
+        errors = sum(worker.errors[operation] for worker in workers)
+        if latencies or errors:
+            operations[operation] = summarize(latencies, errors, duration)
+        all_latencies.extend(latencies)
+        all_errors += errors
+
+    print(json.dumps({'total': summarize(all_latencies, all_errors, duration), 'operations': operations}))
+
+
+def compare(current, baseline_path):
+    # Print the change in p95 and throughput against an earlier result file
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f'\nCompared with {baseline.get("commit")} ({baseline_path}):')
+    for service, result in current['services'].items():
+        previous = baseline.get('services', {}).get(service)
+        if not previous or 'total' not in result or 'total' not in previous:
+            continue
+        for operation, stats in [('total', result['total'])] + sorted(result['operations'].items()):
+            old = previous['total'] if operation == 'total' else previous['operations'].get(operation)
+            if not old or not old.get('p95_ms') or not stats.get('p95_ms'):
+                continue
+            p95_change = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms'] * 100
+            rps_change = (stats['rps'] - old['rps']) / old['rps'] * 100 if old['rps'] else 0
+            print(f'  {service:<10} {operation:<7} p95 {old["p95_ms"]:>9.2f} -> {stats["p95_ms"]:>9.2f} ms ({p95_change:+6.1f}%)'
+                  f'   rps {old["rps"]:>8.1f} -> {stats["rps"]:>8.1f} ({rps_change:+6.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark for the D&D services')
+    parser.add_argument('--services', nargs='+', choices=sorted(SERVICES), default=sorted(SERVICES))
+    parser.add_argument('--backend', choices=('mongomock', 'mongod', 'memory'), default='mongomock')
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='mongod URI for the mongod backend')
+    parser.add_argument('--database', default='bench_microservices', help='Database used instead of microservices')
+    parser.add_argument('--documents', type=int, default=200, help='Documents seeded per service')
+    parser.add_argument('--picture-kb', type=int, default=64, help='Size of the base64 pictures')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('list=70,create=10,update=10,delete=10'))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of load per service')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Result file (default benchmarks/results/load-<commit>.json)')
+    parser.add_argument('--compare', help='Earlier result file to compare against')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_service(args)
+        return
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('worker', 'output', 'compare')},
+        'services': {},
+    }
+    for service in args.services:
+        # A fresh process per service, since they all use the same module names
+        command = [sys.executable, os.path.abspath(__file__), '--worker', service,
+                   '--backend', args.backend, '--uri', args.uri, '--database', args.database,
+                   '--documents', str(args.documents), '--picture-kb', str(args.picture_kb),
+                   '--mix', ','.join(f'{operation}={weight}' for operation, weight in args.mix.items()),
+                   '--concurrency', str(args.concurrency), '--duration', str(args.duration), '--seed', str(args.seed)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(f'{service}: failed\n{completed.stderr[-2000:]}', file=sys.stderr)
+            results['services'][service] = {'error': completed.stderr[-2000:]}
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        results['services'][service] = result
+        total = result['total']
+        print(f'{service:<10} {total["rps"]:>8.1f} req/s   p50 {total["p50_ms"]} ms   p95 {total["p95_ms"]} ms'
+              f'   p99 {total["p99_ms"]} ms   errors {total["errors"]}')
+
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results', f'load-{commit}.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
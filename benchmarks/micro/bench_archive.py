@@ -0,0 +1,78 @@
+# Export and import of a collection as a compressed archive: BSON and MessagePack against gzipped JSON lines
+import gzip
+import importlib
+import io
+import json
+import random
+import zlib
+
+import pytest
+
+from common import make_document
+from conftest import load_service
+
+FORMATS = ['json', 'bson', 'msgpack']
+
+
+def json_export(repository):
+    # Baseline: one JSON document per line in the same gzip stream the archives use
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    chunks = [compressor.compress(json.dumps(document).encode() + b'\n') for document in repository.find({}, sort=[('_id', 1)])]
+    chunks.append(compressor.flush())
+    return chunks
+
+
+def json_import(stream, repository, batch_size=500):
+    batch = []
+    for line in gzip.GzipFile(fileobj=stream, mode='rb'):
+        batch.append(json.loads(line))
+        if len(batch) >= batch_size:
+            repository.insert_many(batch)
+            batch = []
+    repository.insert_many(batch)
+
+
+def filled_repository(documents):
+    # The characters collection of the character service, refilled for each benchmark
+    # services.archive is the same module in every service, so whichever service was imported last provides it
+    app_module = load_service('character')
+    archive = importlib.import_module('services.archive')
+    repository = app_module.db_conn.repository('characters')
+    repository.delete_many({})
+    repository.insert_many([dict(document) for document in documents])
+    return archive, repository
+
+
+def export_bytes(archive, repository, archive_format):
+    if archive_format == 'json':
+        return b''.join(json_export(repository))
+    return b''.join(archive.export_archive(repository, 'characters', archive_format))
+
+
+@pytest.mark.parametrize('archive_format', FORMATS)
+@pytest.mark.parametrize('count,picture_kb', [(2_000, 1), (200, 64)])
+def bench_archive_export(benchmark, archive_format, count, picture_kb):
+    # Read, encode and compress the whole collection; the archive size is recorded next to the timing
+    rng = random.Random(count)
+    archive, repository = filled_repository([make_document('character', index, rng, picture_kb) for index in range(1, count + 1)])
+    data = benchmark.pedantic(export_bytes, args=(archive, repository, archive_format), rounds=5, iterations=1)
+    benchmark.extra_info['archive_bytes'] = len(data)
+
+
+@pytest.mark.parametrize('archive_format', FORMATS)
+@pytest.mark.parametrize('count,picture_kb', [(2_000, 1), (200, 64)])
+def bench_archive_import(benchmark, archive_format, count, picture_kb):
+    # Decompress, decode and insert_many in batches of 500 into the emptied collection
+    rng = random.Random(count)
+    archive, repository = filled_repository([make_document('character', index, rng, picture_kb) for index in range(1, count + 1)])
+    data = export_bytes(archive, repository, archive_format)
+
+    def load():
+        repository.delete_many({})
+        if archive_format == 'json':
+            json_import(io.BytesIO(data), repository)
+        else:
+            archive.import_archive(io.BytesIO(data), repository, 'characters', archive_format, mode='insert')
+    benchmark.pedantic(load, rounds=5, iterations=1)
+    assert repository.count({}) == count
+    benchmark.extra_info['archive_bytes'] = len(data)
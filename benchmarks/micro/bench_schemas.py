@@ -0,0 +1,56 @@
+# Cost of every validate_* method, plus the worst cases called out for the regex and picture checks
+import random
+
+import pytest
+
+from common import make_payload, picture
+from conftest import load_service
+
+# Validators that take more than the field value
+EXTRA_ARGUMENTS = {('campaign', 'endDate'): ('startDate',)}
+
+
+def validator_cases():
+    cases = []
+    for service in ('boss', 'campaign', 'character', 'class', 'npc', 'weapon'):
+        for field in make_payload(service, 1, picture_kb=1):
+            cases.append(pytest.param(service, field, id=f'{service}-{field}'))
+    return cases
+
+
+@pytest.mark.parametrize('service,field', validator_cases())
+def bench_validator(benchmark, service, field):
+    schema = load_service(service).__dict__[f'{service}_schema']
+    payload = make_payload(service, 1, picture_kb=64)
+    validate = getattr(schema, f'validate_{field}')
+    arguments = [payload[field]] + [payload[name] for name in EXTRA_ARGUMENTS.get((service, field), ())]
+    benchmark(validate, *arguments)
+
+
+def bench_campaign_description_555_chars(benchmark):
+    # Longest accepted description; the character-class regex walks the whole string
+    schema = load_service('campaign').campaign_schema
+    description = ('Heroes gather at the old keep, where shadows linger. ' * 11)[:555]
+    benchmark(schema.validate_description, description)
+
+
+def bench_campaign_description_555_chars_rejected(benchmark):
+    # Same length with the invalid character at the very end, the slowest rejection
+    schema = load_service('campaign').campaign_schema
+    description = ('Heroes gather at the old keep, where shadows linger. ' * 11)[:554] + '9'
+
+    def validate():
+        try:
+            schema.validate_description(description)
+        except Exception:
+            pass
+    benchmark(validate)
+
+
+@pytest.mark.parametrize('size_kb', [64, 1024])
+@pytest.mark.parametrize('service', ['boss', 'character', 'npc'])
+def bench_validate_picture_data_uri(benchmark, service, size_kb):
+    # Pictures arrive as base64 data URIs; the URL regex scans every byte
+    schema = load_service(service).__dict__[f'{service}_schema']
+    data_uri = picture(random.Random(size_kb), size_kb)
+    benchmark(schema.validate_picture, data_uri)
@@ -0,0 +1,42 @@
+# Cost of turning documents into JSON responses and of the request-side normalization in the routes
+import random
+
+import pytest
+from flask import jsonify
+
+from common import make_document, make_payload
+from conftest import load_service, service_module
+
+
+@pytest.mark.parametrize('service', ['boss', 'campaign', 'character', 'class', 'npc', 'weapon'])
+def bench_jsonify_10k_documents(benchmark, service):
+    # The list endpoints jsonify the whole collection; pictures are kept small so 10k documents fit in memory
+    app = load_service(service).app
+    rng = random.Random(10_000)
+    documents = [make_document(service, index, rng, picture_kb=1) for index in range(1, 10_001)]
+
+    def serialize():
+        with app.app_context():
+            return jsonify(documents)
+    benchmark.pedantic(serialize, rounds=5, iterations=1)
+
+
+@pytest.mark.parametrize('service', ['boss', 'character', 'npc'])
+def bench_jsonify_pictures(benchmark, service):
+    # 200 documents with realistic 64 KB pictures, where the picture strings dominate the output
+    app = load_service(service).app
+    rng = random.Random(200)
+    documents = [make_document(service, index, rng, picture_kb=64) for index in range(1, 201)]
+
+    def serialize():
+        with app.app_context():
+            return jsonify(documents)
+    benchmark.pedantic(serialize, rounds=5, iterations=1)
+
+
+@pytest.mark.parametrize('players', [4, 50])
+def bench_campaign_pc_normalization(benchmark, players):
+    # pc_roster, which CampaignRoutes runs on the "Aria, Brom" string of every create and update
+    pc_roster = service_module('campaign', 'services.summaries').pc_roster
+    pc = ', '.join(f'{make_payload("character", index)["characterName"]}' for index in range(players))
+    benchmark(pc_roster, pc)
@@ -0,0 +1,70 @@
+# Service methods against an in-memory collection (mongomock, or the memory engine with BENCH_BACKEND=memory)
+import itertools
+import random
+
+import pytest
+
+from common import SERVICES, make_document, make_payload
+from conftest import load_service
+
+DOCUMENTS = 500
+
+
+@pytest.fixture
+def seeded(service_name):
+    # The service object and its repository, reseeded with realistic documents for each benchmark
+    app_module = load_service(service_name)
+    service = app_module.__dict__[f'{service_name}_service']
+    collection = app_module.db_conn.repository(SERVICES[service_name][1])
+    collection.delete_many({})
+    rng = random.Random(DOCUMENTS)
+    collection.insert_many([make_document(service_name, index, rng, picture_kb=16) for index in range(1, DOCUMENTS + 1)])
+    return service_name, service, collection
+
+
+def bench_get_all(benchmark, seeded):
+    service_name, service, _ = seeded
+    benchmark(getattr(service, f'get_all_{SERVICES[service_name][1]}'))
+
+
+def bench_get_by_id(benchmark, seeded):
+    service_name, service, _ = seeded
+    ids = itertools.cycle(range(1, DOCUMENTS + 1))
+    benchmark(lambda: getattr(service, f'get_{service_name}_by_id')(next(ids)))
+
+
+def bench_add(benchmark, seeded):
+    service_name, service, _ = seeded
+    payloads = itertools.cycle([make_payload(service_name, index, picture_kb=16) for index in range(50)])
+    benchmark(lambda: getattr(service, f'add_{service_name}')(dict(next(payloads))))
+
+
+def bench_update(benchmark, seeded):
+    service_name, service, _ = seeded
+    ids = itertools.cycle(range(1, DOCUMENTS + 1))
+    payload = make_payload(service_name, 0, picture_kb=16)
+    benchmark(lambda: getattr(service, f'update_{service_name}')(next(ids), dict(payload)))
+
+
+def bench_patch(benchmark, seeded):
+    service_name, service, _ = seeded
+    ids = itertools.cycle(range(1, DOCUMENTS + 1))
+    field = next(iter(make_payload(service_name, 0, picture_kb=1)))
+    benchmark(lambda: getattr(service, f'patch_{service_name}')(next(ids), {field: 'Patched'}))
+
+
+def bench_get_changes(benchmark, seeded):
+    _, service, collection = seeded
+    collection.update_many({'_id': {'$lte': 50}}, {'$set': {'updatedAt': 10}})
+    benchmark(service.get_changes, 5, 1000)
+
+
+def bench_delete(benchmark, seeded):
+    service_name, service, collection = seeded
+    # Each round deletes a fresh document, so re-insert it in setup
+    document = make_document(service_name, DOCUMENTS + 1, random.Random(0), picture_kb=16)
+
+    def setup():
+        collection.replace_one({'_id': document['_id']}, document, upsert=True)
+        return (document['_id'],), {}
+    benchmark.pedantic(getattr(service, f'delete_{service_name}'), setup=setup, rounds=100)
@@ -0,0 +1,47 @@
+# Micro-benchmarks for the schema validators, serialization and service hot paths
+#
+# Run from the repository root:
+#   pytest -c benchmarks/micro/pytest.ini benchmarks/micro                        # measure
+#   pytest -c benchmarks/micro/pytest.ini benchmarks/micro --benchmark-autosave   # store a baseline
+#   pytest -c benchmarks/micro/pytest.ini benchmarks/micro --benchmark-compare --benchmark-compare-fail=mean:10%
+#
+# Baselines are kept in benchmarks/micro/baselines, one folder per machine (platform and Python version).
+# The committed Linux-CPython-3.11-64bit/0001 run was taken on mongomock; compare against it with
+# --benchmark-compare=0001 on a matching machine, or store a baseline of your own machine first and compare with that.
+# Absolute timings only mean something between runs on the same machine.
+# BENCH_BACKEND=memory runs the service benchmarks on the in-memory storage engine instead of mongomock.
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import SERVICE_PACKAGES, SERVICES, load_app  # noqa: E402
+
+_loaded = {}
+_modules = {}  # Service -> its imported modules by name, kept after the next service is loaded
+
+
+def load_service(service):
+    # Import a service once against mongomock (or BENCH_BACKEND); later loads of other services don't break earlier ones
+    if service not in _loaded:
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix='bench-micro-'))  # The services create their log file in the cwd
+        try:
+            _loaded[service] = load_app(service, backend=os.environ.get('BENCH_BACKEND', 'mongomock'), database=f'bench_micro_{service}')
+            _modules[service] = {name: module for name, module in sys.modules.items() if name.split('.')[0] in SERVICE_PACKAGES}
+        finally:
+            os.chdir(cwd)
+    return _loaded[service]
+
+
+def service_module(service, name):
+    # A module of the given service (e.g. 'services.summaries' of campaign), whichever service was imported last
+    load_service(service)
+    return _modules[service][name]
+
+
+@pytest.fixture(params=sorted(SERVICES))
+def service_name(request):
+    return request.param
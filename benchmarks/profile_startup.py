@@ -0,0 +1,263 @@
+# Import-time and per-worker memory profile of the six services
+#
+# For each service, in fresh processes:
+#   - python -X importtime while importing the app; the raw log is kept and the cumulative cost of
+#     the heavy dependencies (flask, flasgger, marshmallow, pymongo, ...) is extracted
+#   - tracemalloc snapshots right after boot and after N requests, with the top allocation sites,
+#     plus the resident set size, i.e. what each gunicorn worker costs
+#
+# Usage:
+#   python benchmarks/profile_startup.py                                  # all services, 200 requests
+#   python benchmarks/profile_startup.py --services weapon --requests 1000 --api-docs static
+#   python benchmarks/profile_startup.py --compare benchmarks/results/profile-abc1234.json
+#
+# Reports are written to benchmarks/results/profile-<commit>.json and .md (the raw -X importtime logs
+# next to them). Apps run against mongomock, so numbers exclude the server but include the driver.
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import SERVICES, REPO_ROOT, make_payload, make_document, load_app, git_commit  # noqa: E402
+
+# Dependencies whose import cost is tracked on their own
+TRACKED_MODULES = ('flask', 'flasgger', 'marshmallow', 'pymongo', 'flask_cors', 'numpy', 'werkzeug', 'jinja2')
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+# Run in the child: import the app exactly like the benchmarks do
+IMPORT_SNIPPET = '''
+import sys
+sys.path.insert(0, {benchmarks!r})
+from common import load_app
+load_app({service!r})
+'''
+
+
+def rss_kb():
+    # Current resident set size of this process in kB (Linux), falling back to the peak
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def parse_importtime(log):
+    # -X importtime lines -> {module: (self_us, cumulative_us, depth)}
+    modules = {}
+    for line in log.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    return modules
+
+
+def import_profile(service, log_path, environment):
+    # Import the app under -X importtime and summarize where the time went
+    snippet = IMPORT_SNIPPET.format(benchmarks=os.path.dirname(os.path.abspath(__file__)), service=service)
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', snippet], env=environment,
+                               capture_output=True, text=True, cwd=tempfile.mkdtemp(prefix='bench-profile-'))
+    wall = time.perf_counter() - started
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr[-2000:])
+    with open(log_path, 'w') as log_file:
+        log_file.write(completed.stderr)
+
+    modules = parse_importtime(completed.stderr)
+    tracked = {name: round(modules[name][1] / 1000, 1) for name in TRACKED_MODULES if name in modules}
+    # The service's own packages, e.g. routes.routes includes flasgger when docs are live
+    own = {name: round(cumulative / 1000, 1) for name, (_, cumulative, depth) in modules.items()
+           if depth == 0 and name.split('.')[0] in ('models', 'services', 'schemas', 'routes', 'middleware', 'app')}
+    slowest = sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:15]
+    return {
+        'wall_ms': round(wall * 1000, 1),
+        'modules': len(modules),
+        'total_ms': round(sum(self_us for self_us, _, _ in modules.values()) / 1000, 1),
+        'tracked_ms': tracked,
+        'service_modules_ms': own,
+        'slowest_self_ms': [[name, round(self_us / 1000, 1)] for name, (self_us, _, _) in slowest],
+        'log': os.path.relpath(log_path, REPO_ROOT),
+    }
+
+
+def top_allocations(snapshot, limit=15):
+    # Biggest allocation sites by file, ignoring tracemalloc's own bookkeeping
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    return [[stat.traceback[0].filename.replace(sys.prefix, '<prefix>'), round(stat.size / 1024, 1), stat.count]
+            for stat in snapshot.statistics('filename')[:limit]]
+
+
+def run_worker(args):
+    # Runs in the child process: boot the app under tracemalloc, then serve N requests in-process
+    os.chdir(tempfile.mkdtemp(prefix=f'bench-profile-{args.worker}-'))  # The services write their log file to the cwd
+    tracemalloc.start(args.frames)
+    rss_start = rss_kb()
+    started = time.perf_counter()
+    app_module = load_app(args.worker)
+    boot_ms = round((time.perf_counter() - started) * 1000, 1)
+    boot = tracemalloc.take_snapshot()
+    rss_boot = rss_kb()
+
+    service, resource = args.worker, SERVICES[args.worker][1]
+    repository = app_module.db_conn.repository(resource)
+    rng = random.Random(args.seed)
+    repository.insert_many([make_document(service, index, rng, args.picture_kb) for index in range(1, args.documents + 1)])
+
+    client = app_module.app.test_client()
+    ids = list(range(1, args.documents + 1))
+    for number in range(args.requests):
+        if number % 5 == 4:
+            response = client.post(f'/api/v1/{resource}', json=make_payload(service, number, rng, args.picture_kb))
+            if response.status_code == 201:
+                ids.append(response.json['_id'])
+        elif number % 5 == 3:
+            client.put(f'/api/v1/{resource}/{rng.choice(ids)}', json=make_payload(service, number, rng, args.picture_kb))
+        else:
+            client.get(f'/api/v1/{resource}')
+    after = tracemalloc.take_snapshot()
+    rss_after = rss_kb()
+    current, peak = tracemalloc.get_traced_memory()
+
+    growth = [[stat.traceback[0].filename.replace(sys.prefix, '<prefix>'), round(stat.size_diff / 1024, 1)]
+              for stat in after.compare_to(boot, 'filename')[:10]]
+    print(json.dumps({
+        'boot_ms': boot_ms,
+        'rss_kb': {'interpreter': rss_start, 'after_boot': rss_boot, 'after_requests': rss_after},
+        'traced_kb': {
+            'after_boot': round(sum(stat.size for stat in boot.statistics('filename')) / 1024, 1),
+            'after_requests': round(current / 1024, 1),
+            'peak': round(peak / 1024, 1),
+        },
+        'top_after_boot': top_allocations(boot),
+        'growth_after_requests': growth,
+        'requests': args.requests,
+    }))
+
+
+def write_markdown(report, path):
+    lines = [f'# Startup and memory profile ({report["commit"]}, {report["timestamp"]})', '',
+             f'API_DOCS={report["config"]["api_docs"]}, {report["config"]["requests"]} requests per worker', '',
+             '| service | import ms | boot ms (traced) | RSS after boot | RSS after requests | traced after boot | traced peak |',
+             '|---|---:|---:|---:|---:|---:|---:|']
+    for service, result in report['services'].items():
+        if 'error' in result:
+            lines.append(f'| {service} | error | | | | | |')
+            continue
+        memory = result['memory']
+        lines.append(f'| {service} | {result["imports"]["total_ms"]} | {memory["boot_ms"]} | '
+                     f'{memory["rss_kb"]["after_boot"] / 1024:.1f} MB | {memory["rss_kb"]["after_requests"] / 1024:.1f} MB | '
+                     f'{memory["traced_kb"]["after_boot"] / 1024:.1f} MB | {memory["traced_kb"]["peak"] / 1024:.1f} MB |')
+    lines += ['', '## Cumulative import cost of the tracked dependencies (ms)', '',
+              '| service | ' + ' | '.join(TRACKED_MODULES) + ' |', '|---|' + '---:|' * len(TRACKED_MODULES)]
+    for service, result in report['services'].items():
+        if 'error' not in result:
+            tracked = result['imports']['tracked_ms']
+            lines.append(f'| {service} | ' + ' | '.join(str(tracked.get(name, '-')) for name in TRACKED_MODULES) + ' |')
+    for service, result in report['services'].items():
+        if 'error' in result:
+            continue
+        lines += ['', f'## {service}', '', 'Slowest modules (self time, ms): ' +
+                  ', '.join(f'{name} {ms}' for name, ms in result['imports']['slowest_self_ms'][:8]), '',
+                  'Largest allocation sites after boot (kB): ' +
+                  ', '.join(f'{os.path.basename(name)} {size}' for name, size, _ in result['memory']['top_after_boot'][:8]),
+                  '', f'Raw -X importtime log: {result["imports"]["log"]}']
+    with open(path, 'w') as output_file:
+        output_file.write('\n'.join(lines) + '\n')
+
+
+def compare(current, baseline_path):
+    # Print the change in import time and per-worker RSS against an earlier report
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f'\nCompared with {baseline.get("commit")} ({baseline_path}):')
+    for service, result in current['services'].items():
+        previous = baseline.get('services', {}).get(service)
+        if not previous or 'error' in result or 'error' in previous:
+            continue
+        old_import, new_import = previous['imports']['total_ms'], result['imports']['total_ms']
+        old_rss, new_rss = previous['memory']['rss_kb']['after_requests'], result['memory']['rss_kb']['after_requests']
+        print(f'  {service:<10} import {old_import:>8.1f} -> {new_import:>8.1f} ms   '
+              f'RSS {old_rss / 1024:>6.1f} -> {new_rss / 1024:>6.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import-time and per-worker memory profile of the D&D services')
+    parser.add_argument('--services', nargs='+', choices=sorted(SERVICES), default=sorted(SERVICES))
+    parser.add_argument('--requests', type=int, default=200, help='Requests served before the second snapshot')
+    parser.add_argument('--documents', type=int, default=50, help='Documents seeded per service')
+    parser.add_argument('--picture-kb', type=int, default=16, help='Size of the base64 pictures')
+    parser.add_argument('--api-docs', choices=('live', 'static', 'off'), default='live', help='API_DOCS mode to profile')
+    parser.add_argument('--frames', type=int, default=1, help='Traceback depth kept by tracemalloc')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Report path without extension (default benchmarks/results/profile-<commit>)')
+    parser.add_argument('--compare', help='Earlier JSON report to compare against')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    commit = git_commit()
+    output = args.output or os.path.join(REPO_ROOT, 'benchmarks', 'results', f'profile-{commit}')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    environment = dict(os.environ, API_DOCS=args.api_docs)
+    if args.api_docs == 'static':
+        # The static mode serves the spec built by the image; point it at a throwaway copy
+        environment['API_DOCS_SPEC'] = os.path.join(tempfile.mkdtemp(prefix='bench-spec-'), 'openapi.json')
+
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {'requests': args.requests, 'documents': args.documents, 'picture_kb': args.picture_kb,
+                   'api_docs': args.api_docs, 'python': sys.version.split()[0]},
+        'services': {},
+    }
+    for service in args.services:
+        try:
+            if args.api_docs == 'static':
+                subprocess.run([sys.executable, '-m', 'routes.docs', environment['API_DOCS_SPEC']], check=True,
+                               cwd=os.path.join(REPO_ROOT, SERVICES[service][0]), env=dict(environment, API_DOCS='live'),
+                               capture_output=True)
+            imports = import_profile(service, f'{output}-{service}-importtime.log', environment)
+            command = [sys.executable, os.path.abspath(__file__), '--worker', service, '--requests', str(args.requests),
+                       '--documents', str(args.documents), '--picture-kb', str(args.picture_kb),
+                       '--frames', str(args.frames), '--seed', str(args.seed)]
+            completed = subprocess.run(command, capture_output=True, text=True, env=environment)
+            if completed.returncode != 0:
+                raise RuntimeError(completed.stderr[-2000:])
+            memory = json.loads(completed.stdout.strip().splitlines()[-1])
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            print(f'{service}: failed\n{e}', file=sys.stderr)
+            report['services'][service] = {'error': str(e)}
+            continue
+        report['services'][service] = {'imports': imports, 'memory': memory}
+        print(f'{service:<10} import {imports["total_ms"]:>7.1f} ms   boot {memory["boot_ms"]:>7.1f} ms   '
+              f'RSS {memory["rss_kb"]["after_boot"] / 1024:>6.1f} -> {memory["rss_kb"]["after_requests"] / 1024:>6.1f} MB per worker')
+
+    with open(f'{output}.json', 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    write_markdown(report, f'{output}.md')
+    print(f'Report written to {output}.json and {output}.md')
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Startup-time measurement for the six services
+#
+# Default mode: time how long a fresh interpreter takes to import each service's app (what every new
+# gunicorn worker pays), once without bytecode and once with the sources precompiled like in the images.
+# Docker mode: start a built image and time until /healthcheck answers, i.e. until a new replica is ready.
+#
+# Usage:
+#   python benchmarks/startup.py                                  # import time, all services
+#   python benchmarks/startup.py --services weapon --runs 10
+#   python benchmarks/startup.py --docker dnd-weapon:latest --port 8005 --runs 3
+#
+# The import mode runs against mongomock; the docker mode starts the container with the in-memory
+# storage engine, so neither needs a MongoDB server.
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import SERVICES, REPO_ROOT  # noqa: E402
+
+# Run in the child: import the app the way load_app does and report how long it took
+IMPORT_SNIPPET = '''
+import os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {benchmarks!r})
+from common import load_app
+load_app({service!r})
+print(time.perf_counter() - started)
+'''
+
+
+def import_time(service, cache, write_bytecode):
+    # Seconds to import the app in a new interpreter using (and optionally filling) the given bytecode cache
+    environment = dict(os.environ, PYTHONPYCACHEPREFIX=cache)
+    environment.pop('PYTHONDONTWRITEBYTECODE', None)
+    if not write_bytecode:
+        environment['PYTHONDONTWRITEBYTECODE'] = '1'
+    snippet = IMPORT_SNIPPET.format(benchmarks=os.path.dirname(os.path.abspath(__file__)), service=service)
+    completed = subprocess.run([sys.executable, '-c', snippet], env=environment, capture_output=True, text=True,
+                               cwd=tempfile.mkdtemp(prefix='bench-startup-'), check=True)
+    return float(completed.stdout.strip().splitlines()[-1])
+
+
+def measure_imports(service, runs):
+    # From source: an empty cache that is never written, so every module is compiled on import
+    # Precompiled: the cache is filled once first, like pip and compileall do in the images
+    cache = tempfile.mkdtemp(prefix='bench-pycache-')
+    try:
+        source = [import_time(service, cache, write_bytecode=False) for _ in range(runs)]
+        import_time(service, cache, write_bytecode=True)
+        precompiled = [import_time(service, cache, write_bytecode=False) for _ in range(runs)]
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+    return source, precompiled
+
+
+def container_ready_time(image, port, timeout):
+    # Seconds from docker run until the healthcheck answers 200
+    started = time.perf_counter()
+    container = subprocess.run(
+        ['docker', 'run', '-d', '--rm', '-p', f'{port}:{port}', '-e', 'STORAGE_BACKEND=memory', image],
+        capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/healthcheck', timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                pass
+            time.sleep(0.05)
+        raise TimeoutError(f'{image} was not ready after {timeout} s')
+    finally:
+        subprocess.run(['docker', 'stop', '-t', '1', container], capture_output=True)
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'median_ms': round(statistics.median(samples) * 1000, 1),
+        'min_ms': round(min(samples) * 1000, 1),
+        'max_ms': round(max(samples) * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup time of the D&D services')
+    parser.add_argument('--services', nargs='+', choices=sorted(SERVICES), default=sorted(SERVICES))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--docker', help='Image to start instead of measuring the import time')
+    parser.add_argument('--port', type=int, help='Port the image listens on (docker mode)')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for a container (docker mode)')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = {}
+    if args.docker:
+        if not args.port:
+            parser.error('--port is required with --docker')
+        results[args.docker] = summarize([container_ready_time(args.docker, args.port, args.timeout) for _ in range(args.runs)])
+        print(f'{args.docker}: ready in {results[args.docker]["median_ms"]} ms (median of {args.runs})')
+    else:
+        for service in args.services:
+            source, precompiled = measure_imports(service, args.runs)
+            cold, warm = summarize(source), summarize(precompiled)
+            results[service] = {'source': cold, 'precompiled': warm}
+            print(f'{service:<10} import {cold["median_ms"]:>8.1f} ms from source   {warm["median_ms"]:>8.1f} ms precompiled')
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
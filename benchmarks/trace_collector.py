@@ -0,0 +1,118 @@
+# Stand-in OTLP/HTTP trace collector and trace report
+#
+# Collector mode: accept OTLP JSON on /v1/traces (what the services send with TRACE_EXPORT=otlp:<url>)
+# and append every request body to a JSON lines file, the same format the file exporter writes.
+# Report mode: read one or more of those files and print the slowest traces as span trees, plus the
+# total time per span name, to see where request latency goes (validation, Mongo commands, serialization).
+#
+# Usage:
+#   python benchmarks/trace_collector.py --port 4318 --output traces.jsonl
+#   TRACING=1 TRACE_EXPORT=otlp:http://localhost:4318/v1/traces gunicorn ...
+#   python benchmarks/trace_collector.py --report traces.jsonl api_boss/boss-api_traces.jsonl --top 5
+import argparse
+import collections
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(output_path):
+    lock = threading.Lock()
+
+    class CollectorHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/v1/traces':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                self.send_error(400, 'Expected OTLP JSON')
+                return
+            with lock, open(output_path, 'a') as output_file:
+                output_file.write(json.dumps(payload) + '\n')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(b'{}')
+
+        def log_message(self, format, *args):
+            pass  # One line per batch would drown the report
+
+    return CollectorHandler
+
+
+def read_spans(paths):
+    # Flatten the OTLP bodies into (service, span) pairs
+    for path in paths:
+        with open(path) as trace_file:
+            for line in trace_file:
+                if not line.strip():
+                    continue
+                for resource_spans in json.loads(line).get('resourceSpans', []):
+                    attributes = {item['key']: item['value'] for item in resource_spans.get('resource', {}).get('attributes', [])}
+                    service = attributes.get('service.name', {}).get('stringValue', '?')
+                    for scope_spans in resource_spans.get('scopeSpans', []):
+                        for span in scope_spans.get('spans', []):
+                            yield service, span
+
+
+def duration_ms(span):
+    return (int(span['endTimeUnixNano']) - int(span['startTimeUnixNano'])) / 1e6
+
+
+def report(paths, top):
+    traces = collections.defaultdict(list)
+    totals = collections.defaultdict(lambda: [0, 0.0])  # span name -> [count, total ms]
+    for service, span in read_spans(paths):
+        traces[span['traceId']].append((service, span))
+        totals[span['name']][0] += 1
+        totals[span['name']][1] += duration_ms(span)
+
+    def trace_duration(spans):
+        return max(int(span['endTimeUnixNano']) for _, span in spans) - min(int(span['startTimeUnixNano']) for _, span in spans)
+
+    print(f'{len(traces)} traces\n')
+    for trace_id, spans in sorted(traces.items(), key=lambda item: trace_duration(item[1]), reverse=True)[:top]:
+        print(f'trace {trace_id}  {trace_duration(spans) / 1e6:.2f} ms')
+        ids = {span['spanId'] for _, span in spans}
+        children = collections.defaultdict(list)
+        for service, span in spans:
+            # Spans whose parent was not recorded (e.g. the caller is outside the system) are roots
+            children[span.get('parentSpanId') if span.get('parentSpanId') in ids else None].append((service, span))
+
+        def show(parent, depth):
+            for service, span in sorted(children[parent], key=lambda item: int(item[1]['startTimeUnixNano'])):
+                failed = '  ERROR' if span.get('status', {}).get('code') == 2 else ''
+                print(f'  {"  " * depth}{span["name"]:<{48 - 2 * depth}} {duration_ms(span):>9.2f} ms  [{service}]{failed}')
+                show(span['spanId'], depth + 1)
+        show(None, 0)
+        print()
+
+    print(f'{"span":<48} {"count":>7} {"total ms":>10} {"mean ms":>9}')
+    for name, (count, total) in sorted(totals.items(), key=lambda item: item[1][1], reverse=True):
+        print(f'{name:<48} {count:>7} {total:>10.2f} {total / count:>9.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in OTLP trace collector and trace report')
+    parser.add_argument('--port', type=int, default=4318)
+    parser.add_argument('--output', default='traces.jsonl', help='File the collector appends to')
+    parser.add_argument('--report', nargs='+', metavar='FILE', help='Print a report of these trace files instead of collecting')
+    parser.add_argument('--top', type=int, default=10, help='Slowest traces to print in the report')
+    args = parser.parse_args()
+
+    if args.report:
+        report(args.report, args.top)
+        return
+    server = ThreadingHTTPServer(('0.0.0.0', args.port), make_handler(args.output))
+    print(f'Collecting traces on http://localhost:{args.port}/v1/traces into {args.output}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+# Behavior tests of the services' code; run from the repository root with: python -m pytest tests
+# The services are separate apps with the same module names, so one copy (api_boss) of the shared modules is
+# imported and test_copies_match checks that the other services carry the same file; modules of a single service
+# that import nothing from it are loaded from their file with load_module
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ('boss', 'campaign', 'character', 'class', 'npc', 'weapon')
+
+sys.path.insert(0, os.path.join(ROOT, 'api_boss'))
+
+
+def load_module(service, path):
+    # e.g. load_module('weapon', 'schemas/dice.py'), under a name that can't clash with api_boss's modules
+    name = f'api_{service}_' + path[:-3].replace('/', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, f'api_{service}', path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(autouse=True)
+def log_directory(tmp_path, monkeypatch):
+    # The services' Logger writes its file to the working directory
+    monkeypatch.chdir(tmp_path)
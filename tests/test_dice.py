@@ -0,0 +1,87 @@
+# Damage expressions of the weapon service: the parser (schemas/dice.py) and the roll statistics (services/dice_stats.py)
+import time
+
+import pytest
+
+from conftest import load_module
+
+dice = load_module('weapon', 'schemas/dice.py')
+dice_stats = load_module('weapon', 'services/dice_stats.py')
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('1d8 slashing', (1, 8, 0, 'slashing')),
+    ('2d6 + 3 fire', (2, 6, 3, 'fire')),
+    ('2D6-1', (2, 6, -1, None)),
+    ('d4 piercing', (1, 4, 0, 'piercing')),
+    ('  1d10\t+\t2  Cold  ', (1, 10, 2, 'cold')),
+    ('1d6 bludgeoning or piercing', (1, 6, 0, 'bludgeoning or piercing')),
+    ('1d8slashing', (1, 8, 0, 'slashing')),
+    ('1d4 lightning-thunder', (1, 4, 0, 'lightning-thunder')),
+    ('1 piercing', (0, 0, 1, 'piercing')),  # Flat damage: no dice, just the modifier
+    ('100d100', (100, 100, 0, None)),
+])
+def test_parse_damage(value, expected):
+    count, sides, modifier, damage_type = expected
+    assert dice.parse_damage(value) == {'count': count, 'sides': sides, 'modifier': modifier, 'damageType': damage_type}
+
+
+@pytest.mark.parametrize('value', [
+    None, 8, '', '-', 'special', '+1', '1d1', 'd', '101d6', '1d101', '1d8 +', '1d8 fire!', '1d8 fire-',
+    '1d8 ' + 'a' * 64,  # Longer than MAX_DAMAGE_LENGTH
+])
+def test_parse_damage_refuses(value):
+    assert dice.parse_damage(value) is None
+
+
+@pytest.mark.parametrize('value', [
+    '1d8 a' + ' ' * 20000 + '!',
+    '1' + ' ' * 20000 + '!',
+    'a' + ' -' * 10000 + '!',
+    '1d8' + ' ' * 20000 + '+' + ' ' * 20000 + '!',
+])
+def test_pattern_fails_in_linear_time(value):
+    # The parser is bounded by MAX_DAMAGE_LENGTH; the pattern itself must not backtrack quadratically either
+    started = time.perf_counter()
+    assert dice.DICE_PATTERN.fullmatch(value.strip()) is None
+    assert time.perf_counter() - started < 0.5
+
+
+@pytest.mark.parametrize('value,expression', [
+    ('2d6 + 3 fire', '2d6+3'), ('1d8 - 1', '1d8-1'), ('d4', '1d4'), ('5 piercing', '5'),
+])
+def test_format_damage(value, expression):
+    assert dice.format_damage(dice.parse_damage(value)) == expression
+
+
+def test_single_die_stats():
+    stats = dice_stats.damage_stats({'count': 1, 'sides': 6, 'modifier': 0})
+    assert (stats['min'], stats['max'], stats['mean']) == (1, 6, 3.5)
+    assert stats['variance'] == round(35 / 12, 4)
+    assert stats['distribution'] == [[total, round(1 / 6, 6)] for total in range(1, 7)]
+
+
+def test_dice_pool_stats():
+    stats = dice_stats.damage_stats({'count': 2, 'sides': 6, 'modifier': 3})
+    assert (stats['min'], stats['max'], stats['mean']) == (5, 15, 10.0)
+    probabilities = dict(stats['distribution'])
+    assert probabilities[10] == round(6 / 36, 6) and probabilities[5] == probabilities[15] == round(1 / 36, 6)
+    assert sum(probabilities.values()) == pytest.approx(1, abs=1e-5)
+
+
+def test_flat_damage_and_large_pools():
+    assert dice_stats.damage_stats({'count': 0, 'sides': 0, 'modifier': 4}) == {
+        'min': 4, 'max': 4, 'mean': 4.0, 'variance': 0.0, 'stdDev': 0.0, 'distribution': [[4, 1.0]],
+    }
+    # 100d100 uses the square-and-multiply convolutions; mean and variance follow from a single die's
+    stats = dice_stats.damage_stats({'count': 100, 'sides': 100, 'modifier': -10}, include_distribution=False)
+    assert (stats['min'], stats['max']) == (90, 9990) and 'distribution' not in stats
+    assert stats['mean'] == pytest.approx(100 * 50.5 - 10)
+    assert stats['variance'] == pytest.approx(100 * (100 ** 2 - 1) / 12, rel=1e-6)
+
+
+def test_distributions_are_cached_read_only():
+    first = dice_stats.damage_distribution(3, 8, 0)
+    assert dice_stats.damage_distribution(3, 8, 0) is first
+    with pytest.raises(ValueError):
+        first['pmf'][0] = 1
@@ -0,0 +1,67 @@
+# Encounter pricing of the boss service (services/encounter.py): XP thresholds, multipliers and the suggestion search
+import time
+
+import pytest
+
+from conftest import load_module
+
+encounter = load_module('boss', 'services/encounter.py')
+
+
+def test_party_thresholds_add_up_the_levels():
+    # Dungeon Master's Guide example: four level 3 characters and one level 2 one
+    assert encounter.party_thresholds([3, 3, 3, 3, 2]) == {'easy': 350, 'medium': 700, 'hard': 1050, 'deadly': 1800}
+
+
+def test_party_thresholds_clamp_the_level():
+    assert encounter.party_thresholds([0, 25]) == encounter.party_thresholds([1, 20])
+
+
+@pytest.mark.parametrize('monsters,party,multiplier', [
+    (0, 4, 0), (1, 4, 1), (2, 4, 1.5), (3, 4, 2), (6, 4, 2), (7, 4, 2.5), (11, 4, 3), (15, 4, 4),
+    (1, 2, 1.5), (15, 2, 5),  # Small parties move one bracket up
+    (1, 6, 0.5), (3, 6, 1.5),  # Large parties move one bracket down
+])
+def test_encounter_multiplier(monsters, party, multiplier):
+    assert encounter.encounter_multiplier(monsters, party) == multiplier
+
+
+@pytest.mark.parametrize('adjusted,difficulty', [
+    (0, 'trivial'), (349, 'trivial'), (350, 'easy'), (700, 'medium'), (1049, 'medium'), (1050, 'hard'), (1800, 'deadly'),
+])
+def test_rate_encounter(adjusted, difficulty):
+    thresholds = encounter.party_thresholds([3, 3, 3, 3, 2])
+    assert encounter.rate_encounter(adjusted, thresholds) == difficulty
+
+
+def test_evaluate_encounter_counts_every_monster():
+    # Two CR 2 monsters against four level 3 characters: 900 XP times 1.5
+    result = encounter.evaluate_encounter([3, 3, 3, 3], [2, 2])
+    assert (result['baseXp'], result['multiplier'], result['adjustedXp'], result['difficulty']) == (900, 1.5, 1350, 'hard')
+
+
+def test_difficulty_window():
+    thresholds = encounter.party_thresholds([5, 5, 5, 5])
+    assert encounter.difficulty_window(thresholds, 'medium') == (2000, 3000)
+    assert encounter.difficulty_window(thresholds, 'deadly') == (4400, 4400 * encounter.DEADLY_CEILING)
+
+
+def test_search_stays_in_the_window_and_the_stock():
+    available = {1: 2, 2: 1, 5: 3}
+    low, high = 1500, 3000
+    found = encounter.search_cr_combinations(available, 4, low, high, 4, 20)
+    assert found
+    for combination, adjusted in found:
+        assert low <= adjusted < high
+        assert adjusted == sum(encounter.CR_XP[cr] for cr in combination) * encounter.encounter_multiplier(len(combination), 4)
+        assert all(combination.count(cr) <= available[cr] for cr in combination)
+
+
+def test_search_stops_at_the_limit():
+    available = {cr: 100 for cr in encounter.CR_XP}
+    thresholds = encounter.party_thresholds([20] * 10)
+    low, high = encounter.difficulty_window(thresholds, 'easy')
+    start = time.perf_counter()
+    found = encounter.search_cr_combinations(available, 10, low, high, 6, 5)
+    assert len(found) == 5
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,232 @@
+# The in-memory storage engine (STORAGE_BACKEND=memory) against the MongoDB behavior the services rely on
+import os
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from conftest import ROOT, SERVICES
+from models.memory_engine import MemoryDatabase, MemoryRepository
+
+
+@pytest.fixture
+def repository():
+    db_conn = SimpleNamespace(db=MemoryDatabase())
+    repository = MemoryRepository(db_conn, 'items')
+    repository.insert_many([
+        {'_id': 1, 'name': 'Aria', 'level': 3, 'tags': ['elf', 'ranger'], 'pc': [{'characterName': 'Aria'}]},
+        {'_id': 2, 'name': 'Brom', 'level': 5, 'tags': ['dwarf'], 'pc': [{'characterName': 'Brom'}, {'characterName': 'Aria'}]},
+        {'_id': 3, 'name': 'Cora', 'level': 1, 'tags': [], 'extra': None},
+        {'_id': 4, 'name': 'dara', 'level': '7'},
+    ])
+    return repository
+
+
+def ids(documents):
+    return [document['_id'] for document in documents]
+
+
+def test_copies_match():
+    # Every service ships the same engine
+    with open(os.path.join(ROOT, 'api_boss', 'models', 'memory_engine.py'), 'rb') as reference:
+        expected = reference.read()
+    for service in SERVICES:
+        with open(os.path.join(ROOT, f'api_{service}', 'models', 'memory_engine.py'), 'rb') as copy:
+            assert copy.read() == expected, service
+
+
+@pytest.mark.parametrize('query,expected', [
+    ({}, [1, 2, 3, 4]),
+    ({'name': 'Brom'}, [2]),
+    ({'level': {'$gt': 2}}, [1, 2]),  # Range operators skip values of another type ('7')
+    ({'level': {'$gte': 3, '$lte': 5}}, [1, 2]),
+    ({'level': {'$ne': 3}}, [2, 3, 4]),
+    ({'level': {'$in': [1, '7']}}, [3, 4]),
+    ({'level': {'$nin': [1, 3]}}, [2, 4]),
+    ({'tags': 'elf'}, [1]),  # Equality on an array matches its elements
+    ({'tags': {'$all': ['elf', 'ranger']}}, [1]),
+    ({'tags': {'$size': 0}}, [3]),
+    ({'pc.characterName': 'Aria'}, [1, 2]),
+    ({'pc': {'$elemMatch': {'characterName': 'Brom'}}}, [2]),
+    ({'extra': None}, [1, 2, 3, 4]),  # null matches missing fields too
+    ({'extra': {'$exists': True}}, [3]),
+    ({'name': {'$regex': '^d', '$options': 'i'}}, [4]),
+    ({'level': {'$not': {'$gt': 2}}}, [3, 4]),
+    ({'$or': [{'name': 'Aria'}, {'level': 5}]}, [1, 2]),
+    ({'$and': [{'level': {'$gt': 1}}, {'tags': 'dwarf'}]}, [2]),
+    ({'$nor': [{'level': 1}, {'level': 3}]}, [2, 4]),
+    ({'$or': [{'level': {'$gt': 3}}, {'level': 3, '_id': {'$gt': 0}}]}, [1, 2]),  # Delta sync keyset shape
+    ({'$expr': {'$lt': ['$_id', '$level']}}, [1, 2, 4]),  # Fields compared with each other; '7' sorts after numbers
+    ({'$expr': {'$gte': ['$_id', {'$ifNull': ['$missing', 3]}]}}, [3, 4]),
+])
+def test_query_operators(repository, query, expected):
+    assert ids(repository.find(query)) == expected
+    assert repository.count(query) == len(expected)
+
+
+def test_query_operators_with_indexes(repository):
+    # Index candidates give the same results, in natural order
+    repository.create_index('level')
+    repository.create_index('tags')
+    assert ids(repository.find({'level': {'$gt': 2}})) == [1, 2]
+    assert ids(repository.find({'tags': {'$in': ['dwarf', 'elf']}})) == [1, 2]
+    assert repository.explain({'tags': 'elf'})['indexes'] == ['tags_1']
+    assert repository.explain({'missing': 1})['stages'] == ['COLLSCAN']
+
+
+def test_unknown_operator_is_refused(repository):
+    with pytest.raises(ValueError):
+        repository.find({'level': {'$where': 'true'}})
+
+
+def test_sort_skip_limit_and_projection(repository):
+    # Mixed types sort like MongoDB: numbers before strings
+    assert ids(repository.find(sort=[('level', -1)])) == [4, 2, 1, 3]
+    assert ids(repository.find(sort=[('level', 1)], skip=1, limit=2)) == [1, 2]
+    assert ids(repository.find({}, sort=[('tags', 1), ('_id', -1)])) == [4, 3, 2, 1]
+    assert repository.find_one({'_id': 2}, {'name': 1}) == {'_id': 2, 'name': 'Brom'}
+    assert repository.find_one({'_id': 2}, {'pc': 0, 'tags': 0, '_id': 0}) == {'name': 'Brom', 'level': 5}
+
+
+def test_natural_order_survives_updates_and_deletes(repository):
+    repository.create_index('level')
+    repository.update_one({'_id': 1}, {'$set': {'level': 9}})
+    repository.delete_one({'_id': 2})
+    repository.insert_one({'_id': 0, 'level': 9})
+    assert ids(repository.find({'level': {'$gt': 2}})) == [1, 0]  # Index path, ordered by insertion
+    assert ids(repository.find()) == [1, 3, 4, 0]
+
+
+def test_results_are_copies(repository):
+    document = repository.find_one({'_id': 1})
+    document['tags'].append('changed')
+    assert repository.find_one({'_id': 1})['tags'] == ['elf', 'ranger']
+
+
+def test_update_operators(repository):
+    assert repository.update_one({'_id': 1}, {
+        '$set': {'name': 'Ayla', 'stats.str': 10},
+        '$inc': {'level': 2},
+        '$unset': {'pc': ''},
+        '$push': {'tags': {'$each': ['bard', 'elf']}},
+    }) == 1
+    assert repository.find_one({'_id': 1}) == {'_id': 1, 'name': 'Ayla', 'level': 5, 'tags': ['elf', 'ranger', 'bard', 'elf'],
+                                               'stats': {'str': 10}}
+    repository.update_one({'_id': 1}, {'$addToSet': {'tags': 'elf'}, '$pull': {'tags': 'bard'}})
+    assert repository.find_one({'_id': 1})['tags'] == ['elf', 'ranger', 'elf']
+    repository.update_one({'_id': 1}, {'$max': {'level': 4}, '$min': {'stats.str': 8}})
+    assert repository.find_one({'_id': 1}, ['level', 'stats'])['level'] == 5
+    assert repository.find_one({'_id': 1})['stats'] == {'str': 8}
+    assert repository.update_one({'_id': 1}, {'$set': {'level': 5}}) == 0  # Nothing changed
+    assert repository.update_many({'level': {'$lt': 5}}, {'$set': {'low': True}}) == 1
+    with pytest.raises(ValueError):
+        repository.update_one({'_id': 1}, {'name': 'no operator'})
+
+
+def test_find_one_and_update_returns_either_image(repository):
+    assert repository.find_one_and_update({'_id': 1}, {'$set': {'name': 'Ayla'}}, projection=['name']) == {'_id': 1, 'name': 'Ayla'}
+    assert repository.find_one_and_update({'_id': 1}, {'$set': {'name': 'Aria'}}, projection=['name'], before=True) == {'_id': 1, 'name': 'Ayla'}
+    assert repository.find_one_and_update({'_id': 9}, {'$set': {'name': 'New'}}, upsert=True, before=True) is None
+    assert repository.find_one({'_id': 9}) == {'_id': 9, 'name': 'New'}
+    assert repository.find_one_and_update({'_id': 99}, {'$set': {'name': 'x'}}, before=True) is None
+
+
+def test_array_filters(repository):
+    # Rename one roster entry, as the character cascade does
+    modified = repository.update_many(
+        {'pc.characterName': 'Aria'},
+        {'$set': {'pc.$[member].characterName': 'Ayla'}},
+        array_filters=[{'member.characterName': 'Aria'}],
+    )
+    assert modified == 2
+    assert repository.find_one({'_id': 2})['pc'] == [{'characterName': 'Brom'}, {'characterName': 'Ayla'}]
+    # $[] updates every element; $pull with a sub-document condition removes the matches
+    repository.update_one({'_id': 2}, {'$set': {'pc.$[].active': True}})
+    assert all(member['active'] for member in repository.find_one({'_id': 2})['pc'])
+    repository.update_one({'_id': 2}, {'$pull': {'pc': {'characterName': 'Brom'}}})
+    assert repository.find_one({'_id': 2})['pc'] == [{'characterName': 'Ayla', 'active': True}]
+    with pytest.raises(ValueError):
+        repository.update_one({'_id': 2}, {'$set': {'pc.$[other].x': 1}}, array_filters=[{'member.x': 1}])
+
+
+def test_upserts(repository):
+    # Equality fields of the filter and $setOnInsert only go into a new document
+    assert repository.update_one({'name': 'Eve', 'level': {'$eq': 2}, 'tags': {'$in': ['x']}},
+                                 {'$set': {'seen': 1}, '$setOnInsert': {'created': True}}, upsert=True) == 0
+    created = repository.find_one({'name': 'Eve'})
+    assert {key: value for key, value in created.items() if key != '_id'} == {'name': 'Eve', 'level': 2, 'seen': 1, 'created': True}
+    repository.update_one({'name': 'Eve'}, {'$set': {'seen': 2}, '$setOnInsert': {'created': False}}, upsert=True)
+    assert repository.find_one({'name': 'Eve'})['created'] is True
+    counter = repository.find_one_and_update({'_id': 'seq'}, {'$inc': {'value': 5}}, upsert=True)
+    assert counter == {'_id': 'seq', 'value': 5}
+    assert repository.replace_one({'_id': 10}, {'name': 'Fay'}, upsert=True) == 0
+    assert repository.replace_one({'_id': 10}, {'name': 'Gil'}) == 1
+    assert repository.find_one({'_id': 10}) == {'_id': 10, 'name': 'Gil'}
+    repository.upsert_many([{'_id': 10, 'name': 'Hal'}, {'_id': 11, 'name': 'Ivy'}])
+    assert ids(repository.find({'_id': {'$in': [10, 11]}}, sort=[('_id', 1)])) == [10, 11]
+    assert repository.find_one({'_id': 10})['name'] == 'Hal'
+
+
+def test_unique_indexes(repository):
+    repository.create_index('name', unique=True)
+    with pytest.raises(DuplicateKeyError):
+        repository.insert_one({'_id': 5, 'name': 'Aria'})
+    with pytest.raises(DuplicateKeyError):
+        repository.update_one({'_id': 2}, {'$set': {'name': 'Aria'}})
+    with pytest.raises(DuplicateKeyError):
+        repository.insert_one({'_id': 1})
+    assert repository.find_one({'_id': 2})['name'] == 'Brom'
+
+
+def test_next_id_tracks_inserts_and_deletes(repository):
+    assert repository.next_id() == 5
+    repository.insert_one({'_id': 41})
+    assert repository.next_id() == 42
+    repository.delete_one({'_id': 41})
+    assert repository.next_id() == 5
+    repository.delete_many({})
+    assert repository.next_id() == 1
+
+
+def test_distinct_and_aggregate(repository):
+    assert sorted(repository.distinct('tags')) == ['dwarf', 'elf', 'ranger']
+    assert repository.distinct('pc.characterName', {'_id': 2}) == ['Brom', 'Aria']
+    result = list(repository.aggregate([
+        {'$match': {'_id': {'$lte': 3}}},
+        {'$unwind': '$tags'},
+        {'$group': {'_id': '$tags', 'count': {'$sum': 1}, 'levels': {'$push': '$level'}}},
+        {'$sort': {'_id': 1}},
+    ]))
+    assert result == [{'_id': 'dwarf', 'count': 1, 'levels': [5]}, {'_id': 'elf', 'count': 1, 'levels': [3]},
+                      {'_id': 'ranger', 'count': 1, 'levels': [3]}]
+    facets = list(repository.aggregate([{'$facet': {'total': [{'$count': 'count'}], 'top': [{'$sort': {'_id': -1}}, {'$limit': 1}]}}]))
+    assert facets[0]['total'] == [{'count': 4}] and facets[0]['top'][0]['_id'] == 4
+
+
+def test_ttl_indexes_purge_expired_documents():
+    from datetime import datetime, timedelta, timezone
+    db_conn = SimpleNamespace(db=MemoryDatabase())
+    repository = MemoryRepository(db_conn, 'keys')
+    repository.create_index('expiresAt', expire_after_seconds=0)
+    now = datetime.now(timezone.utc)
+    repository.insert_many([{'_id': 1, 'expiresAt': now - timedelta(seconds=1)}, {'_id': 2, 'expiresAt': now + timedelta(hours=1)}])
+    assert db_conn.db['keys'].purge_expired(now) == 1
+    assert ids(repository.find()) == [2]
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'snapshot.bson')
+    database = MemoryDatabase(snapshot_path=path)
+    repository = MemoryRepository(SimpleNamespace(db=database), 'items')
+    repository.create_index('name', unique=True)
+    repository.insert_many([{'_id': 2, 'name': 'b'}, {'_id': 1, 'name': 'a'}])
+    database.snapshot()
+
+    restored = MemoryDatabase(snapshot_path=path)
+    restored.load()
+    repository = MemoryRepository(SimpleNamespace(db=restored), 'items')
+    assert ids(repository.find()) == [2, 1]
+    assert repository.index_names() == ['_id_', 'name_1']
+    assert repository.next_id() == 3
+    with pytest.raises(DuplicateKeyError):
+        repository.insert_one({'_id': 3, 'name': 'a'})